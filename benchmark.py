@@ -0,0 +1,390 @@
+#!/usr/bin/python3
+
+"""
+Benchmark whatpkgs.py on the static sampledata.
+
+Every scenario runs whatpkgs.py in a fresh process with --stats-json, so
+each measurement includes loading the repositories and its peak RSS is not
+skewed by the previous scenarios. The options of each scenario (hints,
+filters, inputs) are read from the recipe.json of the sampledata directory,
+which holds the same settings as its update_sampledata.sh, and the output
+is checked against the package lists committed there.
+
+The results are appended to a JSON history file so that runs can be
+compared across changes.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import click
+
+import sqliterepo
+import whatpkgs
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# Sampledata directory of each repository set that has known-good lists
+DATASETS = {
+    "f25": "sampledata/fedora/25",
+    "f26": "sampledata/fedora/26",
+    "rhel7.3beta": "sampledata/rhel/7.3beta",
+}
+
+SCENARIOS = ("load-cold", "load-warm", "getsourcerpm", "neededby",
+             "neededtoselfhost")
+
+
+class BenchmarkException(Exception):
+    """
+    Raised when whatpkgs.py fails to run a scenario
+    """
+    def __init__(self, argv, returncode, stderr):
+        lines = stderr.strip().splitlines()
+        super(BenchmarkException, self).__init__(
+            "whatpkgs.py %s exited with status %d: %s" % (
+                argv[0], returncode,
+                lines[-1] if lines else "no output"))
+
+
+def read_list(path):
+    """
+    Read a package list, skipping blank lines and comments
+    """
+    with open(path) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.startswith("#")]
+
+
+def _repo_options(recipe):
+    if recipe.get("rhel", False):
+        return ["--rhel"]
+    return ["--version", str(recipe.get("version", "25"))]
+
+
+def _closure_options(recipe, settings):
+    options = ["--merge"]
+    if settings.get("recommends", False):
+        options.append("--recommends")
+    else:
+        options.append("--no-recommends")
+    if settings.get("pick-first", False):
+        options.append("--pick-first")
+    for hint in settings.get("hints", []):
+        options.append("--hint=%s" % hint)
+    for name in recipe.get("filters", []):
+        options.append("--filter=%s" % name)
+    return options
+
+
+def read_recipe(dataset):
+    with open(os.path.join(DIR_PATH, DATASETS[dataset], "recipe.json")) as f:
+        return json.load(f)
+
+
+def has_repodata(dataset, backend):
+    """
+    Check that the metadata read by the backend is present for every
+    repository of a dataset. The Fedora datasets need the Everything
+    repodata, which is not part of the tree.
+    """
+    recipe = read_recipe(dataset)
+    (setname, repos) = whatpkgs._get_static_repos(
+        recipe.get("rhel", False), str(recipe.get("version", "25")))
+    datatype = "primary_db" if backend == "sqlite" else "primary"
+    for (reponame, path) in repos:
+        try:
+            if not os.path.exists(sqliterepo.find_repodata(path, datatype)):
+                return False
+        except sqliterepo.RepodataException:
+            return False
+    return True
+
+
+def get_scenarios(dataset):
+    """
+    Build the command line and the reference list of every scenario of a
+    dataset from its recipe.json
+
+    Returns: list of (scenario, argv, reference path or None) tuples, in
+             the order of SCENARIOS
+    """
+    basedir = os.path.join(DIR_PATH, DATASETS[dataset])
+
+    def path(name):
+        return os.path.join(basedir, name)
+
+    def names(files):
+        found = []
+        for name in files:
+            found.extend(read_list(path(name)))
+        return found
+
+    recipe = read_recipe(dataset)
+    repos = _repo_options(recipe)
+    toplevel = names(recipe["inputs"])
+    runtime = recipe.get("runtime", {})
+    selfhost = recipe.get("selfhost", {})
+    if "inputs" in selfhost:
+        selfhost_roots = names(selfhost["inputs"])
+    else:
+        # Self-host the runtime closure
+        selfhost_roots = names(
+            ["runtime-binary-dependency-packages-short.txt"])
+
+    return [
+        ("load-cold",
+         ["getsourcerpm", "--rebuild-cache"] + repos + toplevel[:1], None),
+        ("load-warm",
+         ["getsourcerpm"] + repos + toplevel[:1], None),
+        ("getsourcerpm",
+         ["getsourcerpm"] + repos +
+         names(["selfhosting-binary-packages-short.txt"]),
+         path("selfhosting-source-packages-short.txt")),
+        ("neededby",
+         ["neededby"] + repos + _closure_options(recipe, runtime) + toplevel,
+         path("runtime-binary-dependency-packages-short.txt")),
+        ("neededtoselfhost",
+         ["neededtoselfhost", "--no-sources"] + repos +
+         _closure_options(recipe, selfhost) + selfhost_roots,
+         path("selfhosting-binary-packages-short.txt")),
+    ]
+
+
+def run_whatpkgs(argv, backend, filelists):
+    """
+    Run whatpkgs.py with --stats-json in a new process
+
+    Returns: tuple of the wall time, the statistics and the lines printed
+    """
+    (fd, stats_path) = tempfile.mkstemp(prefix="whatpkgs-stats-",
+                                        suffix=".json")
+    os.close(fd)
+    # The common options go right after the subcommand name
+    command = argv[:1] + ["--backend", backend, "--filelists", filelists,
+                          "--stats-json", stats_path] + argv[1:]
+    try:
+        start = time.time()
+        proc = subprocess.run(
+            [sys.executable, os.path.join(DIR_PATH, "whatpkgs.py")] +
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        elapsed = time.time() - start
+        if proc.returncode != 0:
+            raise BenchmarkException(command, proc.returncode, proc.stderr)
+        with open(stats_path) as f:
+            stats = json.load(f)
+    finally:
+        os.unlink(stats_path)
+
+    lines = [line.strip() for line in proc.stdout.splitlines()
+             if line.strip()]
+    return (elapsed, stats, lines)
+
+
+def compare_with_reference(lines, reference):
+    """
+    Compare the printed packages with a committed list, as sets since the
+    order of equal names is not significant
+
+    Returns: dict with the path of the list and the names that are missing
+             from the output or that should not be there
+    """
+    expected = set(read_list(reference))
+    found = set(lines)
+    return {"file": os.path.relpath(reference, DIR_PATH),
+            "missing": sorted(expected - found),
+            "extra": sorted(found - expected)}
+
+
+def run_scenario(dataset, scenario, argv, reference, backend, filelists,
+                 repeat):
+    """
+    Run a scenario 'repeat' times and keep the fastest run
+
+    Returns: dict describing the result
+    """
+    runs = [run_whatpkgs(argv, backend, filelists) for i in range(repeat)]
+    (elapsed, stats, lines) = min(runs, key=lambda run: run[0])
+
+    result = {
+        "dataset": dataset,
+        "scenario": scenario,
+        "wall_time": round(elapsed, 6),
+        "wall_times": [round(run[0], 6) for run in runs],
+        "peak_rss_kib": max(run[1]["peak_rss_kib"] for run in runs),
+        "phases": stats["phases"],
+        "counters": stats["counters"],
+        "filter_calls": sum(stats["filter_calls"].values()),
+        "lookups": sum(stats["lookups"].values()),
+        "requirement_cache": stats["requirement_cache"],
+        "packages": len(lines),
+        "reference": None,
+    }
+    if reference is not None:
+        # Every run must give the same answer, not only the fastest one
+        results = [compare_with_reference(run[2], reference) for run in runs]
+        result["reference"] = max(
+            results, key=lambda r: len(r["missing"]) + len(r["extra"]))
+    return result
+
+
+def is_correct(result):
+    reference = result.get("reference")
+    if "error" in result:
+        return False
+    return reference is None or not (reference["missing"] or
+                                     reference["extra"])
+
+
+def get_commit():
+    """
+    Get the commit of the tree being benchmarked, if it is a git checkout
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "-C", DIR_PATH, "describe", "--always", "--dirty"],
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def find_previous(history, run, result):
+    """
+    Find the result of the same scenario in the latest comparable run
+    """
+    for previous in reversed(history):
+        if (previous["backend"], previous["filelists"]) != \
+                (run["backend"], run["filelists"]):
+            continue
+        for old in previous["results"]:
+            if (old["dataset"], old["scenario"]) == \
+                    (result["dataset"], result["scenario"]) and \
+                    "error" not in old:
+                return old
+    return None
+
+
+def format_result(result, previous):
+    if "error" in result:
+        return "%-12s %-17s FAILED: %s" % (result["dataset"],
+                                           result["scenario"],
+                                           result["error"])
+
+    line = "%-12s %-17s %8.2fs %8.1f MiB %8d filters %8d lookups" % (
+        result["dataset"], result["scenario"], result["wall_time"],
+        result["peak_rss_kib"] / 1024.0, result["filter_calls"],
+        result["lookups"])
+    if previous is not None and previous["wall_time"]:
+        line += " (%+.0f%%)" % (
+            (result["wall_time"] / previous["wall_time"] - 1) * 100)
+
+    reference = result["reference"]
+    if reference is None:
+        return line
+    if is_correct(result):
+        return line + "  OK"
+    return line + "  MISMATCH: %d missing, %d extra from %s" % (
+        len(reference["missing"]), len(reference["extra"]),
+        reference["file"])
+
+
+@click.command()
+@click.option('--dataset', multiple=True,
+              type=click.Choice(sorted(DATASETS)),
+              help="Benchmark this repository set. This option may be "
+                   "specified multiple times. By default, all of the ones "
+                   "whose repodata is present are benchmarked.")
+@click.option('--scenario', multiple=True, type=click.Choice(SCENARIOS),
+              help="Run only this scenario. This option may be specified "
+                   "multiple times.")
+@click.option('--backend', default=whatpkgs.DEFAULT_BACKEND,
+              type=click.Choice(whatpkgs.BACKENDS),
+              help="Repository backend passed to whatpkgs.py. The default "
+                   "is the same as for whatpkgs.py.")
+@click.option('--filelists', default="primary",
+              type=click.Choice(sqliterepo.FILELISTS_MODES),
+              help="Filelists mode passed to whatpkgs.py. The committed "
+                   "lists were generated with 'primary', so the other "
+                   "modes are expected to report mismatches.")
+@click.option('--repeat', default=1, type=click.IntRange(1),
+              help="Run each scenario this many times and record the "
+                   "fastest run.")
+@click.option('--history', default="benchmark-history.json", metavar="PATH",
+              help="Append the results to the JSON history at PATH and "
+                   "compare them with the previous run that used the same "
+                   "backend.")
+def main(dataset, scenario, backend, filelists, repeat, history):
+    """
+    Time loading the repositories, getsourcerpm, neededby and
+    neededtoselfhost on the static sampledata, and check that their output
+    still matches the committed package lists.
+
+    Exits with status 1 if any scenario failed or its output changed.
+    """
+    if dataset:
+        datasets = dataset
+    else:
+        datasets = []
+        for name in sorted(DATASETS):
+            if has_repodata(name, backend):
+                datasets.append(name)
+            else:
+                print("Skipping %s: its repodata is not present" % name,
+                      file=sys.stderr)
+        if not datasets:
+            raise click.ClickException("No dataset has its repodata present")
+    scenarios = scenario or SCENARIOS
+
+    entries = load_history(history)
+    run = {"date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+           "commit": get_commit(),
+           "python": platform.python_version(),
+           "backend": backend,
+           "filelists": filelists,
+           "repeat": repeat,
+           "results": []}
+
+    for name in datasets:
+        for (scenario_name, argv, reference) in get_scenarios(name):
+            if scenario_name not in scenarios:
+                continue
+
+            try:
+                result = run_scenario(name, scenario_name, argv, reference,
+                                      backend, filelists, repeat)
+            except BenchmarkException as e:
+                result = {"dataset": name, "scenario": scenario_name,
+                          "error": str(e)}
+
+            run["results"].append(result)
+            print(format_result(result, find_previous(entries, run, result)))
+            sys.stdout.flush()
+
+            if "error" in result:
+                # The other scenarios of this dataset load the same
+                # repositories and would fail the same way
+                break
+
+    entries.append(run)
+    with open(history, "w") as f:
+        json.dump(entries, f, indent=4)
+        f.write("\n")
+
+    if not all(is_correct(result) for result in run["results"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
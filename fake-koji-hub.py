@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""
+Stand-in for a Koji hub answering getBuild, listBuildRPMs and multiCall
+over XML-RPC, to try koji-bootstrap.py --find-missing-builds and
+--rpm-cache without a real Koji instance.
+
+Only the builds listed in --builds-from-file exist. Every request is delayed
+by --latency and every call within it by --call-latency, and requests are
+served concurrently like a hub behind Apache would. The rpms of each build
+are the ones that fake-koji.py download-build writes with the same
+--rpms-per-build and --rpm-size.
+
+Example:
+./fake-koji-hub.py --builds-from-file existing.txt --latency 0.2 &
+./koji-bootstrap.py --koji-server http://localhost:8000/kojihub \\
+    --builds-from-file source-rpms-full.txt --find-missing-builds
+"""
+
+import hashlib
+import time
+import threading
+from optparse import OptionParser
+
+try:
+    from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+    from socketserver import ThreadingMixIn
+
+
+class AnyPathRequestHandler(SimpleXMLRPCRequestHandler):
+    # Answer on any path, such as /kojihub
+    rpc_paths = ()
+
+
+class ThreadingXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+def get_nvr(item):
+    """
+    Turn the [epoch:]name-version-release[.src] lines of the sampledata
+    lists into the name-version-release that builds are looked up by
+    """
+    nvr = item.split(":", 1)[-1]
+    if nvr.endswith(".src"):
+        nvr = nvr[:-len(".src")]
+    return nvr
+
+
+def get_payloadhash(filename, size):
+    # The payload written by fake-koji.py, which is all that the sigmd5
+    # covers since its rpms have an empty header
+    digest = hashlib.sha256(filename.encode("utf-8")).digest()
+    return hashlib.md5((digest * (size // len(digest) + 1))[:size]).hexdigest()
+
+
+class FakeHub(object):
+    def __init__(self, nvrs, latency, call_latency, rpms_per_build=3, rpm_size=65536):
+        self.builds = {}
+        for build_id, nvr in enumerate(sorted(nvrs), 1):
+            name, version, release = nvr.rsplit("-", 2)
+            self.builds[nvr] = {"build_id": build_id, "nvr": nvr,
+                                "name": name, "version": version,
+                                "release": release, "state": 1}
+        self.latency = latency
+        self.call_latency = call_latency
+        self.rpms_per_build = rpms_per_build
+        self.rpm_size = rpm_size
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.calls = 0
+
+    def _dispatch(self, method, params):
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+        return self._call(method, params)
+
+    def _call(self, method, params):
+        if method not in ("getBuild", "listBuildRPMs", "multiCall"):
+            raise Exception("Invalid method: %s" % method)
+
+        # koji passes keyword arguments as a trailing dict
+        kwargs = {}
+        if params and isinstance(params[-1], dict) and \
+                params[-1].get("__starstar"):
+            kwargs = dict(params[-1])
+            del kwargs["__starstar"]
+            params = params[:-1]
+        return getattr(self, method)(*params, **kwargs)
+
+    def getBuild(self, buildInfo, strict=False):
+        time.sleep(self.call_latency)
+        with self.lock:
+            self.calls += 1
+        build = self.builds.get(buildInfo)
+        if build is None and strict:
+            raise Exception("No such build: %s" % buildInfo)
+        return build
+
+    def listBuildRPMs(self, build):
+        time.sleep(self.call_latency)
+        with self.lock:
+            self.calls += 1
+        info = self.builds.get(build)
+        if info is None:
+            raise Exception("No such build: %s" % build)
+
+        rpms = []
+        names = [info["name"]] + ["%s-sub%s" % (info["name"], i) for i in range(1, self.rpms_per_build)]
+        for name in names:
+            filename = "%s-%s-%s.x86_64.rpm" % (name, info["version"], info["release"])
+            rpms.append({"name": name, "version": info["version"],
+                         "release": info["release"], "arch": "x86_64",
+                         "build_id": info["build_id"],
+                         "size": 96 + 16 + self.rpm_size,
+                         "payloadhash": get_payloadhash(filename, self.rpm_size)})
+        return rpms
+
+    def multiCall(self, calls):
+        results = []
+        for call in calls:
+            try:
+                results.append([self._call(call["methodName"],
+                                           call["params"])])
+            except Exception as ex:
+                results.append({"faultCode": 1000, "faultString": str(ex)})
+        return results
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("--builds-from-file",
+        help="Builds that exist on this hub, one per line")
+    parser.add_option("--host", default="localhost")
+    parser.add_option("--port", default=8000, type=int)
+    parser.add_option("--latency", default=0.1, type=float,
+        help="Seconds added to every request (default is 0.1)")
+    parser.add_option("--call-latency", default=0.001, type=float,
+        help="Seconds added to every call of a multicall (default is 0.001)")
+    parser.add_option("--rpms-per-build", default=3, type=int,
+        help="Same as FAKE_KOJI_RPMS of fake-koji.py (default is 3)")
+    parser.add_option("--rpm-size", default=65536, type=int,
+        help="Same as FAKE_KOJI_RPM_SIZE of fake-koji.py (default is 65536)")
+    opts, args = parser.parse_args()
+
+    if not opts.builds_from_file:
+        parser.error("--builds-from-file is required to know which builds exist")
+
+    with open(opts.builds_from_file) as fd:
+        nvrs = set(get_nvr(line.strip()) for line in fd if line.strip())
+
+    hub = FakeHub(nvrs, opts.latency, opts.call_latency, opts.rpms_per_build, opts.rpm_size)
+    server = ThreadingXMLRPCServer((opts.host, opts.port),
+                                   requestHandler=AnyPathRequestHandler,
+                                   allow_none=True, logRequests=False)
+    server.register_instance(hub)
+    print("Serving %s builds on http://%s:%s/kojihub" % (len(hub.builds), opts.host, opts.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("Served %s requests for %s calls" % (hub.requests, hub.calls))
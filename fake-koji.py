@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+Stand-in for the koji command line client, to try koji-bootstrap.py
+--import-builds without a real Koji instance:
+
+./koji-bootstrap.py --koji-command ./fake-koji.py --builds-from-file \\
+    source-rpms-full.txt --import-builds --import-dest-tag tag --import-owner me
+
+Only the download-build, import, add-pkg and tag-build commands are
+supported. download-build writes FAKE_KOJI_RPMS (default 3) rpms with a
+payload of FAKE_KOJI_RPM_SIZE bytes (default 65536) for the build, or only
+the rpm given with --rpm. Their content only depends on their file name,
+the same way as in fake-koji-hub.py, so that their sigmd5 matches what its
+listBuildRPMs returns. import and tag-build record what they did as files
+in FAKE_KOJI_STATE (default /tmp/fake-koji), and every command is logged
+to its commands.log. Importing the same rpm twice is an error, as is
+tagging a build that was not imported. Every command takes
+FAKE_KOJI_LATENCY seconds (default 0.1) and fails with a probability of
+FAKE_KOJI_FAILURES (default 0).
+"""
+
+import hashlib
+import os
+import random
+import struct
+import sys
+import time
+
+
+def fail(message):
+    sys.stderr.write("%s\n" % message)
+    sys.exit(1)
+
+
+def state_path(kind, name):
+    path = os.path.join(os.environ.get("FAKE_KOJI_STATE", "/tmp/fake-koji"), kind)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Created by another command in the meantime
+            pass
+    return os.path.join(path, name)
+
+
+def create(path):
+    # O_EXCL makes this atomic between concurrent commands
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except OSError:
+        return False
+
+
+def write_rpm(filename):
+    # A lead, an empty signature header and the payload
+    digest = hashlib.sha256(filename.encode("utf-8")).digest()
+    size = int(os.environ.get("FAKE_KOJI_RPM_SIZE", 65536))
+    with open(filename, "wb") as fd:
+        fd.write(b"\xed\xab\xee\xdb" + b"\0" * 92)
+        fd.write(b"\x8e\xad\xe8\x01" + b"\0" * 4 + struct.pack(">II", 0, 0))
+        fd.write((digest * (size // len(digest) + 1))[:size])
+
+
+def download_build(nvr, rpm=False):
+    if rpm:
+        write_rpm("%s.rpm" % nvr)
+        return
+
+    name, version, release = nvr.rsplit("-", 2)
+    subpackages = [name] + ["%s-sub%s" % (name, i) for i in range(1, int(os.environ.get("FAKE_KOJI_RPMS", 3)))]
+    for subpackage in subpackages:
+        write_rpm("%s-%s-%s.x86_64.rpm" % (subpackage, version, release))
+
+
+def import_rpm(rpm):
+    if not os.path.exists(rpm):
+        fail("No such file: %s" % rpm)
+    if not create(state_path("rpms", os.path.basename(rpm))):
+        fail("RPM already imported: %s" % os.path.basename(rpm))
+
+
+def tag_build(tag, nvr):
+    name, version, release = nvr.rsplit("-", 2)
+    if not os.path.exists(state_path("rpms", "%s-%s-%s.x86_64.rpm" % (name, version, release))):
+        fail("No such build: %s" % nvr)
+    if not create(state_path("tagged", "%s@%s" % (nvr, tag))):
+        fail("%s is already tagged into %s" % (nvr, tag))
+
+
+def main(argv):
+    # Skip the global options
+    while argv and argv[0].startswith("--"):
+        argv = argv[2:] if argv[0] == "--profile" else argv[1:]
+    if not argv:
+        fail("No command given")
+    with open(state_path(".", "commands.log"), "a") as fd:
+        fd.write(" ".join(argv) + "\n")
+
+    time.sleep(float(os.environ.get("FAKE_KOJI_LATENCY", 0.1)))
+    if random.random() < float(os.environ.get("FAKE_KOJI_FAILURES", 0)):
+        fail("Simulated failure of %s" % argv[0])
+
+    command = argv[0]
+    args = [arg for arg in argv[1:] if not arg.startswith("--")]
+    if command == "download-build":
+        download_build(args[0], "--rpm" in argv)
+    elif command == "import":
+        # The value of --src-epoch is the only option argument left
+        import_rpm(args[-1])
+    elif command == "add-pkg":
+        # --owner takes the first argument
+        pass
+    elif command == "tag-build":
+        tag_build(args[0], args[1])
+    else:
+        fail("Unsupported command: %s" % command)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
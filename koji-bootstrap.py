@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import json
+import time
+import threading
 import shutil
 import glob
+import hashlib
+import itertools
+import struct
 import kobo.rpmlib
 import kobo.shortcuts
 import koji
@@ -15,47 +22,444 @@ logging.basicConfig()
 logger=logging.getLogger("koji-bootstrap")
 logger.setLevel(logging.DEBUG)
 
-class ImportThread(WorkerThread):
+class StageThread(WorkerThread):
+    """
+    Worker of one stage of the import pipeline
+    """
+    def __init__(self, pool, importer, stage):
+        WorkerThread.__init__(self, pool)
+        self.importer = importer
+        self.stage = stage
+
     def process(self, item, num):
-        nvr, epoch, total, opts = item
-        self.pool.log_info("Downloading %s (%s/%s)" % (nvr, num, total))
-        n_retries = 1
-        while n_retries <= 3:
+        self.importer.process(self.stage, item)
+
+class ImportJournal(object):
+    """
+    Append-only record of the progress of --import-builds, one JSON object
+    per line, so that an interrupted import resumes where it stopped. Each
+    build goes through the downloaded, imported and tagged states, and every
+    imported rpm is recorded too so that a build interrupted halfway is not
+    imported twice.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.state = {}
+        self.imported_rpms = set()
+        if os.path.exists(path):
+            with open(path) as fd:
+                for line in fd:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may have been cut short
+                        continue
+                    if "rpm" in entry:
+                        self.imported_rpms.add(entry["rpm"])
+                    elif entry["state"] != "failed":
+                        self.state[entry["nvr"]] = entry["state"]
+        self.fd = open(path, "a")
+
+    def record(self, nvr, state, rpm=None):
+        entry = {"nvr": nvr, "state": state}
+        if rpm:
+            entry["rpm"] = rpm
+        with self.lock:
+            self.fd.write(json.dumps(entry) + "\n")
+            self.fd.flush()
+            os.fsync(self.fd.fileno())
+            if rpm:
+                self.imported_rpms.add(rpm)
+            elif state != "failed":
+                # A failure is only logged, the build resumes from its last
+                # completed step on the next run
+                self.state[nvr] = state
+
+    def close(self):
+        self.fd.close()
+
+class StageStats(object):
+    """
+    Throughput of one stage of the import pipeline
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.builds = 0
+        self.failed = 0
+        self.rpms = 0
+        self.size = 0
+        self.busy = 0.0
+        self.start = None
+        self.end = None
+
+    def add(self, started, ok=True, rpms=0, size=0):
+        with self.lock:
+            if ok:
+                self.builds += 1
+            else:
+                self.failed += 1
+            self.rpms += rpms
+            self.size += size
+            self.busy += time.time() - started
+            if self.start is None or started < self.start:
+                self.start = started
+            self.end = time.time()
+
+    def report(self):
+        elapsed = max((self.end or 0) - (self.start or 0), 1e-6)
+        line = "%s: %s builds in %.1f seconds (%.2f builds/s" % (self.stage, self.builds, elapsed, self.builds / elapsed)
+        if self.rpms:
+            line += ", %s rpms" % self.rpms
+        if self.size:
+            line += ", %.1f MiB/s" % (self.size / 1048576.0 / elapsed)
+        line += ", %.1f threads busy on average)" % (self.busy / elapsed)
+        if self.failed:
+            line += ", %s failed" % self.failed
+        return line
+
+def get_rpm_sigmd5(path):
+    """
+    Compute the MD5 digest of the header and payload of an rpm, which Koji
+    records as its payloadhash. They follow the 96 bytes lead and the
+    signature header, padded to 8 bytes.
+    """
+    with open(path, "rb") as fd:
+        fd.seek(96)
+        intro = fd.read(16)
+        if len(intro) != 16 or intro[:3] != b"\x8e\xad\xe8":
+            raise RuntimeError("%s is not an rpm" % path)
+        count, size = struct.unpack(">II", intro[8:16])
+        length = 16 * count + size
+        fd.seek(96 + 16 + length + (-length % 8))
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: fd.read(1048576), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Not on the same filesystem
+        shutil.copy2(src, dst + ".tmp")
+        os.rename(dst + ".tmp", dst)
+
+class RpmCache(object):
+    """
+    Downloaded rpms stored under their sigmd5, so that retries and later
+    runs link them into the workdir instead of downloading them again. The
+    least recently used rpms are removed once the cache grows beyond
+    max_size bytes.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # sigmd5 -> [size, last use]
+        self.entries = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                if name.endswith(".tmp"):
+                    continue
+                st = os.stat(os.path.join(dirpath, name))
+                self.entries[name] = [st.st_size, st.st_mtime]
+                self.size += st.st_size
+
+    def get_path(self, sigmd5):
+        return os.path.join(self.path, sigmd5[:2], sigmd5)
+
+    def link(self, sigmd5, size, dst):
+        """
+        Link the rpm with the given sigmd5 and size to dst if it is in the
+        cache, returning whether it was
+        """
+        with self.lock:
+            entry = self.entries.get(sigmd5)
+            if entry is None or entry[0] != size:
+                self.misses += 1
+                return False
+            entry[1] = time.time()
+
+        try:
+            # The modification time keeps track of the last use across runs
+            os.utime(self.get_path(sigmd5), None)
+            link_or_copy(self.get_path(sigmd5), dst)
+        except OSError:
+            # Removed behind our back
+            with self.lock:
+                self.entries.pop(sigmd5, None)
+                self.misses += 1
+            return False
+
+        with self.lock:
+            self.hits += 1
+            self.reused += size
+        return True
+
+    def add(self, path, sigmd5):
+        """
+        Verify that the downloaded rpm at path has the given sigmd5 and store
+        it in the cache
+        """
+        actual = get_rpm_sigmd5(path)
+        if actual != sigmd5:
+            raise RuntimeError("%s has sigmd5 %s instead of %s" % (path, actual, sigmd5))
+
+        cached = self.get_path(sigmd5)
+        if not os.path.isdir(os.path.dirname(cached)):
             try:
-                self.import_build(nvr, epoch, opts)
-                if opts.import_dest_tag:
-                    self.tag_build(nvr, opts)
+                os.makedirs(os.path.dirname(cached))
+            except OSError:
+                # Created by another thread in the meantime
+                pass
+        with self.lock:
+            if sigmd5 in self.entries:
+                return
+            link_or_copy(path, cached)
+            size = os.path.getsize(cached)
+            self.entries[sigmd5] = [size, time.time()]
+            self.size += size
+            self.evict()
+
+    def evict(self):
+        if self.size <= self.max_size:
+            return
+        for sigmd5, entry in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if self.size <= self.max_size:
                 break
-            except RuntimeError:
-                self.pool.log_error("Retrying import#%d of %s" % (n_retries, nvr))
+            try:
+                os.unlink(self.get_path(sigmd5))
+            except OSError:
+                pass
+            self.size -= entry[0]
+            del self.entries[sigmd5]
+
+    def report(self):
+        return "rpm cache: %s hits, %s misses, %.1f MiB reused, %.1f MiB in %s" % (
+            self.hits, self.misses, self.reused / 1048576.0, self.size / 1048576.0, self.path)
+
+class Importer(object):
+    """
+    Pipeline importing builds from one Koji instance to another. Builds are
+    downloaded, imported and tagged by separate pools of threads, and at most
+    --import-buffer downloaded builds wait on disk for their import.
+    """
+    def __init__(self, opts, journal):
+        self.opts = opts
+        self.journal = journal
+        self.stages = ["download", "import"]
+        if opts.import_dest_tag:
+            self.stages.append("tag")
+        self.stats = dict((stage, StageStats(stage)) for stage in self.stages)
+        self.slots = threading.Semaphore(opts.import_buffer)
+        self.total = 0
+        self.counter = itertools.count(1)
+        self.cache = None
+        if opts.rpm_cache:
+            self.cache = RpmCache(opts.rpm_cache, opts.rpm_cache_size * 1048576)
+        # Koji sessions of the download threads
+        self.local = threading.local()
+
+        threads = {"download": opts.download_threads, "import": opts.import_threads, "tag": opts.tag_threads}
+        self.pools = {}
+        for stage in self.stages:
+            pool = ThreadPool(logger=logger)
+            for x in range(threads[stage]):
+                pool.add(StageThread(pool, self, stage))
+            self.pools[stage] = pool
+
+    def get_workdir(self, nvr):
+        return os.path.join(self.opts.workdir, nvr) # store it under $workdir/$build
+
+    def run(self, builds):
+        """
+        Import the (nvr, epoch) builds, skipping the steps that the journal
+        says are already done
+        """
+        done = "tagged" if "tag" in self.stages else "imported"
+        queues = dict((stage, []) for stage in self.stages)
+        skipped = 0
+        for item in builds:
+            state = self.journal.state.get(item[0])
+            if state == done or state == "tagged":
+                skipped += 1
+            elif state == "imported":
+                queues["tag"].append(item)
+            elif state == "downloaded" and os.path.isdir(self.get_workdir(item[0])):
+                queues["import"].append(item)
+            else:
+                queues["download"].append(item)
+        if skipped:
+            logger.info("Skipping %s builds already done according to the journal" % skipped)
+
+        self.total = len(queues["download"])
+        for stage in self.stages:
+            self.pools[stage].start()
+        for stage in reversed(self.stages):
+            for item in queues[stage]:
+                if stage == "import":
+                    # Already downloaded, so it takes a slot right away
+                    self.slots.acquire()
+                self.pools[stage].queue.put(item)
+
+        # Each stage only feeds the next one, so they can be drained in order
+        for stage in self.stages:
+            self.pools[stage].stop()
+
+        for stage in self.stages:
+            if self.stats[stage].start is not None:
+                logger.info(self.stats[stage].report())
+        if self.cache:
+            logger.info(self.cache.report())
+        return sum(self.stats[stage].failed for stage in self.stages)
+
+    def process(self, stage, item):
+        nvr, epoch = item
+        started = time.time()
+        if stage == "download":
+            self.slots.acquire()
+            logger.info("Downloading %s (%s/%s)" % (nvr, next(self.counter), self.total))
+            downloaded = []
+            ok = self.attempt(stage, nvr, self.download_build, nvr, downloaded)
+            if ok:
+                rpms = glob.glob("%s/*" % self.get_workdir(nvr))
+                self.stats[stage].add(started, rpms=len(rpms), size=sum(os.path.getsize(rpm) for rpm in downloaded))
+                self.journal.record(nvr, "downloaded")
+                self.pools["import"].queue.put(item)
+            else:
+                self.stats[stage].add(started, ok=False)
+                self.remove_workdir(nvr)
+
+        elif stage == "import":
+            rpms = []
+            ok = self.attempt(stage, nvr, self.import_build, nvr, epoch, rpms)
+            self.stats[stage].add(started, ok, rpms=len(rpms))
+            self.remove_workdir(nvr)
+            if ok:
+                self.journal.record(nvr, "imported")
+                if "tag" in self.stages:
+                    self.pools["tag"].queue.put(item)
+
+        elif stage == "tag":
+            ok = self.attempt(stage, nvr, self.tag_build, nvr)
+            self.stats[stage].add(started, ok)
+            if ok:
+                self.journal.record(nvr, "tagged")
+
+    def attempt(self, stage, nvr, func, *args):
+        """
+        Call func up to three times, returning whether it succeeded
+        """
+        n_retries = 1
+        while True:
+            try:
+                func(*args)
+                return True
+            except Exception as ex:
+                if n_retries >= 3:
+                    logger.error("Giving up %s of %s: %s" % (stage, nvr, ex))
+                    self.journal.record(nvr, "failed")
+                    return False
+                logger.error("Retrying %s#%d of %s" % (stage, n_retries, nvr))
+            n_retries += 1
+
+    def koji(self, profile, args, workdir=None):
+        return kobo.shortcuts.run("%s --profile '%s' %s" % (self.opts.koji_command, profile, args), workdir=workdir)
+
+    def list_rpms(self, nvr):
+        """
+        Get the rpms of a build that download-build fetches, with their
+        payloadhash (sigmd5) and size
+        """
+        if getattr(self.local, "koji_session", None) is None:
+            self.local.koji_session = get_koji_session(self.opts)
+        return [rpm for rpm in self.local.koji_session.listBuildRPMs(nvr) if not koji.is_debuginfo(rpm["name"])]
+
+    def download_build(self, nvr, downloaded):
+        workdir = self.get_workdir(nvr)
+        shutil.rmtree(workdir, ignore_errors=True)
+        os.makedirs(workdir)
+        del downloaded[:]
+
+        rpms = []
+        if self.cache:
+            rpms = self.list_rpms(nvr)
+        if not rpms:
+            self.koji(self.opts.koji_profile, "download-build %s" % nvr, workdir=workdir)
+            downloaded.extend(glob.glob("%s/*" % workdir))
+            return
+
+        missing = []
+        for rpm in rpms:
+            filename = "%(name)s-%(version)s-%(release)s.%(arch)s.rpm" % rpm
+            if not self.cache.link(rpm["payloadhash"], rpm["size"], os.path.join(workdir, filename)):
+                missing.append((filename, rpm))
+
+        if len(missing) == len(rpms):
+            self.koji(self.opts.koji_profile, "download-build %s" % nvr, workdir=workdir)
+        else:
+            for filename, rpm in missing:
+                logger.debug("Downloading rpm %s" % filename)
+                self.koji(self.opts.koji_profile, "download-build --rpm %s" % filename[:-len(".rpm")], workdir=workdir)
+
+        for filename, rpm in missing:
+            path = os.path.join(workdir, filename)
+            self.cache.add(path, rpm["payloadhash"])
+            downloaded.append(path)
+
+    def import_build(self, nvr, epoch, imported):
+        for rpm in sorted(glob.glob("%s/*" % self.get_workdir(nvr))):
+            if os.path.basename(rpm) in self.journal.imported_rpms:
                 continue
-            finally:
-                n_retries =+ 1
+            logger.debug("Importing rpm %s" % rpm)
+            self.koji(self.opts.koji_dest_profile, "import --create-build --src-epoch '%s' %s" % (epoch, rpm))
+            self.journal.record(nvr, "imported", rpm=os.path.basename(rpm))
+            imported.append(rpm)
 
-    def tag_build(self, nvr, opts):
+    def tag_build(self, nvr):
         # XXX: use clientsession :-)
+        opts = self.opts
         pkg_name = kobo.rpmlib.parse_nvr(nvr)['name']
-        self.pool.log_debug("Whitelisting %s into %s" % (pkg_name, opts.import_dest_tag))
+        logger.debug("Whitelisting %s into %s" % (pkg_name, opts.import_dest_tag))
         try:
-            ret, out = kobo.shortcuts.run("koji --profile '%s' add-pkg --owner %s %s %s" % (opts.koji_dest_profile, opts.import_owner, opts.import_dest_tag, pkg_name))
+            self.koji(opts.koji_dest_profile, "add-pkg --owner %s %s %s" % (opts.import_owner, opts.import_dest_tag, pkg_name))
         except RuntimeError:
             pass
 
-        self.pool.log_debug("Tagging %s into %s" % (nvr, opts.import_dest_tag))
-        ret, out = kobo.shortcuts.run("koji --profile '%s' tag-build --nowait %s %s" % (opts.koji_dest_profile, opts.import_dest_tag, nvr))
+        logger.debug("Tagging %s into %s" % (nvr, opts.import_dest_tag))
+        self.koji(opts.koji_dest_profile, "tag-build --nowait %s %s" % (opts.import_dest_tag, nvr))
 
-    def import_build(self, nvr, epoch, opts):
-        workdir = os.path.join(opts.workdir, nvr) # store it under $workdir/$build
-        shutil.rmtree(workdir, ignore_errors=True)
-        os.makedirs(workdir)
-        ret, out = kobo.shortcuts.run("koji --profile '%s' download-build %s" % (opts.koji_profile, nvr), workdir=workdir)
+    def remove_workdir(self, nvr):
+        logger.debug("Removing workdir %s" % self.get_workdir(nvr))
+        shutil.rmtree(self.get_workdir(nvr), ignore_errors=True)
+        self.slots.release()
 
-        for rpm in glob.glob("%s/*" % workdir):
-            self.pool.log_debug("Importing rpm %s" % rpm)
-            ret, out = kobo.shortcuts.run("koji --profile '%s' import --create-build --src-epoch '%s' %s" % (opts.koji_dest_profile, epoch, rpm))
+class LookupThread(WorkerThread):
+    """
+    Look up batches of builds, each in a single multicall round trip. Every
+    thread uses its own session since they cannot be shared.
+    """
+    koji_session = None
 
-        self.pool.log_debug("Removing workdir %s" % workdir)
-        shutil.rmtree(workdir, ignore_errors=True)
+    def process(self, item, num):
+        index, nvrs, total, opts, results = item
+        if self.koji_session is None:
+            self.koji_session = get_koji_session(opts)
+
+        self.pool.log_debug("Looking up batch %s/%s (%s builds)" % (index + 1, total, len(nvrs)))
+        n_retries = 1
+        while n_retries <= 3:
+            try:
+                results[index] = lookup_builds(self.koji_session, nvrs)
+                break
+            except Exception as ex:
+                self.pool.log_error("Retrying lookup#%d of batch %s: %s" % (n_retries, index + 1, ex))
+            n_retries += 1
 
 def get_koji_session(options):
     koji_config = munch.Munch(koji.read_config(
@@ -66,9 +470,19 @@ def get_koji_session(options):
     #    config=koji_config,
     #    )
 
-    address = koji_config.server
+    address = options.koji_server or koji_config.server
     return koji.ClientSession(address, opts=koji_config)
 
+def lookup_builds(koji_session, nvrs):
+    """
+    Call getBuild for every nvr in one multicall. Returns one entry per nvr,
+    in the same order: [build_info] or a fault dict.
+    """
+    koji_session.multicall = True
+    for nvr in nvrs:
+        koji_session.getBuild(nvr)
+    return koji_session.multiCall(strict=False)
+
 def get_nevra(data):
     nevra = kobo.rpmlib.parse_nvra(data)
     if nevra['arch'] != 'src':
@@ -90,15 +504,45 @@ def handle_pretty_print_nvrs(opts):
 
 def handle_missing_builds(opts):
     nvrs = get_nvrs(opts.builds_from_file)
-    koji_session = get_koji_session(opts)
+    size = opts.lookup_batch_size
+    batches = [nvrs[i:i + size] for i in range(0, len(nvrs), size)]
+
+    # Batches may complete in any order, results are kept by batch index
+    results = {}
+    threads = min(opts.lookup_threads, len(batches))
+    pool = ThreadPool(logger=logger)
+    for x in range(threads):
+        pool.add(LookupThread(pool))
+
+    start = time.time()
+    pool.start()
+    for index, batch in enumerate(batches):
+        pool.queue.put((index, batch, len(batches), opts, results))
+    pool.stop()
+    elapsed = time.time() - start
 
-    for item in nvrs:
-        build_info = koji_session.getBuild(item)
-        if not build_info:
-            print(item)
+    failed = 0
+    for index, batch in enumerate(batches):
+        if index not in results:
+            logger.error("Unable to look up %s builds of batch %s" % (len(batch), index + 1))
+            failed += len(batch)
+            continue
+
+        for item, reply in zip(batch, results[index]):
+            if isinstance(reply, dict):
+                logger.error("Unable to look up %s: %s" % (item, reply.get("faultString")))
+                failed += 1
+            elif not reply[0]:
+                print(item)
+
+    logger.info("Looked up %s builds in %.2f seconds (%.1f builds/s, %s batches of up to %s, %s threads)"
+        % (len(nvrs), elapsed, len(nvrs) / max(elapsed, 1e-6), len(batches), size, threads))
+    if failed:
+        sys.exit(1)
 
 def handle_import_builds(opts):
-    nevrs = set()
+    builds = []
+    seen = set()
     fd = open(opts.builds_from_file, "r")
 
     # additional implementation due extra need for epoch
@@ -106,16 +550,19 @@ def handle_import_builds(opts):
         item = item.strip()
         nevra = get_nevra(item)
         nvr = kobo.rpmlib.make_nvr(nevra)
-        nevrs.add((nvr, nevra['epoch']))
-
-    pool = ThreadPool(logger=logger)
-    for x in xrange(opts.import_threads):
-        pool.add(ImportThread(pool))
+        if nvr not in seen:
+            seen.add(nvr)
+            builds.append((nvr, nevra['epoch']))
 
-    pool.start()
-    for item in nevrs:
-        pool.queue.put((item[0], item[1], len(nevrs), opts))
-    pool.stop()
+    if not os.path.isdir(opts.workdir):
+        os.makedirs(opts.workdir)
+    journal = ImportJournal(opts.import_journal or os.path.join(opts.workdir, "import-journal"))
+    try:
+        failed = Importer(opts, journal).run(builds)
+    finally:
+        journal.close()
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     parser = OptionParser()
@@ -126,15 +573,35 @@ if __name__ == "__main__":
         action="store_const", const="print", dest="action")
     parser.add_option("--import-builds", help="Import builds",
         action="store_const", const="import", dest="action")
+    parser.add_option("--download-threads",
+        help="Download threads (default is 4)", default=4, type=int)
     parser.add_option("--import-threads",
-        help="Import threads (default is 4)", default=6, type=int)
+        help="Import threads (default is 6)", default=6, type=int)
+    parser.add_option("--tag-threads",
+        help="Tag threads (default is 2)", default=2, type=int)
+    parser.add_option("--import-buffer",
+        help="Downloaded builds allowed to wait for their import (default is 8)", default=8, type=int)
+    parser.add_option("--rpm-cache",
+        help="Keep downloaded rpms in DIR and reuse them instead of downloading them again", metavar="DIR")
+    parser.add_option("--rpm-cache-size",
+        help="Size of --rpm-cache in MiB, beyond which the least recently used rpms are removed (default is 20480)",
+        default=20480, type=int)
+    parser.add_option("--import-journal",
+        help="Progress of --import-builds, to resume it if interrupted (default is WORKDIR/import-journal)", metavar="FILE")
     parser.add_option("--import-dest-tag",
         help="Tag build after import. Requires manual whitelist ...", metavar="TAG")
     parser.add_option("--import-owner",
         help="Owner for koji add-pkg", metavar="USER")
 
+    parser.add_option("--lookup-batch-size",
+        help="Builds looked up per multicall by --find-missing-builds (default is 200)", default=200, type=int)
+    parser.add_option("--lookup-threads",
+        help="Multicalls in flight at once for --find-missing-builds (default is 4)", default=4, type=int)
+
     parser.add_option("--koji-profile", default="koji")
+    parser.add_option("--koji-server", help="Hub URL overriding the one of --koji-profile", metavar="URL")
     parser.add_option("--koji-dest-profile", default="koji", help="profile of Koji import-target")
+    parser.add_option("--koji-command", default="koji", help="Koji client to run for --import-builds")
     parser.add_option("--workdir", help="This is required for import of builds", default="/tmp/import")
     parser.add_option("--debug", action="store_true", help="Print debug info such as individual rpm imports")
     opts, args = parser.parse_args()
@@ -146,6 +613,10 @@ if __name__ == "__main__":
         parser.error("At least one of --import-builds --print-builds --find-missing-builds is needed")
     if opts.import_dest_tag and not opts.import_owner:
         parser.error("You need to specify --import-owner with --import-dest-tag")
+    if opts.lookup_batch_size < 1 or opts.lookup_threads < 1:
+        parser.error("--lookup-batch-size and --lookup-threads must be at least 1")
+    if min(opts.download_threads, opts.import_threads, opts.tag_threads, opts.import_buffer) < 1:
+        parser.error("--download-threads, --import-threads, --tag-threads and --import-buffer must be at least 1")
 
     logger.setLevel(logging.INFO)
     if opts.debug:
@@ -0,0 +1,582 @@
+#!/usr/bin/python3
+
+"""
+Compact on-disk format for a resolved dependency graph, as written by
+"whatpkgs.py exportgraph", and a loader that memory-maps it.
+
+Neither this module nor its commands need dnf or the repodata, so the graph
+can be queried on any machine.
+
+The file is little-endian and made of 8-byte aligned sections:
+
+  header:     b"WPKGRAPH", format version and number of sections (u32 each)
+  directory:  per section, a 32-byte NUL-padded name, its offset and its
+              length in bytes (u64 each)
+
+The sections are:
+
+  meta:                   JSON object describing how the graph was resolved
+  strings, string_offsets: every string once, as UTF-8, and the u32 offset of
+                          each of them, plus the end of the last one
+  packages:               per package, the u32 string ids of its name,
+                          version, release, arch and repo, its epoch and its
+                          flags (PACKAGE_FIELDS)
+  <kind>_offsets,
+  <kind>_targets,
+  <kind>_requires:        per edge kind, the adjacency of every package in CSR
+                          form: the edges of package i are the entries
+                          offsets[i] to offsets[i + 1] of the target package
+                          ids and of the string ids of the requirements
+  ambiguity_*:            the requirements that could not be resolved to one
+                          package, in the same CSR form over their candidates
+"""
+
+import array
+import collections
+import json
+import mmap
+import struct
+import sys
+import click
+
+MAGIC = b"WPKGRAPH"
+FORMAT_VERSION = 1
+
+# Edge kinds, in the order they are stored
+EDGE_KINDS = ("requires", "requires_pre", "recommends", "buildrequires",
+              "source")
+
+# Edge kinds followed for the runtime dependencies of a package
+RUNTIME_KINDS = ("requires", "requires_pre", "recommends")
+
+# Fields of a record of the package table, all of them u32
+PACKAGE_FIELDS = ("name", "version", "release", "arch", "repo", "epoch",
+                  "flags")
+
+# Package flags
+FLAG_SOURCE = 1
+# The requirements of the package were resolved. Packages that only appear
+# as candidates of an ambiguity have no edges.
+FLAG_EXPANDED = 2
+
+# String id of the requirement of an edge that has none (the "source" kind)
+NO_STRING = 0xffffffff
+
+_HEADER = struct.Struct("<8sII")
+_DIRECTORY_ENTRY = struct.Struct("<32sQQ")
+
+Package = collections.namedtuple(
+    "Package", ("id", "name", "epoch", "version", "release", "arch", "repo",
+                "is_source", "expanded"))
+
+
+class GraphFormatException(Exception):
+    """
+    Raised when a file is not a dependency graph this module can read
+    """
+    def __init__(self, path, reason):
+        self.path = path
+        self.reason = reason
+
+    def __str__(self):
+        return "%s is not a usable dependency graph: %s" % (self.path,
+                                                            self.reason)
+
+
+class GraphWriter(object):
+    """
+    Collect a dependency graph and write it out in the compact format.
+
+    Packages are added with add_package(), which returns their id, and edges
+    with add_edge() in any order.
+    """
+    def __init__(self, meta=None):
+        self.meta = meta or {}
+        self._strings = {}
+        self._packages = []
+        self._edges = dict((kind, []) for kind in EDGE_KINDS)
+        self._ambiguities = []
+
+    def __len__(self):
+        return len(self._packages)
+
+    def intern(self, string):
+        """
+        Get the string id of a string, adding it to the string table
+        """
+        if string is None:
+            return NO_STRING
+        try:
+            return self._strings[string]
+        except KeyError:
+            sid = len(self._strings)
+            self._strings[string] = sid
+            return sid
+
+    def add_package(self, name, epoch, version, release, arch, repo,
+                    is_source=False):
+        """
+        Add a package to the package table
+
+        Returns: the id of the package
+        """
+        flags = FLAG_SOURCE if is_source else 0
+        self._packages.append([self.intern(name), self.intern(version),
+                               self.intern(release), self.intern(arch),
+                               self.intern(repo), epoch, flags])
+        for edges in self._edges.values():
+            edges.append([])
+        return len(self._packages) - 1
+
+    def set_expanded(self, node):
+        """
+        Record that the requirements of a package were resolved
+        """
+        self._packages[node][PACKAGE_FIELDS.index("flags")] |= FLAG_EXPANDED
+
+    def add_edge(self, kind, node, target, requirement=None):
+        """
+        Record that package node depends on package target through a
+        requirement of the given kind
+        """
+        self._edges[kind][node].append((target, self.intern(requirement)))
+
+    def add_ambiguity(self, node, requirement, candidates):
+        """
+        Record that a requirement of package node could be satisfied by
+        any of the candidate package ids
+        """
+        self._ambiguities.append((node, self.intern(requirement),
+                                  sorted(candidates)))
+
+    def _sections(self):
+        strings = list(self._strings)
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = array.array("I", [0])
+        for data in encoded:
+            offsets.append(offsets[-1] + len(data))
+
+        yield ("meta", json.dumps(self.meta, sort_keys=True).encode("utf-8"))
+        yield ("strings", b"".join(encoded))
+        yield ("string_offsets", offsets)
+        yield ("packages", array.array(
+            "I", (field for record in self._packages for field in record)))
+
+        for kind in EDGE_KINDS:
+            offsets = array.array("I", [0])
+            targets = array.array("I")
+            requires = array.array("I")
+            for edges in self._edges[kind]:
+                for (target, requirement) in edges:
+                    targets.append(target)
+                    requires.append(requirement)
+                offsets.append(len(targets))
+            yield ("%s_offsets" % kind, offsets)
+            yield ("%s_targets" % kind, targets)
+            yield ("%s_requires" % kind, requires)
+
+        offsets = array.array("I", [0])
+        nodes = array.array("I")
+        requires = array.array("I")
+        candidates = array.array("I")
+        for (node, requirement, members) in self._ambiguities:
+            nodes.append(node)
+            requires.append(requirement)
+            candidates.extend(members)
+            offsets.append(len(candidates))
+        yield ("ambiguity_offsets", offsets)
+        yield ("ambiguity_nodes", nodes)
+        yield ("ambiguity_requires", requires)
+        yield ("ambiguity_candidates", candidates)
+
+    def write(self, path):
+        """
+        Write the graph to the file at path
+        """
+        sections = []
+        for (name, data) in self._sections():
+            if isinstance(data, array.array):
+                if sys.byteorder != "little":
+                    data = array.array(data.typecode, data)
+                    data.byteswap()
+                data = data.tobytes()
+            sections.append((name, data))
+
+        offset = _HEADER.size + _DIRECTORY_ENTRY.size * len(sections)
+        directory = []
+        for (name, data) in sections:
+            offset += -offset % 8
+            directory.append((name, offset, len(data)))
+            offset += len(data)
+
+        with open(path, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(sections)))
+            for (name, offset, length) in directory:
+                f.write(_DIRECTORY_ENTRY.pack(name.encode("ascii"), offset,
+                                              length))
+            for ((name, offset, length), (_, data)) in zip(directory,
+                                                           sections):
+                f.write(b"\0" * (offset - f.tell()))
+                f.write(data)
+
+
+class PackageGraph(object):
+    """
+    A dependency graph written by GraphWriter, memory-mapped read-only.
+
+    Packages are identified by their integer id. Every query takes the edge
+    kinds to follow, so the same graph answers runtime (RUNTIME_KINDS) and
+    self-hosting (EDGE_KINDS) questions.
+    """
+    def __init__(self, path):
+        self.filename = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._sections = {}
+        try:
+            self._read_directory()
+        except (struct.error, KeyError, ValueError) as e:
+            self.close()
+            raise GraphFormatException(path, e)
+
+        self.meta = json.loads(bytes(self._bytes("meta")).decode("utf-8"))
+        self._strings = self._bytes("strings")
+        self._string_offsets = self._words("string_offsets")
+        self._packages = self._words("packages")
+        self._edges = dict(
+            (kind, (self._words("%s_offsets" % kind),
+                    self._words("%s_targets" % kind),
+                    self._words("%s_requires" % kind)))
+            for kind in EDGE_KINDS)
+        self._reverse = {}
+        self._names = None
+
+    def _read_directory(self):
+        (magic, version, count) = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("bad magic number")
+        if version != FORMAT_VERSION:
+            raise ValueError("unsupported format version %d" % version)
+
+        for i in range(count):
+            (name, offset, length) = _DIRECTORY_ENTRY.unpack_from(
+                self._map, _HEADER.size + _DIRECTORY_ENTRY.size * i)
+            if offset + length > len(self._map):
+                raise ValueError("truncated file")
+            self._sections[name.rstrip(b"\0").decode("ascii")] = \
+                (offset, length)
+
+    def _bytes(self, name):
+        (offset, length) = self._sections[name]
+        return memoryview(self._map)[offset:offset + length]
+
+    def _words(self, name):
+        data = self._bytes(name)
+        if sys.byteorder == "little":
+            return data.cast("I")
+        words = array.array("I", data)
+        words.byteswap()
+        return words
+
+    def close(self):
+        """
+        Release the memory map. Nothing returned by the graph may be used
+        afterwards.
+        """
+        self._sections = {}
+        self._strings = self._string_offsets = self._packages = None
+        self._edges = {}
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._packages) // len(PACKAGE_FIELDS)
+
+    def string(self, sid):
+        """
+        Get the string with the given string id
+        """
+        if sid == NO_STRING:
+            return None
+        start = self._string_offsets[sid]
+        end = self._string_offsets[sid + 1]
+        return bytes(self._strings[start:end]).decode("utf-8")
+
+    def package(self, node):
+        """
+        Get the package with the given id
+        """
+        start = node * len(PACKAGE_FIELDS)
+        (name, version, release, arch, repo, epoch, flags) = \
+            self._packages[start:start + len(PACKAGE_FIELDS)]
+        return Package(node, self.string(name), epoch, self.string(version),
+                       self.string(release), self.string(arch),
+                       self.string(repo), bool(flags & FLAG_SOURCE),
+                       bool(flags & FLAG_EXPANDED))
+
+    def find(self, name, arch=None):
+        """
+        Find the ids of the packages with this name, and this architecture
+        if one is given. Source RPMs are found with arch 'src'.
+        """
+        if self._names is None:
+            self._names = {}
+            name_field = PACKAGE_FIELDS.index("name")
+            for node in range(len(self)):
+                sid = self._packages[node * len(PACKAGE_FIELDS) + name_field]
+                self._names.setdefault(self.string(sid), []).append(node)
+
+        return [node for node in self._names.get(name, [])
+                if arch is None or self.package(node).arch == arch]
+
+    def successors(self, node, kinds=EDGE_KINDS):
+        """
+        Iterate over the (target, kind, requirement) edges of a package
+        """
+        for kind in kinds:
+            (offsets, targets, requires) = self._edges[kind]
+            for i in range(offsets[node], offsets[node + 1]):
+                yield (targets[i], kind, requires[i])
+
+    def predecessors(self, node, kinds=EDGE_KINDS):
+        """
+        Iterate over the (source, kind, requirement) edges leading to a
+        package. The reverse adjacency of each kind is built on first use.
+        """
+        for kind in kinds:
+            (offsets, sources, requires) = self._get_reverse(kind)
+            for i in range(offsets[node], offsets[node + 1]):
+                yield (sources[i], kind, requires[i])
+
+    def _get_reverse(self, kind):
+        if kind not in self._reverse:
+            (offsets, targets, requires) = self._edges[kind]
+            counts = array.array("I", bytes(4 * (len(self) + 1)))
+            for target in targets:
+                counts[target + 1] += 1
+            for node in range(len(self)):
+                counts[node + 1] += counts[node]
+
+            position = array.array("I", counts)
+            sources = array.array("I", bytes(4 * len(targets)))
+            reverse_requires = array.array("I", bytes(4 * len(targets)))
+            for node in range(len(self)):
+                for i in range(offsets[node], offsets[node + 1]):
+                    slot = position[targets[i]]
+                    position[targets[i]] += 1
+                    sources[slot] = node
+                    reverse_requires[slot] = requires[i]
+            self._reverse[kind] = (counts, sources, reverse_requires)
+
+        return self._reverse[kind]
+
+    def _walk(self, roots, step):
+        depths = collections.OrderedDict((root, 0) for root in roots)
+        parents = {}
+        worklist = collections.deque(roots)
+        while worklist:
+            node = worklist.popleft()
+            for (other, kind, requirement) in step(node):
+                if other not in depths:
+                    depths[other] = depths[node] + 1
+                    parents[other] = (node, kind, requirement)
+                    worklist.append(other)
+        return (depths, parents)
+
+    def closure(self, roots, kinds=RUNTIME_KINDS):
+        """
+        Get every package reachable from the roots, including the roots.
+
+        Returns: an ordered dict of the number of steps from the nearest root
+                 to each package, keyed by package id
+        """
+        return self._walk(roots, lambda node: self.successors(node,
+                                                              kinds))[0]
+
+    def reverse_closure(self, targets, kinds=RUNTIME_KINDS):
+        """
+        Get every package from which one of the targets is reachable,
+        including the targets.
+
+        Returns: an ordered dict of the number of steps to the nearest target
+                 from each package, keyed by package id
+        """
+        return self._walk(targets, lambda node: self.predecessors(node,
+                                                                  kinds))[0]
+
+    def path(self, source, target, kinds=RUNTIME_KINDS):
+        """
+        Find a shortest chain of dependencies from package source to package
+        target.
+
+        Returns: list of the (package id, kind, requirement string id) steps
+                 after source, or None if target is not reachable
+        """
+        (depths, parents) = self._walk(
+            [source], lambda node: self.successors(node, kinds))
+        if target not in depths:
+            return None
+
+        steps = []
+        node = target
+        while node != source:
+            (parent, kind, requirement) = parents[node]
+            steps.append((node, kind, requirement))
+            node = parent
+        steps.reverse()
+        return steps
+
+    def ambiguities(self, nodes=None):
+        """
+        Iterate over the (package id, requirement, candidate ids) of every
+        requirement left ambiguous, restricted to the packages in 'nodes' if
+        it is given
+        """
+        offsets = self._words("ambiguity_offsets")
+        owners = self._words("ambiguity_nodes")
+        requires = self._words("ambiguity_requires")
+        candidates = self._words("ambiguity_candidates")
+        for i in range(len(owners)):
+            if nodes is None or owners[i] in nodes:
+                yield (owners[i], self.string(requires[i]),
+                       list(candidates[offsets[i]:offsets[i + 1]]))
+
+    def format_package(self, node, full=False):
+        """
+        Format a package name the way whatpkgs.py prints it
+        """
+        pkg = self.package(node)
+        if full:
+            return "%d:%s-%s-%s.%s" % (pkg.epoch, pkg.name, pkg.version,
+                                       pkg.release, pkg.arch)
+        if pkg.arch == self.meta.get("multi_arch"):
+            return "%s#%s" % (pkg.name, pkg.arch)
+        return pkg.name
+
+
+def _lookup(graph, fullpkgname, is_source=False):
+    """
+    Find the single package called name or name#arch
+    """
+    (name, _, arch) = fullpkgname.partition("#")
+    nodes = [node for node in graph.find(name, arch or None)
+             if graph.package(node).is_source == is_source]
+    if len(nodes) == 0:
+        raise click.ClickException(
+            "Package name %s is not in the graph" % fullpkgname)
+    if len(nodes) > 1 and not arch:
+        # Prefer the architectures in the same order as whatpkgs.py
+        for tier in graph.meta.get("arch_tiers", []):
+            tiered = [node for node in nodes
+                      if graph.package(node).arch == tier]
+            if tiered:
+                return tiered[0]
+    return nodes[0]
+
+
+def _kinds(self_host):
+    return EDGE_KINDS if self_host else RUNTIME_KINDS
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command(short_help="Describe a dependency graph")
+@click.argument('graph_file', metavar="FILE")
+def info(graph_file):
+    """
+    Print how the graph was resolved and how big it is.
+    """
+    with PackageGraph(graph_file) as graph:
+        for (key, value) in sorted(graph.meta.items()):
+            print("%s: %s" % (key, value))
+        print("packages: %d" % len(graph))
+        for kind in EDGE_KINDS:
+            print("%s edges: %d" % (kind, len(graph._edges[kind][1])))
+        print("ambiguities: %d" % len(graph._words("ambiguity_nodes")))
+
+
+@main.command(short_help="Get package dependencies")
+@click.argument('graph_file', metavar="FILE")
+@click.argument('pkgnames', nargs=-1)
+@click.option('--self-host/--no-self-host', default=False,
+              help="Follow the Source RPMs and their BuildRequires as well.")
+@click.option('--reverse/--no-reverse', default=False,
+              help="List the packages that depend on the given packages "
+                   "instead.")
+@click.option('--sources/--no-sources', default=False,
+              help="List the Source RPMs instead of the binary packages.")
+@click.option('--full-name/--no-full-name', default=False)
+@click.option('--show-depth/--no-show-depth', default=False)
+def closure(graph_file, pkgnames, self_host, reverse, sources, full_name,
+            show_depth):
+    """
+    Print the merged closure of the given packages from the graph.
+    """
+    with PackageGraph(graph_file) as graph:
+        nodes = [_lookup(graph, name) for name in pkgnames]
+        if reverse:
+            depths = graph.reverse_closure(nodes, _kinds(self_host))
+        else:
+            depths = graph.closure(nodes, _kinds(self_host))
+
+        for node in sorted(depths, key=lambda node: (
+                graph.package(node).name, graph.package(node).arch)):
+            if graph.package(node).is_source != sources:
+                continue
+            name = graph.format_package(node, full_name)
+            if show_depth:
+                print("%s\t%d" % (name, depths[node]))
+            else:
+                print(name)
+
+        ambiguities = list(graph.ambiguities(depths))
+        if ambiguities and not reverse:
+            print("=== Unresolved Requirements ===", file=sys.stderr)
+            for (node, requirement, candidates) in ambiguities:
+                print("%s: %s: %s" % (
+                    graph.format_package(node, full_name), requirement,
+                    ", ".join(graph.format_package(candidate, full_name)
+                              for candidate in candidates)),
+                      file=sys.stderr)
+
+
+@main.command(short_help="Explain a dependency")
+@click.argument('graph_file', metavar="FILE")
+@click.argument('source')
+@click.argument('target')
+@click.option('--self-host/--no-self-host', default=False,
+              help="Follow the Source RPMs and their BuildRequires as well.")
+@click.option('--full-name/--no-full-name', default=False)
+def path(graph_file, source, target, self_host, full_name):
+    """
+    Print a shortest chain of dependencies from SOURCE to TARGET.
+    """
+    with PackageGraph(graph_file) as graph:
+        steps = graph.path(_lookup(graph, source), _lookup(graph, target),
+                           _kinds(self_host))
+        if steps is None:
+            print("%s does not depend on %s" % (source, target),
+                  file=sys.stderr)
+            sys.exit(1)
+
+        line = graph.format_package(_lookup(graph, source), full_name)
+        for (node, kind, requirement) in steps:
+            label = kind
+            if requirement != NO_STRING:
+                label = "%s: %s" % (kind, graph.string(requirement))
+            line += " --[%s]--> %s" % (label,
+                                       graph.format_package(node, full_name))
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,747 @@
+"""
+Repository backend that answers package queries from the primary.sqlite
+metadata of yum/dnf repositories, without python3-dnf.
+
+The Sack, Query, Package and Reldep objects mimic the part of the hawkey API
+that whatpkgs.py uses, so they can be wrapped by its IndexedQuery just like a
+hawkey query. Dependencies are matched the way libsolv matches them.
+"""
+
+import bz2
+import functools
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+from xml.etree import ElementTree
+
+REPO_NS = "http://linux.duke.edu/metadata/repo"
+
+# Comparison flags of a dependency, as stored in the repodata
+FLAG_OPERATORS = {"EQ": "=", "LT": "<", "GT": ">", "LE": "<=", "GE": ">="}
+OPERATOR_FLAGS = dict((op, flags) for (flags, op) in FLAG_OPERATORS.items())
+
+# Files that createrepo lists in the primary metadata and not only in the
+# filelists: the ones that are commonly required by path
+PRIMARY_FILE_RE = re.compile(r"^/etc/|^/usr/lib/sendmail$|bin/")
+
+# Which files can satisfy a file dependency: only the ones listed in the
+# primary metadata, or every file from the filelists metadata, loaded either
+# with the repositories or when a file dependency is first looked up
+FILELISTS_MODES = ("primary", "full", "lazy")
+
+# Operators of rich (boolean) dependencies
+RICH_OPERATORS = ("and", "or", "if", "else", "unless", "with", "without")
+
+_ALNUM = re.compile(r"[0-9]+|[a-zA-Z]+")
+
+
+class RepodataException(Exception):
+    """
+    Raised when the metadata of a repository cannot be used
+    """
+    def __init__(self, path, reason):
+        self.path = path
+        self.reason = reason
+
+    def __str__(self):
+        return "Unable to read the repodata in %s: %s" % (self.path,
+                                                          self.reason)
+
+
+def rpmvercmp(a, b):
+    """
+    Compare two version or release strings the way rpm does
+
+    Returns: -1, 0 or 1
+    """
+    if a == b:
+        return 0
+
+    i = j = 0
+    while i < len(a) or j < len(b):
+        # Skip the separators, but not the '~' and '^' markers
+        while i < len(a) and not a[i].isalnum() and a[i] not in "~^":
+            i += 1
+        while j < len(b) and not b[j].isalnum() and b[j] not in "~^":
+            j += 1
+
+        # '~' sorts before everything, even the end of the string
+        a_tilde = i < len(a) and a[i] == "~"
+        b_tilde = j < len(b) and b[j] == "~"
+        if a_tilde or b_tilde:
+            if not a_tilde:
+                return 1
+            if not b_tilde:
+                return -1
+            i += 1
+            j += 1
+            continue
+
+        # '^' sorts after the end of the string but before anything else
+        a_caret = i < len(a) and a[i] == "^"
+        b_caret = j < len(b) and b[j] == "^"
+        if a_caret or b_caret:
+            if i >= len(a):
+                return -1
+            if j >= len(b):
+                return 1
+            if not a_caret:
+                return 1
+            if not b_caret:
+                return -1
+            i += 1
+            j += 1
+            continue
+
+        if i >= len(a) or j >= len(b):
+            break
+
+        a_segment = _ALNUM.match(a, i)
+        b_segment = _ALNUM.match(b, j)
+        if a_segment is None or b_segment is None:
+            # Non-ASCII characters count as separators
+            i += a_segment is None
+            j += b_segment is None
+            continue
+        a_part = a_segment.group()
+        b_part = b_segment.group()
+        i = a_segment.end()
+        j = b_segment.end()
+
+        a_numeric = a_part[0].isdigit()
+        if a_numeric != b_part[0].isdigit():
+            # Numeric segments are newer than alphabetic ones
+            return 1 if a_numeric else -1
+
+        if a_numeric:
+            a_part = a_part.lstrip("0")
+            b_part = b_part.lstrip("0")
+            if len(a_part) != len(b_part):
+                return 1 if len(a_part) > len(b_part) else -1
+
+        if a_part != b_part:
+            return 1 if a_part > b_part else -1
+
+    if i >= len(a) and j >= len(b):
+        return 0
+    return -1 if i >= len(a) else 1
+
+
+def evrcmp(evr1, evr2, match_release=False):
+    """
+    Compare two (epoch, version, release) tuples. A missing epoch counts as
+    0. With match_release, the releases are only compared if both are given,
+    as when matching a dependency.
+    """
+    (epoch1, version1, release1) = evr1
+    (epoch2, version2, release2) = evr2
+    if (epoch1 or 0) != (epoch2 or 0):
+        return 1 if (epoch1 or 0) > (epoch2 or 0) else -1
+
+    cmp = rpmvercmp(version1 or "", version2 or "")
+    if cmp:
+        return cmp
+
+    if match_release and (not release1 or not release2):
+        return 0
+    return rpmvercmp(release1 or "", release2 or "")
+
+
+def _format_evr(epoch, version, release):
+    evr = version or ""
+    if epoch:
+        evr = "%d:%s" % (epoch, evr)
+    if release:
+        evr = "%s-%s" % (evr, release)
+    return evr
+
+
+def _parse_epoch(epoch):
+    return int(epoch) if epoch else 0
+
+
+class Reldep(object):
+    """
+    A dependency: a name, optionally with a version comparison, or a rich
+    dependency in parentheses
+    """
+    __slots__ = ("name", "flags", "epoch", "version", "release")
+
+    def __init__(self, name, flags=None, epoch=None, version=None,
+                 release=None):
+        self.name = name
+        self.flags = flags
+        self.epoch = epoch
+        self.version = version
+        self.release = release
+
+    @classmethod
+    def parse(cls, string):
+        """
+        Make a Reldep from its string form,
+        "name [op [epoch:]version[-release]]"
+        """
+        string = string.strip()
+        if string.startswith("("):
+            return cls(string)
+
+        parts = string.split()
+        if len(parts) == 3 and parts[1] in OPERATOR_FLAGS:
+            (epoch, version, release) = _split_evr(parts[2])
+            return cls(parts[0], OPERATOR_FLAGS[parts[1]], epoch, version,
+                       release)
+        return cls(string)
+
+    @property
+    def is_rich(self):
+        return self.name.startswith("(")
+
+    def __str__(self):
+        if not self.flags:
+            return self.name
+        return "%s %s %s" % (self.name, FLAG_OPERATORS[self.flags],
+                             _format_evr(self.epoch, self.version,
+                                         self.release))
+
+    def __repr__(self):
+        return "<sqliterepo.Reldep %s>" % self
+
+    def __eq__(self, other):
+        return isinstance(other, Reldep) and str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def overlaps(self, provide):
+        """
+        Check whether a Provides (another Reldep with the same name)
+        satisfies this requirement
+        """
+        if not self.flags or not provide.flags:
+            return True
+
+        sense = evrcmp((provide.epoch, provide.version, provide.release),
+                       (self.epoch, self.version, self.release),
+                       match_release=True)
+        provided = provide.flags
+        required = self.flags
+        if sense < 0:
+            return "G" in provided or "L" in required
+        if sense > 0:
+            return "L" in provided or "G" in required
+        return (("E" in provided and "E" in required) or
+                (provided[0] == "L" and required[0] == "L") or
+                (provided[0] == "G" and required[0] == "G"))
+
+
+def _split_evr(evr):
+    epoch = None
+    if ":" in evr:
+        (epoch, evr) = evr.split(":", 1)
+        epoch = int(epoch)
+    (version, _, release) = evr.partition("-")
+    return (epoch, version, release or None)
+
+
+def _tokenize_rich(string):
+    """
+    Split a rich dependency into parentheses, operators and the simple
+    dependencies between them
+    """
+    tokens = []
+    words = []
+    for word in re.findall(r"\(|\)|[^\s()]+", string):
+        if word in ("(", ")") or word in RICH_OPERATORS:
+            if words:
+                tokens.append(" ".join(words))
+                words = []
+            tokens.append(word)
+        else:
+            words.append(word)
+    if words:
+        tokens.append(" ".join(words))
+    return tokens
+
+
+def parse_rich(string):
+    """
+    Parse a rich dependency into nested (operator, left, right) tuples with
+    Reldep leaves
+    """
+    tokens = _tokenize_rich(string)
+    position = [0]
+
+    def expression():
+        if tokens[position[0]] == "(":
+            position[0] += 1
+            node = expression()
+            while tokens[position[0]] != ")":
+                operator = tokens[position[0]]
+                position[0] += 1
+                node = (operator, node, expression())
+            position[0] += 1
+            return node
+        node = Reldep.parse(tokens[position[0]])
+        position[0] += 1
+        return node
+
+    try:
+        return expression()
+    except IndexError:
+        raise ValueError("Malformed rich dependency %s" % string)
+
+
+class Package(object):
+    """
+    A package of a repository loaded into a Sack
+    """
+    __slots__ = ("name", "arch", "epoch", "version", "release", "sourcerpm",
+                 "reponame", "_repo", "_key", "_deps")
+
+    def __init__(self, repo, key, name, arch, epoch, version, release,
+                 sourcerpm):
+        self._repo = repo
+        self._key = key
+        self._deps = {}
+        self.reponame = repo.name
+        self.name = name
+        self.arch = arch
+        self.epoch = _parse_epoch(epoch)
+        self.version = version
+        self.release = release
+        self.sourcerpm = sourcerpm or None
+
+    @property
+    def evr(self):
+        return _format_evr(self.epoch, self.version, self.release)
+
+    def evr_cmp(self, other):
+        return evrcmp((self.epoch, self.version, self.release),
+                      (other.epoch, other.version, other.release))
+
+    def _get_deps(self, table, pre=None):
+        cache_key = (table, pre)
+        if cache_key not in self._deps:
+            self._deps[cache_key] = self._repo.get_deps(self._key, table,
+                                                        pre)
+        return self._deps[cache_key]
+
+    @property
+    def requires(self):
+        return self._get_deps("requires", False)
+
+    @property
+    def requires_pre(self):
+        return self._get_deps("requires", True)
+
+    @property
+    def recommends(self):
+        return self._get_deps("recommends")
+
+    @property
+    def provides(self):
+        return self._repo.get_provides(self._key)
+
+    @property
+    def files(self):
+        return self._repo.get_files(self._key)
+
+    def __lt__(self, other):
+        # Same order as hawkey: by name, then newest first, then by arch
+        if self.name != other.name:
+            return self.name < other.name
+        cmp = self.evr_cmp(other)
+        if cmp:
+            return cmp > 0
+        return self.arch < other.arch
+
+    def __str__(self):
+        return "%s-%s.%s" % (self.name, self.evr, self.arch)
+
+    def __repr__(self):
+        return "<sqliterepo.Package %s, %s>" % (self, self.reponame)
+
+
+class Repo(object):
+    """
+    The primary.sqlite database of one repository
+    """
+    def __init__(self, name, path, db_path, filelists_db=None):
+        """
+        filelists_db is called, without arguments, to get the path of the
+        filelists.sqlite database the first time the files of a package are
+        needed. Without it, only the files listed in the primary database
+        are known.
+        """
+        self.name = name
+        self.path = path
+        self.db_path = db_path
+        self._db = None
+        self._pid = None
+        self.tables = set(row[0] for row in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"))
+        self._provides = None
+        self._filelists_db = filelists_db
+        # Files of each package, and packages owning each file
+        self._files = None
+        self._file_owners = None
+
+        self.packages = {}
+        for row in self.db.execute(
+                "SELECT pkgKey, name, arch, epoch, version, release, "
+                "rpm_sourcerpm FROM packages ORDER BY pkgKey"):
+            self.packages[row[0]] = Package(self, *row)
+
+    @property
+    def db(self):
+        """
+        The connection to the database. A process forked after it was opened
+        gets its own connection, since SQLite connections cannot be shared
+        across a fork.
+        """
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._pid = os.getpid()
+        return self._db
+
+    def get_deps(self, key, table, pre=None):
+        """
+        Get the dependencies of the given kind of a package, in the order
+        of the metadata and without the rpmlib() ones
+        """
+        if table not in self.tables:
+            return []
+
+        sql = ("SELECT name, flags, epoch, version, release FROM %s "
+               "WHERE pkgKey = ?" % table)
+        if pre is not None:
+            sql += " AND pre IN (%s)" % ("'TRUE', 1" if pre else
+                                         "'FALSE', 0")
+        deps = []
+        seen = set()
+        for (name, flags, epoch, version, release) in self.db.execute(
+                sql + " ORDER BY rowid", (key,)):
+            if name.startswith("rpmlib("):
+                continue
+            dep = Reldep(name, flags, _parse_epoch(epoch) if epoch else None,
+                         version, release)
+            if str(dep) not in seen:
+                seen.add(str(dep))
+                deps.append(dep)
+        return deps
+
+    def get_provides(self, key):
+        """
+        Get the Provides of a package. The Provides of the whole repository
+        are read at once on first use.
+        """
+        if self._provides is None:
+            self._provides = {}
+            for (pkg_key, name, flags, epoch, version, release) in \
+                    self.db.execute(
+                        "SELECT pkgKey, name, flags, epoch, version, release "
+                        "FROM provides ORDER BY rowid"):
+                self._provides.setdefault(pkg_key, []).append(
+                    Reldep(name, flags,
+                           _parse_epoch(epoch) if epoch else None,
+                           version, release))
+        return self._provides.get(key, [])
+
+    def get_files(self, key):
+        """
+        Get the files of a package. The files of the whole repository are
+        read at once on first use.
+        """
+        if self._files is None:
+            self.load_files()
+        return self._files.get(key, [])
+
+    def load_files(self):
+        """
+        Read the files of every package, from the filelists database if
+        there is one and otherwise from the primary database
+        """
+        self._files = {}
+        if self._filelists_db is None:
+            if "files" in self.tables:
+                for (key, filename) in self.db.execute(
+                        "SELECT pkgKey, name FROM files ORDER BY rowid"):
+                    self._files.setdefault(key, []).append(filename)
+            return
+
+        # The package keys of the two databases differ, but the package
+        # checksums are the same
+        keys = dict((pkgid, key) for (key, pkgid) in self.db.execute(
+            "SELECT pkgKey, pkgId FROM packages"))
+        filelists = sqlite3.connect(self._filelists_db())
+        try:
+            for (pkgid, dirname, filenames) in filelists.execute(
+                    "SELECT packages.pkgId, dirname, filenames "
+                    "FROM filelist JOIN packages USING (pkgKey) "
+                    "ORDER BY filelist.rowid"):
+                key = keys.get(pkgid)
+                if key is None:
+                    continue
+                files = self._files.setdefault(key, [])
+                prefix = dirname.rstrip("/") + "/"
+                # The names are joined with '/'; only the root directory
+                # itself gives empty ones
+                files.extend(prefix + filename
+                             for filename in filenames.split("/") if filename)
+        finally:
+            filelists.close()
+
+    def whatprovides(self, reldep):
+        """
+        Find the packages of this repository whose Provides (or files, for a
+        path) satisfy a simple dependency
+        """
+        found = []
+        for (key, flags, epoch, version, release) in self.db.execute(
+                "SELECT pkgKey, flags, epoch, version, release FROM provides "
+                "WHERE name = ?", (reldep.name,)):
+            provide = Reldep(reldep.name, flags,
+                             _parse_epoch(epoch) if epoch else None,
+                             version, release)
+            if reldep.overlaps(provide):
+                found.append(self.packages[key])
+
+        if reldep.name.startswith("/"):
+            if self._file_owners is None:
+                if self._files is None:
+                    self.load_files()
+                self._file_owners = _index_files(self._files)
+            found.extend(self.packages[key]
+                         for key in self._file_owners.get(reldep.name, []))
+
+        return found
+
+
+class Sack(object):
+    """
+    The packages of a set of repositories, read from the primary.sqlite.bz2
+    (and filelists.sqlite.bz2) of each of them
+    """
+    def __init__(self, repos, db_dir, filelists="primary"):
+        """
+        Load the (reponame, path) repositories. The databases are
+        decompressed into db_dir, unless a previous run already did.
+        'filelists' is one of FILELISTS_MODES.
+        """
+        self.db_dir = db_dir
+        self.repos = []
+        self.decompressed = 0
+        for (reponame, path) in repos:
+            db_path = self._get_db(reponame, path, "primary")
+            filelists_db = None
+            if filelists != "primary":
+                # Fail now rather than on the first file dependency if the
+                # repository has no filelists
+                find_repodata(path, "filelists_db")
+                filelists_db = functools.partial(self._get_db, reponame,
+                                                 path, "filelists")
+            repo = Repo(reponame, path, db_path, filelists_db)
+            if filelists == "full":
+                repo.load_files()
+            self.repos.append(repo)
+
+    def _get_db(self, reponame, path, datatype):
+        db_path = os.path.join(self.db_dir, "%s-%s.sqlite" % (reponame,
+                                                              datatype))
+        if not os.path.exists(db_path):
+            os.makedirs(self.db_dir, exist_ok=True)
+            _decompress(find_repodata(path, datatype + "_db"), db_path)
+            self.decompressed += 1
+        return db_path
+
+    def query(self):
+        return Query(self, [pkg for repo in self.repos
+                            for pkg in repo.packages.values()])
+
+    def whatprovides(self, reldep):
+        """
+        Find every package satisfying a dependency, which may be a rich
+        dependency
+        """
+        if reldep.is_rich:
+            return self._whatprovides_rich(parse_rich(reldep.name))
+
+        found = []
+        for repo in self.repos:
+            found.extend(repo.whatprovides(reldep))
+        return found
+
+    def _whatprovides_rich(self, node):
+        if isinstance(node, Reldep):
+            return self.whatprovides(node)
+
+        (operator, left, right) = node
+        left_found = self._whatprovides_rich(left)
+
+        if operator in ("and", "with"):
+            right_keys = set(id(pkg) for pkg in
+                             self._whatprovides_rich(right))
+            return [pkg for pkg in left_found if id(pkg) in right_keys]
+        if operator == "or":
+            found = list(left_found)
+            keys = set(id(pkg) for pkg in found)
+            for pkg in self._whatprovides_rich(right):
+                if id(pkg) not in keys:
+                    keys.add(id(pkg))
+                    found.append(pkg)
+            return found
+        if operator == "without":
+            right_keys = set(id(pkg) for pkg in
+                             self._whatprovides_rich(right))
+            return [pkg for pkg in left_found if id(pkg) not in right_keys]
+
+        if operator == "else":
+            # "A if B else C": either A or C may end up being required
+            found = list(left_found)
+            keys = set(id(pkg) for pkg in found)
+            for pkg in self._whatprovides_rich(right):
+                if id(pkg) not in keys:
+                    keys.add(id(pkg))
+                    found.append(pkg)
+            return found
+
+        # "A if B" and "A unless B": the condition is assumed to hold, so
+        # only A can be required
+        return left_found
+
+
+def _index_files(files):
+    """
+    Turn the files of each package key into the package keys owning each
+    file
+    """
+    owners = {}
+    for (key, filenames) in files.items():
+        for filename in filenames:
+            owners.setdefault(filename, []).append(key)
+    return owners
+
+
+def find_repodata(path, datatype):
+    """
+    Find the file holding the given type of metadata ("primary",
+    "primary_db", "filelists"...) of the repository at path, from its
+    repomd.xml
+    """
+    repomd = os.path.join(path, "repodata", "repomd.xml")
+    try:
+        root = ElementTree.parse(repomd).getroot()
+    except (OSError, ElementTree.ParseError) as e:
+        raise RepodataException(path, e)
+
+    for data in root.findall("{%s}data" % REPO_NS):
+        if data.get("type") == datatype:
+            location = data.find("{%s}location" % REPO_NS)
+            return os.path.join(path, location.get("href"))
+
+    raise RepodataException(path, "no %s in repomd.xml" % datatype)
+
+
+def _decompress(source, destination):
+    """
+    Decompress a .sqlite.bz2 file, replacing the destination atomically
+
+    Raises RepodataException if the file is missing or corrupt
+    """
+    opener = bz2.open if source.endswith(".bz2") else open
+    (fd, tmp_path) = tempfile.mkstemp(
+        dir=os.path.dirname(destination),
+        prefix=os.path.basename(destination) + ".")
+    try:
+        # The temporary file is opened first so that it is closed even if
+        # the source cannot be opened
+        with os.fdopen(fd, "wb") as dst, opener(source, "rb") as src:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.rename(tmp_path, destination)
+    except (OSError, EOFError) as e:
+        os.unlink(tmp_path)
+        raise RepodataException(source, e)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class Query(object):
+    """
+    An immutable list of packages of a Sack that can be filtered like a
+    hawkey query
+    """
+    def __init__(self, sack, packages):
+        self.sack = sack
+        self._packages = packages
+
+    def __iter__(self):
+        return iter(self._packages)
+
+    def __len__(self):
+        return len(self._packages)
+
+    def __getitem__(self, index):
+        return self._packages[index]
+
+    def run(self):
+        return list(self._packages)
+
+    def filter(self, name=None, arch=None, latest=False, provides=None,
+               pkg=None):
+        """
+        Narrow the query to the packages matching every given criterion.
+        'arch' and 'provides' may be lists, matching any of their entries,
+        and 'pkg' restricts the result to the given packages.
+        """
+        packages = self._packages
+
+        if pkg is not None:
+            wanted = set(id(candidate) for candidate in pkg)
+            packages = [candidate for candidate in packages
+                        if id(candidate) in wanted]
+
+        if name is not None:
+            packages = [candidate for candidate in packages
+                        if candidate.name == name]
+
+        if arch is not None:
+            arches = set([arch] if isinstance(arch, str) else arch)
+            packages = [candidate for candidate in packages
+                        if candidate.arch in arches]
+
+        if provides is not None:
+            if not isinstance(provides, (list, tuple)):
+                provides = [provides]
+            providers = set()
+            for reldep in provides:
+                if not isinstance(reldep, Reldep):
+                    reldep = Reldep.parse(str(reldep))
+                providers.update(id(candidate) for candidate in
+                                 self.sack.whatprovides(reldep))
+            packages = [candidate for candidate in packages
+                        if id(candidate) in providers]
+
+        if latest:
+            packages = _latest_per_arch(packages)
+
+        return Query(self.sack, packages)
+
+
+def _latest_per_arch(packages):
+    # Like hawkey, a version that ties across repositories is only returned
+    # once, from the repository that was loaded first.
+    latest = {}
+    for pkg in packages:
+        key = (pkg.name, pkg.arch)
+        best = latest.get(key)
+        if best is None or pkg.evr_cmp(best) > 0:
+            latest[key] = pkg
+
+    keep = set(id(pkg) for pkg in latest.values())
+    return [pkg for pkg in packages if id(pkg) in keep]
@@ -5,15 +5,21 @@ Tool for interacting with python3-dnf to get complicated dependency
 information from yum/dnf repodata.
 """
 
+import multiprocessing
 import os
-import queue
-import threading
+import pprint
+import sys
 import whatpkgs
 import click
 import time
+from colorama import Fore, Back, Style
 
 NUM_PROCS=os.sysconf("SC_NPROCESSORS_ONLN")
 
+# Loaded repositories and options, set up before the worker processes are
+# forked so that they are shared with them copy-on-write
+_state = None
+
 
 def print_package_name(filehandle, pkgname, dependencies, full):
     """
@@ -33,6 +39,203 @@ def print_package_name(filehandle, pkgname, dependencies, full):
         filehandle.write("%s\n" % printpkg.name)
 
 
+def selfhost_worker(item):
+    """
+    Compute the self-hosting closure of one package in a worker process and
+    write it to its output file.
+
+    Each worker keeps its own dependency graph, so the parts of the closure
+    shared with packages it processed earlier are only resolved once.
+
+    Returns: tuple of the package name and an error message, or None
+    """
+    (pkg_name, output_file) = item
+
+    if _state["graph"] is None:
+        _state["graph"] = whatpkgs.DependencyGraph(
+            _state["query"], _state["hint"], _state["filter"],
+            _state["whatreqs"], _state["pick_first"], _state["recommends"],
+            self_host=True)
+
+    try:
+        [(_, pkg)] = whatpkgs.get_pkgs_by_name(_state["query"], [pkg_name])
+        (binary_pkgs, source_pkgs, ambiguities) = \
+            _state["graph"].closure(pkg)
+    except Exception as e:
+        return (pkg_name, str(e))
+
+    with open(output_file, 'w') as f:
+        if _state["sources"]:
+            for key in sorted(source_pkgs, key=source_pkgs.get):
+                # Skip the initial package
+                if key == pkg_name:
+                    continue
+                print_package_name(f, key, source_pkgs, _state["full_name"])
+        else:
+            for key in sorted(binary_pkgs, key=binary_pkgs.get):
+                print_package_name(f, key, binary_pkgs, _state["full_name"])
+
+    return (pkg_name, None)
+
+
+def _ambiguity_keys(ambiguities):
+    """
+    Convert ambiguities into lists of package keys that can be sent back
+    from a worker process
+    """
+    return [[whatpkgs.package_key(pkg) for pkg in ambiguity.values()]
+            for ambiguity in ambiguities]
+
+
+def resolve_binaries_worker(keys):
+    """
+    Resolve the requirements and the Source RPM of a slice of the binary
+    packages discovered at the current level
+
+    Returns: list of (key, dependency keys, Source RPM key, ambiguities)
+    """
+    query = _state["query"]
+    results = []
+    for key in keys:
+        pkg = query.get_package(key)
+        ambiguities = []
+        deps = whatpkgs.get_package_requirements(
+            pkg, {}, ambiguities, query, _state["hint"], _state["filter"],
+            _state["whatreqs"], _state["pick_first"], _state["recommends"])
+        source_pkg = whatpkgs.get_srpm_for_package(query, pkg)
+        results.append((key,
+                        [whatpkgs.package_key(dep) for dep in deps],
+                        whatpkgs.package_key(source_pkg),
+                        _ambiguity_keys(ambiguities)))
+    return results
+
+
+def resolve_sources_worker(keys):
+    """
+    Resolve the BuildRequires of a slice of the Source RPMs discovered at
+    the current level
+
+    Returns: list of (key, dependency keys, ambiguities)
+    """
+    query = _state["query"]
+    results = []
+    for key in keys:
+        source_pkg = query.get_package(key)
+        ambiguities = []
+        deps = whatpkgs.get_requirements(
+            source_pkg, source_pkg.requires, {}, ambiguities, query,
+            _state["hint"], _state["filter"], _state["whatreqs"],
+            _state["pick_first"])
+        results.append((key,
+                        [whatpkgs.package_key(dep) for dep in deps],
+                        _ambiguity_keys(ambiguities)))
+    return results
+
+
+def _map_partitioned(pool, processes, worker, keys):
+    """
+    Split the keys into slices, process them in the pool and return the
+    concatenated results in the original order
+    """
+    if not keys:
+        return []
+
+    # A few slices per process, so that they even out
+    size = max(1, len(keys) // (processes * 4))
+    slices = [keys[i:i + size] for i in range(0, len(keys), size)]
+
+    results = []
+    for result in pool.map(worker, slices):
+        results.extend(result)
+    return results
+
+
+def merged_self_host(pool, processes, roots):
+    """
+    Compute the merged self-hosting closure of the root packages one
+    breadth-first level at a time. The frontier of each level is partitioned
+    across the pool, and the results are deduplicated against the global
+    visited sets here before forming the next frontier.
+
+    Returns: tuple of the binary packages keyed by name#arch, the Source
+             RPMs keyed by name and an AmbiguityTracker
+    """
+    query = _state["query"]
+    binary_pkgs = {}
+    source_pkgs = {}
+    ambiguity_keys = []
+
+    def visit(keys):
+        frontier = []
+        for key in keys:
+            pkg = query.get_package(key)
+            depname = "%s#%s" % (pkg.name, pkg.arch)
+            if depname not in binary_pkgs:
+                binary_pkgs[depname] = pkg
+                frontier.append(key)
+        return frontier
+
+    frontier = visit([whatpkgs.package_key(pkg) for pkg in roots])
+    while frontier:
+        discovered = []
+        new_sources = []
+
+        for (key, deps, source_key, ambiguities) in _map_partitioned(
+                pool, processes, resolve_binaries_worker, frontier):
+            discovered.extend(deps)
+            ambiguity_keys.extend(ambiguities)
+
+            source_pkg = query.get_package(source_key)
+            if source_pkg.name not in source_pkgs:
+                source_pkgs[source_pkg.name] = source_pkg
+                new_sources.append(source_key)
+
+        for (key, deps, ambiguities) in _map_partitioned(
+                pool, processes, resolve_sources_worker, new_sources):
+            discovered.extend(deps)
+            ambiguity_keys.extend(ambiguities)
+
+        frontier = visit(discovered)
+
+    ambiguities = whatpkgs.AmbiguityTracker(binary_pkgs)
+    for keys in ambiguity_keys:
+        ambiguity = {}
+        for key in keys:
+            pkg = query.get_package(key)
+            ambiguity["%s#%s" % (pkg.name, pkg.arch)] = pkg
+        ambiguities.append(ambiguity)
+
+    return (binary_pkgs, source_pkgs, ambiguities)
+
+
+def compare_with_serial(query, roots, binary_pkgs, source_pkgs,
+                        parallel_time, processes):
+    """
+    Compute the merged closure with the serial engine, make sure that it
+    matches the parallel result and report the speedup
+    """
+    serial_binaries = {}
+    serial_sources = {}
+
+    start = time.time()
+    whatpkgs.walk_dependencies(roots, serial_binaries, [], query,
+                               _state["hint"], _state["filter"],
+                               _state["whatreqs"], _state["pick_first"],
+                               _state["recommends"],
+                               sources=serial_sources)
+    serial_time = time.time() - start
+
+    if (set(serial_binaries) != set(binary_pkgs) or
+            set(serial_sources) != set(source_pkgs)):
+        print("Parallel and serial closures differ", file=sys.stderr)
+        sys.exit(1)
+
+    print("Serial: %.2f seconds, parallel with %d processes: %.2f seconds "
+          "(%.2fx speedup)" % (serial_time, processes, parallel_time,
+                               serial_time / parallel_time),
+          file=sys.stderr)
+
+
 @click.group()
 def main():
     pass
@@ -50,6 +253,14 @@ For build dependencies, the default is to exclude Recommends: from the
 dependencies of the BuildRequires.
 """)
 @click.option('--recommends/--no-recommends', default=False)
+@click.option('--merge/--no-merge', default=False,
+              help="Print the combined closure of all of the packages "
+                   "instead of writing one file per package. The closure is "
+                   "explored one dependency level at a time, with each "
+                   "level split across the worker processes.")
+@click.option('--compare-serial/--no-compare-serial', default=False,
+              help="With --merge, also compute the closure serially, check "
+                   "that the results are identical and report the speedup.")
 @click.option('--full-name/--no-full-name', default=False)
 @click.option('--sources/--no-sources', default=True)
 @click.option('--pick-first/--no-pick-first', default=False,
@@ -60,6 +271,19 @@ fulfill the requirement, automatically select one from the list.
 Note: this result may differ between runs depending upon how the list is
 sorted. It is recommended to use --hint instead, where practical.
 """)
+@click.option('--filter', multiple=True,
+              help="""
+Specify a package to be skipped during processing. This option may be
+specified multiple times.
+
+This is useful when some packages are provided by a lower-level module
+already contains the package and its dependencies.
+""")
+@click.option('--whatreqs', multiple=True,
+              help="""
+Specify a package that you want to identify what pulls it into the complete
+set. This option may be specified multiple times.
+""")
 @click.option('--system/--no-system', default=False,
               help="If --system is specified, use the 'fedora', 'updates', "
                    "'source' and 'updates-source' repositories from the local "
@@ -69,64 +293,119 @@ sorted. It is recommended to use --hint instead, where practical.
               help="If --system is not specified, the use of --rhel will "
                    "give back results from the RHEL sample data. Otherwise, "
                    "Fedora sample data will be used.")
+@click.option('--version', default="25",
+              help="Specify the version of the OS sampledata to compare "
+                   "against.")
+@click.option('--backend', default=whatpkgs.DEFAULT_BACKEND,
+              type=click.Choice(whatpkgs.BACKENDS),
+              help="Load the repositories with python3-dnf, or read their "
+                   "primary.sqlite or XML metadata directly, which does "
+                   "not need dnf but only supports the static sampledata.")
+@click.option('--filelists', default=None,
+              type=click.Choice(whatpkgs.sqliterepo.FILELISTS_MODES),
+              help="Satisfy file dependencies with only the files listed in "
+                   "the primary metadata, or with every file from the "
+                   "filelists metadata, loaded up front (full) or when the "
+                   "first file dependency is looked up (lazy). Defaults to "
+                   "full with the dnf backend, which loads the filelists "
+                   "anyway, and to primary otherwise.")
+@click.option('--cache/--no-cache', default=True,
+              help="Reuse the on-disk cache of the static sampledata. It is "
+                   "regenerated automatically whenever the repodata "
+                   "changes.")
+@click.option('--rebuild-cache/--no-rebuild-cache', default=False,
+              help="Discard the on-disk cache of the static sampledata and "
+                   "regenerate it.")
+@click.option('--from-file', default=None, metavar="PATH",
+              help="Also read package names from the file at PATH, one per "
+                   "line, or from standard input if PATH is '-'. Blank "
+                   "lines and lines starting with '#' are skipped.")
+@click.option('--processes', default=NUM_PROCS, type=int,
+              help="Number of worker processes to use. Defaults to the "
+                   "number of online processors.")
 @click.option('--path', default="./%s" % time.asctime())
-def neededtoselfhost(pkgnames, hint, recommends, full_name,
-                     pick_first, sources, system, rhel, path):
-
-    def selfhost_worker():
-        while True:
-            item = q.get()
-            if item is None:
-                break
-
-            binary_pkgs = {}
-            source_pkgs = {}
-            ambiguities = []
-
-            pkg = whatpkgs.get_pkg_by_name(query, item["pkg_name"])
-
-            whatpkgs.recurse_self_host(pkg, binary_pkgs, source_pkgs,
-                                       ambiguities, query, hint,
-                                       pick_first, recommends)
-
-            f = open(item["output_file"], 'w')
-
-            if sources:
-                for key in sorted(source_pkgs, key=source_pkgs.get):
-                    # Skip the initial package
-                    if key == item["pkg_name"]:
-                        continue
-                    print_package_name(f, key, source_pkgs, full_name)
-            else:
-                for key in sorted(binary_pkgs, key=binary_pkgs.get):
-                    print_package_name(f, key, binary_pkgs, full_name)
-
-            q.task_done()
-
-    os.mkdir(path)
-
-    query = whatpkgs.get_query_object(system, rhel)
-
-    q = queue.Queue()
-    threads = []
-    for i in range(NUM_PROCS):
-        t = threading.Thread(target=selfhost_worker)
-        t.start()
-        threads.append(t)
-
-    for pkgname in pkgnames:
-        output_file = os.path.join(path, pkgname)
-        temp = {"pkg_name": pkgname,
-                "output_file": output_file}
-        q.put(temp)
-
-    q.join()
-
-    # stop workers
-    for i in range(NUM_PROCS):
-        q.put(None)
-    for t in threads:
-        t.join()
+def neededtoselfhost(pkgnames, hint, recommends, merge, compare_serial,
+                     full_name, pick_first, sources, filter, whatreqs,
+                     system, rhel, version, backend, filelists, cache,
+                     rebuild_cache, from_file, processes, path):
+    """
+    Look up the build dependencies for each specified package and all of
+    their dependencies, and write them to one file per package in --path.
+
+    The repositories are loaded once and shared copy-on-write with forked
+    worker processes, which each take the next package from a shared queue
+    as soon as they become idle.
+
+    With --merge, the combined closure of all packages is computed by the
+    worker processes level by level and printed instead.
+    """
+    global _state
+
+    if not merge:
+        os.mkdir(path)
+
+    query = whatpkgs.get_query_object(system, rhel, version,
+                                      cache, rebuild_cache, backend,
+                                      filelists)
+    # Build the indexes before forking so the workers share them
+    query.build_indexes()
+
+    _state = {"query": query,
+              "hint": hint,
+              "filter": filter,
+              "whatreqs": whatreqs,
+              "pick_first": pick_first,
+              "recommends": recommends,
+              "sources": sources,
+              "full_name": full_name,
+              "graph": None}
+
+    pkgnames = whatpkgs.with_names_from_file(pkgnames, from_file)
+
+    if merge:
+        roots = [pkg for (pkgname, pkg) in
+                 whatpkgs.get_pkgs_by_name(query, pkgnames, filter)]
+
+        ctx = multiprocessing.get_context("fork")
+        start = time.time()
+        with ctx.Pool(processes) as pool:
+            (binary_pkgs, source_pkgs, ambiguities) = \
+                merged_self_host(pool, processes, roots)
+        parallel_time = time.time() - start
+
+        if sources:
+            for key in sorted(source_pkgs, key=source_pkgs.get):
+                print_package_name(sys.stdout, key, source_pkgs, full_name)
+        else:
+            for key in sorted(binary_pkgs, key=binary_pkgs.get):
+                print_package_name(sys.stdout, key, binary_pkgs, full_name)
+        if len(ambiguities) > 0:
+            print(Fore.RED + Back.BLACK +
+                  "=== Unresolved Requirements ===" +
+                  Style.RESET_ALL)
+            pp = pprint.PrettyPrinter(indent=4)
+            pp.pprint(list(ambiguities))
+
+        if compare_serial:
+            compare_with_serial(query, roots, binary_pkgs, source_pkgs,
+                                parallel_time, processes)
+        return
+
+    items = ((pkgname, os.path.join(path, pkgname))
+             for pkgname in pkgnames if pkgname not in filter)
+
+    failed = False
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(processes) as pool:
+        for (pkgname, error) in pool.imap_unordered(selfhost_worker, items):
+            if error:
+                print("Failed to process %s: %s" % (pkgname, error),
+                      file=sys.stderr)
+                failed = True
+
+    if failed:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
@@ -5,19 +5,89 @@ Tool for interacting with python3-dnf to get complicated dependency
 information from yum/dnf repodata.
 """
 
+import atexit
+import collections
+import contextlib
+import functools
+import gc
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import os
 import platform
+import shutil
+import socket
+import socketserver
 import sys
+import tempfile
+import time
+import traceback
 import pprint
-import dnf
+import re
+import resource
 import click
 from colorama import Fore, Back, Style
+from xml.etree import ElementTree
+
+import pkggraph
+import sqliterepo
+import xmlrepo
+
+try:
+    import dnf
+except ImportError:
+    # Only the sqlite and xml backends can be used
+    dnf = None
 
 multi_arch = None
 primary_arch = platform.machine()
 if primary_arch == "x86_64":
     multi_arch = "i686"
 
+# Architectures searched for dependencies, in order of preference
+ARCH_TIERS = [arch for arch in (primary_arch, multi_arch, "noarch") if arch]
+
+RELDEP_OPERATORS = ("=", "<", ">", "<=", ">=")
+
+REPO_NS = "http://linux.duke.edu/metadata/repo"
+
+# Kinds of edges in the reverse-dependency index, with the labels they are
+# printed with. A "source" edge leads from a binary package to the Source RPM
+# it was built from.
+REVERSE_DEPENDENCY_KINDS = collections.OrderedDict([
+    ("requires", "Requires"),
+    ("requires_pre", "Requires(pre)"),
+    ("recommends", "Recommends"),
+    ("buildrequires", "BuildRequires"),
+    ("source", "Source"),
+])
+
+# A package name in the epoch:name-version-release.arch form
+FULL_NAME_RE = re.compile(r"^\d+:.+-[^-]+-[^-]+\.[^.]+$")
+
+# Ways of loading the repositories: with python3-dnf, or by reading their
+# primary.sqlite metadata (see sqliterepo.py) or their XML metadata (see
+# xmlrepo.py) directly
+BACKENDS = ("dnf", "sqlite", "xml")
+DEFAULT_BACKEND = "dnf" if dnf is not None else "sqlite"
+
+# Marker written into a sack cache directory once it is fully populated
+CACHE_STAMP = ".whatpkgs-complete"
+
+# (query object, backend, filelists mode) of each repo set loaded by the
+# resolver daemon, keyed by repo set name. This is None unless running as
+# "whatpkgs.py serve".
+_resident_queries = None
+
+# Statistics of the running subcommand (see Stats). This is None unless
+# --stats or --stats-json was given.
+_stats = None
+
+# Number of requirements listed by --stats as the slowest to resolve
+STATS_SLOWEST_REQUIREMENTS = 10
+
 def splitFilename(filename):
     """
     Pass in a standard style rpm fullname
@@ -69,7 +139,19 @@ class TooManyPackagesException(Exception):
                            "Too many packages returned for %s" % pkgname)
 
 
-def _setup_static_repo(base, reponame, path):
+class PackageLookupException(click.ClickException):
+    """
+    Exception class collecting every requested package that could not be
+    resolved to exactly one package. It is a ClickException so that the
+    list is shown as an error message rather than a traceback.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        click.ClickException.__init__(
+            self, "\n".join(str(error) for error in errors))
+
+
+def _setup_static_repo(base, reponame, path, expire=True):
     repo = dnf.repo.Repo(reponame, base.conf)
 
     repo.mirrorlist = None
@@ -84,94 +166,1000 @@ def _setup_static_repo(base, reponame, path):
     base.repos.add(repo)
     repo.load()
     repo.enable()
-    repo._md_expire_cache()
+    if expire:
+        repo._md_expire_cache()
+
+
+def _get_static_repos(use_rhel, version="25"):
+    """
+    Determine the static sampledata repositories to load
+
+    Returns: tuple of a short name for the repository set and a list of
+             (reponame, path) tuples
+    """
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+
+    if use_rhel:
+        # Load the static data for RHEL
+        return ("rhel7.3beta", [
+            ("static-rhel7.3beta-binary",
+             os.path.join(dir_path,
+                 "sampledata/repodata/RHEL-7/7.3-Beta/Server/%s/os/" %
+                 primary_arch)),
+            ("static-rhel7.3beta-optional-binary",
+             os.path.join(dir_path,
+                 "sampledata/repodata/RHEL-7/7.3-Beta/Server-optional/%s/os/" %
+                 primary_arch)),
+            ("static-rhel7.3beta-source",
+             os.path.join(dir_path,
+                 "sampledata/repodata/RHEL-7/7.3-Beta/Server/source/tree/")),
+            ("static-rhel7.3beta-optional-source",
+             os.path.join(dir_path,
+                 "sampledata/repodata/RHEL-7/7.3-Beta/Server-optional/source"
+                 "/tree/")),
+        ])
+
+    # Load the static data for Fedora
+    return ("f%s" % version, [
+        ("static-f%s-beta-binary" % version,
+         os.path.join(dir_path,
+            "sampledata/repodata/fedora/linux/development/%s/Everything/%s/"
+            "/os" % (version, primary_arch))),
+        ("static-f%s-beta-source" % version,
+         os.path.join(dir_path,
+            "sampledata/repodata/fedora/linux/development/%s/Everything/source"
+            "/tree/" % version)),
+        # Add override repositories for modularity
+        ("static-gencore-override-f%s-binary" % version,
+         os.path.join(dir_path,
+            "sampledata/repodata/fedora/linux/development/%s/gencore-override"
+            "/%s/os" % (version, primary_arch))),
+        ("static-gencore-override-source",
+         os.path.join(dir_path,
+            "sampledata/repodata/fedora/linux/development/%s/gencore-override"
+            "/source/tree/" % version)),
+    ])
+
+
+def _get_repomd_checksums(path):
+    """
+    Read the checksums of all metadata listed in a repository's repomd.xml
+
+    Returns: sorted list of (type, checksum) tuples
+    """
+    repomd = os.path.join(path, "repodata", "repomd.xml")
+    checksums = []
+    for data in ElementTree.parse(repomd).getroot().findall(
+            "{%s}data" % REPO_NS):
+        checksum = data.find("{%s}checksum" % REPO_NS)
+        checksums.append((data.get("type"), checksum.text.strip()))
+    return sorted(checksums)
+
+
+def _get_cache_key(repos):
+    """
+    Compute a key identifying the exact content of a set of repositories
+    """
+    digest = hashlib.sha256()
+    digest.update(primary_arch.encode("utf-8"))
+    for (reponame, path) in repos:
+        digest.update(reponame.encode("utf-8"))
+        for (mdtype, checksum) in _get_repomd_checksums(path):
+            digest.update(("%s:%s" % (mdtype, checksum)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _get_cache_dir(setname, repos, rebuild):
+    """
+    Locate the on-disk sack cache for this set of repositories.
+
+    Stale caches for the same set (from older repodata) are removed, as is
+    the current one if a rebuild was requested.
+
+    Returns: tuple of the cache directory and whether it is already populated
+    """
+    cache_root = os.path.join(
+        os.environ.get("XDG_CACHE_HOME",
+                       os.path.join(os.path.expanduser("~"), ".cache")),
+        "whatpkgs")
+    cache_dir = os.path.join(cache_root, "%s-%s" % (
+        setname, _get_cache_key(repos)[:16]))
+
+    if os.path.isdir(cache_root):
+        for entry in os.listdir(cache_root):
+            stale = os.path.join(cache_root, entry)
+            if entry.startswith(setname + "-") and stale != cache_dir:
+                shutil.rmtree(stale, ignore_errors=True)
+
+    if rebuild:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    populated = os.path.exists(os.path.join(cache_dir, CACHE_STAMP))
+    os.makedirs(cache_dir, exist_ok=True)
+    return (cache_dir, populated)
 
 
-def setup_repo(use_system, use_rhel, version="25"):
+def setup_repo(use_system, use_rhel, version="25",
+               use_cache=True, rebuild_cache=False):
     """
     Enable only the official Fedora repositories
 
+    When using the static sampledata, the prepared sack is cached on disk
+    keyed by the checksums in each repository's repomd.xml, so that it only
+    has to be regenerated when the repodata changes.
+
     Returns: dnf.Base containing all the package metadata from the standard
              repositories for binary RPMs
     """
+    if dnf is None:
+        raise click.ClickException(
+            "python3-dnf is not installed; use --backend=sqlite instead")
+
+    start = time.time()
     base = dnf.Base()
+    cache_state = "system"
+    tmp_cache_dir = None
 
     if use_system:
-        base.read_all_repos()
-        repo = base.repos.all()
-        repo.disable()
-        repo = base.repos.get_matching("fedora")
-        repo.enable()
-        repo = base.repos.get_matching("updates")
-        repo.enable()
-        repo = base.repos.get_matching("fedora-source")
-        repo.enable()
-        repo = base.repos.get_matching("updates-source")
-        repo.enable()
-
-    elif use_rhel:
-        # Load the static data for RHEL
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        repo_path = os.path.join(dir_path,
-            "sampledata/repodata/RHEL-7/7.3-Beta/Server/%s/os/" % primary_arch)
-        _setup_static_repo(base, "static-rhel7.3beta-binary", repo_path)
-
-        repo_path = os.path.join(dir_path,
-            "sampledata/repodata/RHEL-7/7.3-Beta/Server-optional/%s/os/" %
-                                 primary_arch)
-        _setup_static_repo(base,
-                           "static-rhel7.3beta-optional-binary",
-                           repo_path)
-
-        repo_path = os.path.join(dir_path,
-            "sampledata/repodata/RHEL-7/7.3-Beta/Server/source/tree/")
-        _setup_static_repo(base, "static-rhel7.3beta-source", repo_path)
-
-        repo_path = os.path.join(dir_path,
-            "sampledata/repodata/RHEL-7/7.3-Beta/Server-optional/source/tree/")
-        _setup_static_repo(base,
-                           "static-rhel7.3beta-optional-source",
-                           repo_path)
+        with stats_phase("setup_repos"):
+            base.read_all_repos()
+            repo = base.repos.all()
+            repo.disable()
+            repo = base.repos.get_matching("fedora")
+            repo.enable()
+            repo = base.repos.get_matching("updates")
+            repo.enable()
+            repo = base.repos.get_matching("fedora-source")
+            repo.enable()
+            repo = base.repos.get_matching("updates-source")
+            repo.enable()
 
     else:
-        # Load the static data for Fedora
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        repo_path = os.path.join(dir_path,
-           "sampledata/repodata/fedora/linux/development/%s/Everything/%s/"
-           "/os" % (version, primary_arch))
-        _setup_static_repo(base, "static-f%s-beta-binary" % version, repo_path)
-
-        repo_path = os.path.join(dir_path,
-           "sampledata/repodata/fedora/linux/development/%s/Everything/source"
-           "/tree/" % version)
-        _setup_static_repo(base, "static-f%s-beta-source" % version, repo_path)
+        (setname, repos) = _get_static_repos(use_rhel, version)
 
-        # Add override repositories for modularity
-        repo_path = os.path.join(dir_path,
-           "sampledata/repodata/fedora/linux/development/%s/gencore-override"
-           "/%s/os" % (version, primary_arch))
-        _setup_static_repo(base,
-                           "static-gencore-override-f%s-binary" % version,
-                           repo_path)
-
-        repo_path = os.path.join(dir_path,
-           "sampledata/repodata/fedora/linux/development/%s/gencore-override"
-           "/source/tree/" % version)
-        _setup_static_repo(base, "static-gencore-override-source", repo_path)
-
-    base.fill_sack(load_system_repo=False, load_available_repos=True)
+        if use_cache:
+            (cache_dir, populated) = _get_cache_dir(setname, repos,
+                                                    rebuild_cache)
+            cache_state = "hit" if populated else "miss"
+        else:
+            # Build the sack in a scratch directory and throw it away
+            tmp_cache_dir = tempfile.mkdtemp(prefix="whatpkgs-")
+            cache_dir = tmp_cache_dir
+            cache_state = "disabled"
+        base.conf.cachedir = cache_dir
+
+        with stats_phase("setup_repos"):
+            for (reponame, path) in repos:
+                _setup_static_repo(base, reponame, path,
+                                   expire=not use_cache)
+
+    with stats_phase("fill_sack"):
+        base.fill_sack(load_system_repo=False, load_available_repos=True)
+
+    if tmp_cache_dir:
+        shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+    elif cache_state == "miss":
+        open(os.path.join(cache_dir, CACHE_STAMP), "w").close()
+
+    print("Loaded repositories in %.2f seconds (cache: %s)" % (
+        time.time() - start, cache_state), file=sys.stderr)
     return base
 
 
-def get_query_object(use_system, use_rhel, version):
+def setup_sqlite_repo(use_system, use_rhel, version="25",
+                      use_cache=True, rebuild_cache=False,
+                      filelists="primary"):
+    """
+    Load the static sampledata by reading the primary.sqlite database of
+    each repository directly, without dnf. Unless 'filelists' is "primary",
+    the filelists.sqlite databases are read too.
+
+    The databases are decompressed into the same on-disk cache directory
+    that the dnf backend uses, so that happens only once per repodata.
+
+    Returns: sqliterepo.Sack of all the packages in the repositories
+    """
+    if use_system:
+        raise click.ClickException(
+            "The sqlite backend cannot load the system repositories; "
+            "use --backend=dnf instead")
+
+    start = time.time()
+    (setname, repos) = _get_static_repos(use_rhel, version)
+
+    tmp_cache_dir = None
+    if use_cache:
+        (cache_dir, populated) = _get_cache_dir(setname, repos,
+                                                rebuild_cache)
+        db_dir = os.path.join(cache_dir, "sqlite")
+        os.makedirs(db_dir, exist_ok=True)
+    else:
+        tmp_cache_dir = db_dir = tempfile.mkdtemp(prefix="whatpkgs-")
+        # The filelists databases may only be decompressed later on
+        atexit.register(shutil.rmtree, tmp_cache_dir, ignore_errors=True)
+
+    try:
+        with stats_phase("fill_sack"):
+            sack = sqliterepo.Sack(repos, db_dir, filelists)
+    except sqliterepo.RepodataException as e:
+        raise click.ClickException(str(e))
+
+    if tmp_cache_dir:
+        cache_state = "disabled"
+    else:
+        cache_state = "miss" if sack.decompressed else "hit"
+
+    print("Loaded repositories in %.2f seconds (cache: %s)" % (
+        time.time() - start, cache_state), file=sys.stderr)
+    return sack
+
+
+def setup_xml_repo(use_system, use_rhel, version="25", filelists="primary"):
+    """
+    Load the static sampledata by stream-parsing the primary.xml.gz metadata
+    of each repository directly, without dnf. Unless 'filelists' is
+    "primary", the filelists.xml.gz metadata is parsed too.
+
+    Nothing is cached: the metadata is parsed again on every run.
+
+    Returns: xmlrepo.Sack of all the packages in the repositories
+    """
+    if use_system:
+        raise click.ClickException(
+            "The xml backend cannot load the system repositories; "
+            "use --backend=dnf instead")
+
+    start = time.time()
+    (setname, repos) = _get_static_repos(use_rhel, version)
+
+    try:
+        with stats_phase("fill_sack"):
+            sack = xmlrepo.Sack(repos, filelists)
+    except sqliterepo.RepodataException as e:
+        raise click.ClickException(str(e))
+
+    print("Loaded repositories in %.2f seconds (cache: disabled)" % (
+        time.time() - start), file=sys.stderr)
+    return sack
+
+
+def package_key(pkg):
+    """
+    Get a key that identifies a package within the sack and, unlike the
+    package object itself, can be sent to another process
+    """
+    return (pkg.name, pkg.epoch, pkg.version, pkg.release, pkg.arch,
+            pkg.reponame)
+
+
+def _split_reldep(reldep):
+    """
+    Split a dependency string into its name and whether it carries a
+    version comparison.
+
+    Returns: tuple of (name, versioned), or None if the dependency is not a
+             simple name (rich dependencies and file paths)
+    """
+    if reldep.startswith("(") or reldep.startswith("/"):
+        return None
+
+    parts = reldep.split(" ")
+    if len(parts) == 3 and parts[1] in RELDEP_OPERATORS:
+        return (parts[0], True)
+    if len(parts) == 1:
+        return (reldep, False)
+    return None
+
+
+def _split_file_reldep(reldep):
+    """
+    Get the path required by a file dependency, or None if the dependency
+    is not a plain path
+    """
+    if reldep.startswith("/") and " " not in reldep:
+        return reldep
+    return None
+
+
+def _latest_packages(pkgs):
+    """
+    Narrow a list of packages to the latest version of each name, the way
+    query.filter(latest=True) does. When the same version is available from
+    more than one repository, only the first one seen is kept.
+    """
+    latest = collections.OrderedDict()
+    for pkg in pkgs:
+        best = latest.get(pkg.name)
+        if best is None or pkg.evr_cmp(best) > 0:
+            latest[pkg.name] = pkg
+
+    return list(latest.values())
+
+
+class IndexedQuery(object):
+    """
+    Wrapper around a hawkey query object for the whole sack, carrying lookup
+    indexes that are built on first use.
+
+    Anything other than the index lookups is passed through to the query
+    object, so it can be used anywhere a query is expected.
+    """
+    def __init__(self, query, filelists="primary"):
+        """
+        With the "primary" filelists mode, file dependencies are only
+        satisfied by the files that the primary metadata lists, whatever
+        the backend loaded.
+        """
+        self.query = query
+        self.primary_files_only = filelists == "primary"
+        self._provides = None
+        self._latest_provides = None
+        # Packages providing each path, as a file or an explicit Provides,
+        # keyed by (path, arch)
+        self._files = None
+
+        # Latest packages, keyed by (name, arch)
+        self._names = None
+        # Every package, keyed by package_key()
+        self._keys = None
+        # Every package, keyed by (name, epoch, version, release, arch)
+        self._nevras = None
+
+        # Memoized results of whatprovides(), keyed by (reldep, arch)
+        self._resolved = {}
+        self.resolve_hits = 0
+        self.resolve_misses = 0
+
+        # Source package name for each sourcerpm filename
+        self._source_names = {}
+        # Latest source packages, keyed by name
+        self._sources = None
+        # Latest binary packages, keyed by the name of their source package
+        self._binaries = None
+        # (package, kind, requirement) of everything that requires a
+        # package, keyed by the package_key() of the required package
+        self._reverse = None
+
+    def __getattr__(self, name):
+        return getattr(self.query, name)
+
+    def __iter__(self):
+        return iter(self.query)
+
+    def __len__(self):
+        return len(self.query)
+
+    def build_indexes(self):
+        """
+        Build every index up front rather than on first use, for example
+        before forking processes that should share them.
+        """
+        self.get_package(None)
+        self.get_packages_by_nevra(None, None, None, None, None)
+        self.get_latest_by_name(None, None)
+        if self._provides is None:
+            self._build_provides_index()
+        if self._files is None:
+            self._build_file_index()
+        self.get_source_packages("")
+        self.get_binary_packages(None)
+
+    def get_package(self, key):
+        """
+        Find the package identified by a package_key()
+        """
+        if self._keys is None:
+            self._keys = {}
+            for pkg in self.query:
+                self._keys[package_key(pkg)] = pkg
+
+        return self._keys.get(key)
+
+    def get_packages_by_nevra(self, name, epoch, version, release, arch):
+        """
+        Find the packages with exactly this name, epoch, version, release
+        and architecture, in any repository
+        """
+        if self._nevras is None:
+            self._nevras = {}
+            for pkg in self.query:
+                self._nevras.setdefault(package_key(pkg)[:5], []).append(pkg)
+
+        return self._nevras.get((name, epoch, version, release, arch), [])
+
+    def get_latest_by_name(self, name, arch):
+        """
+        Find the latest packages with this name and architecture. This is
+        equivalent to query.filter(name=name, latest=True, arch=arch)
+        """
+        if self._names is None:
+            with stats_phase("build_indexes"):
+                self._names = {}
+                for pkg in self.query:
+                    self._names.setdefault((pkg.name, pkg.arch),
+                                           []).append(pkg)
+                for key in self._names:
+                    self._names[key] = _latest_packages(self._names[key])
+
+        return self._names.get((name, arch), [])
+
+    def _filter(self, query, label, **kwargs):
+        """
+        Call query.filter(), counting the call for --stats under the label
+        of the architecture (or list of them) that is being searched
+        """
+        if _stats is not None:
+            if isinstance(label, list):
+                label = ",".join(label)
+            _stats.filter_calls[label] += 1
+        return query.filter(**kwargs)
+
+    def _build_provides_index(self):
+        with stats_phase("build_indexes"):
+            self._provides = {}
+            for pkg in self._filter(self.query, ARCH_TIERS, arch=ARCH_TIERS):
+                for provide in pkg.provides:
+                    split = _split_reldep(str(provide))
+                    if split is None:
+                        continue
+                    candidates = self._provides.setdefault(
+                        (split[0], pkg.arch), [])
+                    if not candidates or candidates[-1] is not pkg:
+                        candidates.append(pkg)
+
+            self._latest_provides = {}
+            for key in self._provides:
+                self._latest_provides[key] = _latest_packages(
+                    self._provides[key])
+
+    def _build_file_index(self):
+        """
+        Index the packages by the paths they provide. Only file dependencies
+        use this index, so the files of the packages are only read once one
+        of them is looked up.
+        """
+        with stats_phase("build_indexes"):
+            self._files = {}
+            for pkg in self._filter(self.query, ARCH_TIERS, arch=ARCH_TIERS):
+                paths = [str(provide).split(" ")[0]
+                         for provide in pkg.provides
+                         if str(provide).startswith("/")]
+                if self.primary_files_only:
+                    paths.extend(
+                        filename for filename in pkg.files
+                        if sqliterepo.PRIMARY_FILE_RE.search(filename))
+                else:
+                    paths.extend(pkg.files)
+
+                for path in paths:
+                    candidates = self._files.setdefault((path, pkg.arch), [])
+                    if not candidates or candidates[-1] is not pkg:
+                        candidates.append(pkg)
+
+    def whatprovides(self, require, arch):
+        """
+        Find the latest packages of the given architecture that satisfy the
+        requirement. This is equivalent to
+        query.filter(provides=require, latest=True, arch=arch)
+
+        Results are memoized for the lifetime of the object. Only the raw
+        candidate list is stored; --hint and --filter are applied by the
+        caller, so the returned list must not be modified.
+        """
+        key = (str(require), arch)
+        if _stats is not None:
+            _stats.lookups[arch] += 1
+        try:
+            required_packages = self._resolved[key]
+            self.resolve_hits += 1
+            return required_packages
+        except KeyError:
+            self.resolve_misses += 1
+
+        return self._resolve_timed(key, require, arch)
+
+    def _resolve_timed(self, key, require, arch):
+        """
+        Resolve and memoize a requirement, adding the time it took to the
+        statistics. The index it needs is built beforehand, so that its time
+        only counts in the build_indexes phase.
+        """
+        self._prepare_index(key[0], arch)
+        start = _stats.clock() if _stats is not None else None
+        required_packages = self._whatprovides(require, arch)
+        self._resolved[key] = required_packages
+        if _stats is not None:
+            _stats.require_times[key[0]] += _stats.clock() - start
+        return required_packages
+
+    def _prepare_index(self, require, arch):
+        """
+        Build the index that _whatprovides() uses for this requirement, if
+        it is not built yet
+        """
+        if arch not in ARCH_TIERS:
+            return
+        if _split_file_reldep(require) is not None:
+            if self._files is None:
+                self._build_file_index()
+        elif _split_reldep(require) is not None and self._provides is None:
+            self._build_provides_index()
+
+    def _whatprovides(self, require, arch):
+        path = _split_file_reldep(str(require))
+        if path is not None and arch in ARCH_TIERS:
+            if self._files is None:
+                self._build_file_index()
+            return _latest_packages(self._files.get((path, arch), []))
+
+        split = _split_reldep(str(require))
+        if split is None or arch not in ARCH_TIERS:
+            return list(self._filter(self.query, arch, provides=require,
+                                     latest=True, arch=arch))
+
+        if self._provides is None:
+            self._build_provides_index()
+
+        (name, versioned) = split
+        if not versioned:
+            return list(self._latest_provides.get((name, arch), []))
+
+        # Only check the version range against the packages that provide
+        # this name at all
+        candidates = self._provides.get((name, arch))
+        if not candidates:
+            return []
+        return list(self._filter(self.query, arch, pkg=candidates,
+                                 provides=require, latest=True))
+
+    def whatprovides_many(self, requires, arch):
+        """
+        Resolve a batch of requirements at once, returning one list of
+        packages per requirement, in the same order as whatprovides() would.
+
+        Requirements already memoized cost a dict lookup. Rich and
+        versioned file dependencies that are not yet memoized are resolved
+        together: a single query finds every package that satisfies any of
+        them, and each requirement is then only checked against those
+        packages. For --stats, the time of that single query is shared
+        equally between them.
+        """
+        keys = [(str(require), arch) for require in requires]
+        if _stats is not None:
+            _stats.lookups[arch] += len(keys)
+
+        missing = collections.OrderedDict()
+        for (key, require) in zip(keys, requires):
+            if key in self._resolved or key in missing:
+                self.resolve_hits += 1
+            else:
+                self.resolve_misses += 1
+                missing[key] = require
+
+        unindexed = []
+        for (key, require) in missing.items():
+            if arch in ARCH_TIERS and (
+                    _split_reldep(key[0]) is not None or
+                    _split_file_reldep(key[0]) is not None):
+                self._resolve_timed(key, require, arch)
+            else:
+                unindexed.append((key, require))
+
+        if len(unindexed) == 1:
+            (key, require) = unindexed[0]
+            self._resolve_timed(key, require, arch)
+        elif unindexed:
+            clock = _stats.clock if _stats is not None else time.time
+            start = clock()
+            providers = self._filter(
+                self.query, arch,
+                provides=[require for (key, require) in unindexed],
+                arch=arch)
+            shared = (clock() - start) / len(unindexed)
+            for (key, require) in unindexed:
+                start = clock()
+                if len(providers) == 0:
+                    self._resolved[key] = []
+                else:
+                    self._resolved[key] = list(self._filter(
+                        providers, arch, provides=require, latest=True))
+                if _stats is not None:
+                    _stats.require_times[key[0]] += (clock() - start +
+                                                     shared)
+
+        return [self._resolved[key] for key in keys]
+
+    def get_source_name(self, sourcerpm):
+        """
+        Get the base name of a sourcerpm filename
+        """
+        try:
+            return self._source_names[sourcerpm]
+        except KeyError:
+            (sourcename, _, _, _, _) = splitFilename(sourcerpm)
+            self._source_names[sourcerpm] = sourcename
+            return sourcename
+
+    def get_source_packages(self, sourcerpm):
+        """
+        Find the latest source packages with the same name as the sourcerpm
+        filename. This is equivalent to
+        query.filter(name=sourcename, latest=True, arch='src')
+        """
+        if self._sources is None:
+            with stats_phase("build_indexes"):
+                self._sources = {}
+                for pkg in self._filter(self.query, 'src', arch='src'):
+                    self._sources.setdefault(pkg.name, []).append(pkg)
+                for name in self._sources:
+                    self._sources[name] = _latest_packages(
+                        self._sources[name])
+
+        return self._sources.get(self.get_source_name(sourcerpm), [])
+
+    def get_binary_packages(self, sourcename):
+        """
+        Find the latest binary packages built from the named source package
+        """
+        if self._binaries is None:
+            with stats_phase("build_indexes"):
+                self._binaries = {}
+                for pkg in self._filter(self.query, ARCH_TIERS, latest=True,
+                                        arch=ARCH_TIERS):
+                    if not pkg.sourcerpm:
+                        continue
+                    self._binaries.setdefault(
+                        self.get_source_name(pkg.sourcerpm), []).append(pkg)
+
+        return self._binaries.get(sourcename, [])
+
+    def _add_reverse_dependencies(self, pkg, kinds, requires):
+        providers = get_providers_many(self, requires)
+        for (require, kind, required_packages) in zip(requires, kinds,
+                                                      providers):
+            for rpkg in required_packages:
+                key = package_key(rpkg)
+                if key != package_key(pkg):
+                    self._reverse.setdefault(key, []).append(
+                        (pkg, kind, require))
+
+    def _build_reverse_index(self):
+        with stats_phase("build_indexes"):
+            self._fill_reverse_index()
+
+    def _fill_reverse_index(self):
+        self._reverse = {}
+
+        for pkg in self._filter(self.query, ARCH_TIERS, latest=True,
+                                arch=ARCH_TIERS):
+            requires = list(pkg.requires)
+            requires_pre = list(pkg.requires_pre)
+            recommends = list(pkg.recommends)
+            kinds = (["requires"] * len(requires) +
+                     ["requires_pre"] * len(requires_pre) +
+                     ["recommends"] * len(recommends))
+            self._add_reverse_dependencies(
+                pkg, kinds, requires + requires_pre + recommends)
+
+            if pkg.sourcerpm:
+                for source_pkg in self.get_source_packages(pkg.sourcerpm):
+                    self._reverse.setdefault(
+                        package_key(source_pkg), []).append(
+                            (pkg, "source", None))
+
+        for source_pkg in self._filter(self.query, 'src', latest=True,
+                                       arch='src'):
+            buildrequires = list(source_pkg.requires)
+            self._add_reverse_dependencies(
+                source_pkg, ["buildrequires"] * len(buildrequires),
+                buildrequires)
+
+    def get_requiring_packages(self, pkg):
+        """
+        Find the latest packages that depend on this package: the binary
+        packages whose Requires, Requires(pre) or Recommends it satisfies,
+        the Source RPMs whose BuildRequires it satisfies and, for a Source
+        RPM, the binary packages built from it.
+
+        Requirements are resolved as get_providers() would, but without
+        choosing between multiple providers, so every candidate is
+        considered to be required.
+
+        Returns: list of (package, kind, requirement) tuples, where kind is
+        one of REVERSE_DEPENDENCY_KINDS and requirement is None for the
+        "source" kind
+        """
+        if self._reverse is None:
+            self._build_reverse_index()
+
+        return self._reverse.get(package_key(pkg), [])
+
+
+class Stats(object):
+    """
+    Timings and counters collected during one subcommand for --stats and
+    --stats-json.
+
+    Phases are timed as they are entered, so a phase that runs inside
+    another one (building an index during the traversal, for example) is
+    counted in both.
+
+    'printed' tells whether the report is written to stderr (--stats),
+    rather than only to a JSON file.
+
+    Garbage collections are timed as the "gc" phase and left out of the
+    requirement times, since each of them falls on whichever requirement
+    happens to be resolved at the time.
+    """
+    def __init__(self, command, printed=False):
+        self.command = command
+        self.printed = printed
+        self.start = time.time()
+        self.phases = collections.OrderedDict()
+        self.counters = collections.Counter()
+        # query.filter() calls, keyed by the architectures they were
+        # restricted to
+        self.filter_calls = collections.Counter()
+        # Requirement lookups (including the memoized ones), keyed by the
+        # architecture searched
+        self.lookups = collections.Counter()
+        # Time spent resolving each requirement, across architectures
+        self.require_times = collections.Counter()
+        self.gc_time = 0.0
+        self._gc_start = None
+        self.query = None
+        self.hits = 0
+        self.misses = 0
+
+    def gc_callback(self, phase, info):
+        if phase == "start":
+            self._gc_start = time.time()
+        elif self._gc_start is not None:
+            self.gc_time += time.time() - self._gc_start
+            self._gc_start = None
+
+    def clock(self):
+        """
+        Get the time, not counting the garbage collections
+        """
+        return time.time() - self.gc_time
+
+    def set_query(self, query):
+        """
+        Report the requirement cache counters of this query, from their
+        current values on
+        """
+        self.query = query
+        self.hits = query.resolve_hits
+        self.misses = query.resolve_misses
+
+    def as_dict(self):
+        slowest = heapq.nlargest(STATS_SLOWEST_REQUIREMENTS,
+                                 self.require_times.items(),
+                                 key=lambda item: item[1])
+        result = collections.OrderedDict([
+            ("command", self.command),
+            ("wall_time", round(time.time() - self.start, 6)),
+            ("phases", collections.OrderedDict(
+                [(name, round(seconds, 6))
+                 for (name, seconds) in self.phases.items()] +
+                [("gc", round(self.gc_time, 6))])),
+            ("counters", dict(self.counters)),
+            ("filter_calls", dict(self.filter_calls)),
+            ("lookups", dict(self.lookups)),
+            ("peak_rss_kib",
+             resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+            ("slowest_requirements", [
+                {"require": require, "seconds": round(seconds, 6)}
+                for (require, seconds) in slowest]),
+        ])
+        if self.query is not None:
+            result["requirement_cache"] = {
+                "hits": self.query.resolve_hits - self.hits,
+                "misses": self.query.resolve_misses - self.misses}
+        return result
+
+    def report(self, stream):
+        """
+        Write the statistics in a human-readable form
+        """
+        stats = self.as_dict()
+        print("=== Statistics for %s ===" % stats["command"], file=stream)
+        print("Wall time: %.3fs" % stats["wall_time"], file=stream)
+        for (name, seconds) in stats["phases"].items():
+            print("Phase %s: %.3fs" % (name, seconds), file=stream)
+        for name in sorted(stats["counters"]):
+            print("%s: %d" % (name.replace("_", " ").capitalize(),
+                              stats["counters"][name]), file=stream)
+        for arch in sorted(stats["lookups"]):
+            print("Requirement lookups (%s): %d" % (
+                arch, stats["lookups"][arch]), file=stream)
+        for arch in sorted(stats["filter_calls"]):
+            print("Query filter calls (%s): %d" % (
+                arch, stats["filter_calls"][arch]), file=stream)
+        if "requirement_cache" in stats:
+            print("Requirement cache: %d hits, %d misses" % (
+                stats["requirement_cache"]["hits"],
+                stats["requirement_cache"]["misses"]), file=stream)
+        print("Peak RSS: %.1f MiB" % (stats["peak_rss_kib"] / 1024.0),
+              file=stream)
+        for entry in stats["slowest_requirements"]:
+            print("Slow requirement: %.3fs %s" % (entry["seconds"],
+                                                  entry["require"]),
+                  file=stream)
+
+
+def start_stats(enabled, json_path):
+    """
+    Start collecting statistics for the current subcommand if --stats or
+    --stats-json was given. They are reported when the subcommand ends,
+    even if it fails.
+    """
+    global _stats
+
+    _stats = None
+    if not enabled and json_path is None:
+        return
+
+    ctx = click.get_current_context()
+    _stats = Stats(ctx.info_name, enabled)
+    gc.callbacks.append(_stats.gc_callback)
+
+    def finish():
+        global _stats
+
+        stats, _stats = _stats, None
+        gc.callbacks.remove(stats.gc_callback)
+        if enabled:
+            stats.report(sys.stderr)
+        if json_path is not None:
+            with open(json_path, "w") as f:
+                json.dump(stats.as_dict(), f, indent=4)
+                f.write("\n")
+
+    ctx.call_on_close(finish)
+
+
+@contextlib.contextmanager
+def stats_phase(name):
+    """
+    Add the time spent in the body of the with statement to the named phase
+    """
+    if _stats is None:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        _stats.phases[name] = (_stats.phases.get(name, 0.0) +
+                               time.time() - start)
+
+
+def count_stat(name, amount=1):
+    if _stats is not None:
+        _stats.counters[name] += amount
+
+
+def print_resolution_stats(query, hits, misses):
+    """
+    Report how well the requirement cache performed since the counters were
+    at 'hits' and 'misses'. With --stats, the report already includes them.
+    """
+    if _stats is not None and _stats.printed:
+        return
+    print("Requirement cache: %d hits, %d misses" % (
+        query.resolve_hits - hits, query.resolve_misses - misses),
+          file=sys.stderr)
+
+
+def get_providers_many(query, requires):
+    """
+    Find the packages satisfying each of a list of requirements, with the
+    same architecture preference as get_providers(). Every architecture is
+    searched once for all of the requirements still unsatisfied.
+
+    Returns: a list of package lists, one for each requirement
+    """
+    providers = [[] for require in requires]
+    pending = list(range(len(requires)))
+
+    for arch in ARCH_TIERS:
+        if not pending:
+            break
+        found = query.whatprovides_many([requires[i] for i in pending], arch)
+        unresolved = []
+        for (i, required_packages) in zip(pending, found):
+            if len(required_packages) > 0:
+                providers[i] = required_packages
+            else:
+                unresolved.append(i)
+        pending = unresolved
+
+    return providers
+
+
+def get_providers(query, require):
+    """
+    Find the packages satisfying a requirement, preferring primary_arch, then
+    multi_arch and finally noarch packages.
+    """
+    for arch in ARCH_TIERS:
+        required_packages = query.whatprovides(require, arch)
+        if len(required_packages) > 0:
+            return required_packages
+
+    return []
+
+
+def _get_repo_set_name(use_system, use_rhel, version):
+    """
+    Get a short name identifying the repositories selected by the options
+    """
+    if use_system:
+        return "system"
+    return _get_static_repos(use_rhel, version)[0]
+
+
+def default_filelists(backend):
+    """
+    Get the filelists mode used when none is given: dnf always loads the
+    filelists, so file dependencies are satisfied by every file with it,
+    while the other backends only read the primary metadata by default.
+    """
+    return "full" if backend == "dnf" else "primary"
+
+
+def get_query_object(use_system, use_rhel, version,
+                     use_cache=True, rebuild_cache=False,
+                     backend=DEFAULT_BACKEND, filelists=None):
     """
     Get query objects for binary packages and source packages
 
+    The repositories are loaded with the given backend, one of BACKENDS,
+    and the given filelists mode, one of sqliterepo.FILELISTS_MODES, or
+    default_filelists() if it is None. dnf always loads the filelists
+    itself, so there "full" and "lazy" are the same. When running inside the resolver daemon, the query object that
+    was loaded at startup is returned instead, as long as it was loaded
+    with the same backend and filelists mode. It is never reloaded, so
+    --rebuild-cache cannot be honoured there.
+
     Returns: query object for source and binaries
     """
-    base = setup_repo(use_system, use_rhel, version)
+    if filelists is None:
+        filelists = default_filelists(backend)
+
+    if _resident_queries is not None:
+        setname = _get_repo_set_name(use_system, use_rhel, version)
+        if setname not in _resident_queries:
+            raise click.ClickException(
+                "Repository set %s is not loaded by this server" % setname)
+        (query, loaded_backend, loaded_filelists) = _resident_queries[setname]
+        if (backend, filelists) != (loaded_backend, loaded_filelists):
+            raise click.ClickException(
+                "Repository set %s is loaded by this server with "
+                "--backend=%s --filelists=%s" % (setname, loaded_backend,
+                                                 loaded_filelists))
+        if rebuild_cache:
+            raise click.ClickException(
+                "The server does not reload its repositories; restart it "
+                "with --rebuild-cache instead")
+    elif backend == "sqlite":
+        sack = setup_sqlite_repo(use_system, use_rhel, version,
+                                 use_cache, rebuild_cache, filelists)
+        query = IndexedQuery(sack.query(), filelists)
+    elif backend == "xml":
+        sack = setup_xml_repo(use_system, use_rhel, version, filelists)
+        query = IndexedQuery(sack.query(), filelists)
+    else:
+        base = setup_repo(use_system, use_rhel, version,
+                          use_cache, rebuild_cache)
+        query = IndexedQuery(base.sack.query(), filelists)
 
-    return base.sack.query()
+    if _stats is not None:
+        _stats.set_query(query)
+    return query
 
 
 def get_pkg_by_name(q, pkgname, arch=None):
@@ -181,60 +1169,93 @@ def get_pkg_by_name(q, pkgname, arch=None):
     packages that match the name, it will throw an error.
     """
 
-    # If we were requested to search for a specific architecture
     if arch:
-        matched = q.filter(name=pkgname, latest=True, arch=arch)
-        if len(matched) > 1:
-            raise TooManyPackagesException(pkgname)
-        if len(matched) == 1:
-            # Exactly one package matched.
-            return matched[0]
-        raise NoSuchPackageException(pkgname)
-
-    # Otherwise, check the primary arch, multi-arch and noarch packages
-    matched = q.filter(name=pkgname, latest=True, arch=primary_arch)
-    if len(matched) > 1:
-        raise TooManyPackagesException(pkgname)
-
-    if len(matched) == 1:
-        # Exactly one package matched. We'll prioritize the archful package if
-        # the same package would satisfy a multi-arch version as well.
+        # If we were requested to search for a specific architecture
+        arches = [arch]
+    else:
+        # Otherwise, check the primary arch, multi-arch and noarch packages.
+        # We'll prioritize the archful package if the same package would
+        # satisfy a multi-arch version as well.
         # Technically it's possible for there to also be a noarch package
         # with the same name, which is an edge case I'm not optimizing for
         # yet.
-        return matched[0]
+        arches = ARCH_TIERS
 
-    if multi_arch:
-        matched = q.filter(name=pkgname, latest=True, arch=multi_arch)
+    for search_arch in arches:
+        matched = q.get_latest_by_name(pkgname, search_arch)
         if len(matched) > 1:
             raise TooManyPackagesException(pkgname)
 
         if len(matched) == 1:
             # Exactly one package matched
-            # Technically it's possible for there to also be a noarch package
-            # with the same name, which is an edge case I'm not optimizing for
-            # yet.
             return matched[0]
 
-    matched = q.filter(name=pkgname, latest=True, arch='noarch')
-    if len(matched) > 1:
-        raise TooManyPackagesException(pkgname)
-
-    if len(matched) == 1:
-        # Exactly one package matched
-        return matched[0]
     raise NoSuchPackageException(pkgname)
 
 
+def get_pkg_by_nevra(q, fullpkgname):
+    """
+    Find the package given as epoch:name-version-release.arch, as printed
+    by --full-name. If the same build is in more than one repository, the
+    first one found is returned.
+    """
+    (name, version, release, epoch, arch) = splitFilename(fullpkgname)
+    matched = q.get_packages_by_nevra(name, int(epoch or 0), version,
+                                      release, arch)
+    if len(matched) == 0:
+        raise NoSuchPackageException(fullpkgname)
+
+    return matched[0]
+
+
+@stats_phase("resolve_toplevel")
+def get_pkgs_by_name(q, fullpkgnames, filters=None):
+    """
+    Look up every name or name#arch in the list with get_pkg_by_name(),
+    skipping the names listed in 'filters'. Names in the full
+    epoch:name-version-release.arch form are looked up exactly with
+    get_pkg_by_nevra() instead.
+
+    Rather than stopping at the first name that cannot be resolved, all of
+    them are collected and reported together in a PackageLookupException.
+
+    Returns: list of (pkgname, package) tuples in the order given
+    """
+    pkgs = []
+    errors = []
+    for fullpkgname in fullpkgnames:
+        if _is_nevra(fullpkgname):
+            pkgname = splitFilename(fullpkgname)[0]
+            lookup = functools.partial(get_pkg_by_nevra, q, fullpkgname)
+        else:
+            (pkgname, arch) = _split_pkgname(fullpkgname)
+            lookup = functools.partial(get_pkg_by_name, q, pkgname, arch)
+
+        if filters and pkgname in filters:
+            # Skip this if we explicitly filtered it out
+            continue
+
+        try:
+            pkgs.append((pkgname, lookup()))
+        except (NoSuchPackageException, TooManyPackagesException) as e:
+            errors.append(e)
+
+    if errors:
+        raise PackageLookupException(errors)
+
+    return pkgs
+
+
 def get_srpm_for_package(query, pkg):
-    # Get just the base name of the SRPM
+    count_stat("srpm_lookups")
+
+    # Look up the SRPM by its base name
     try:
-        (sourcename, _, _, _, _) = splitFilename(pkg.sourcerpm)
+        matched = query.get_source_packages(pkg.sourcerpm)
     except Exception:
         print("Failure: %s(%s)" % (pkg.sourcerpm, pkg.name))
         raise
 
-    matched = query.filter(name=sourcename, latest=True, arch='src')
     if len(matched) > 1:
         raise TooManyPackagesException(pkg.name)
 
@@ -253,10 +1274,14 @@ def get_srpm_for_package_name(query, pkgname):
 
     return get_srpm_for_package(query, pkg)
 
-def append_requirement(reqs, parent, pkg, filters, whatreqs):
+def append_requirement(reqs, parent, pkg, filters, whatreqs,
+                       require=None, reasons=None):
     """
     Check if this package is in the filter list. If it is, then
     do not add it to the list of packages to recurse into.
+
+    If 'reasons' is a list, the requirement that pulled the package in is
+    appended to it alongside the package.
     """
     if whatreqs is not None and pkg.name in whatreqs:
         print("%s is pulled in by %s" % (pkg.name, parent.name),
@@ -264,27 +1289,28 @@ def append_requirement(reqs, parent, pkg, filters, whatreqs):
 
     if filters is None or pkg.name not in filters:
         reqs.append(pkg)
+        if reasons is not None:
+            reasons.append(require)
 
 def get_requirements(parent, reqs, dependencies, ambiguities,
-                     query, hints, filters, whatreqs, pick_first):
+                     query, hints, filters, whatreqs, pick_first,
+                     providers=None, reporter=None, reasons=None):
     """
     Share code for recursing into requires or recommends
+
+    If the requirements were already resolved by get_providers_many(), the
+    result can be passed as 'providers'.
+
+    If 'reporter' is given, it is told about every requirement without a
+    provider and every ambiguity found. If 'reasons' is a list, the
+    requirement matched by each returned package is appended to it.
     """
     requirements = []
 
-    for require in reqs:
-        required_packages = query.filter(provides=require, latest=True,
-                                         arch=primary_arch)
+    if providers is None:
+        providers = get_providers_many(query, reqs)
 
-        # Check for multi-arch packages satisfying it
-        if len(required_packages) == 0 and multi_arch:
-            required_packages = query.filter(provides=require, latest=True,
-                                             arch=multi_arch)
-
-        # Check for noarch packages satisfying it
-        if len(required_packages) == 0:
-            required_packages = query.filter(provides=require, latest=True,
-                                             arch='noarch')
+    for (require, required_packages) in zip(reqs, providers):
 
         # If there are no dependencies, just return
         if len(required_packages) == 0:
@@ -293,6 +1319,9 @@ def get_requirements(parent, reqs, dependencies, ambiguities,
                 parent.name, parent.version,
                 parent.release, parent.arch),
                   file=sys.stderr)
+            count_stat("missing_providers")
+            if reporter is not None:
+                reporter.miss(parent, require)
             continue
 
         # Check for multiple possible packages
@@ -305,7 +1334,8 @@ def get_requirements(parent, reqs, dependencies, ambiguities,
                         # This has been disambiguated; use this one
                         found = True
                         append_requirement(requirements, parent, rpkg,
-                                           filters, whatreqs)
+                                           filters, whatreqs,
+                                           require, reasons)
                         break
                 if found:
                     # Don't keep looking once we find a match
@@ -314,9 +1344,9 @@ def get_requirements(parent, reqs, dependencies, ambiguities,
             if not found:
                 if pick_first:
                     # First try to use something we've already discovered
-                    for rpkg in required_packages:
-                        if rpkg.name in dependencies:
-                            return
+                    if any(rpkg.name in dependencies
+                           for rpkg in required_packages):
+                        continue
 
                     # The user instructed processing to just take the first
                     # entry in the list.
@@ -324,7 +1354,8 @@ def get_requirements(parent, reqs, dependencies, ambiguities,
                         if rpkg.arch == 'noarch' or rpkg.arch == \
                                 primary_arch or rpkg.arch == multi_arch:
                             append_requirement(requirements, parent, rpkg,
-                                               filters, whatreqs)
+                                               filters, whatreqs,
+                                               require, reasons)
                             break
                     continue
                 # Packages not solved by 'hints' list
@@ -333,164 +1364,991 @@ def get_requirements(parent, reqs, dependencies, ambiguities,
                 for rpkg in required_packages:
                     unresolved["%s#%s" % (rpkg.name, rpkg.arch)] = rpkg
                 ambiguities.append(unresolved)
+                count_stat("ambiguities")
+                if reporter is not None:
+                    reporter.ambiguity(parent, require, unresolved)
 
             continue
 
         # Exactly one package matched, so proceed down into it.
         append_requirement(requirements, parent, required_packages[0],
-                           filters, whatreqs)
+                           filters, whatreqs, require, reasons)
 
     return requirements
 
 
-def recurse_package_deps(pkg, dependencies, ambiguities,
-                         query, hints, filters, whatreqs,
-                         pick_first, follow_recommends):
-    """
-    Recursively search through dependencies and add them to the list
+def get_package_requirements(pkg, dependencies, ambiguities,
+                             query, hints, filters, whatreqs,
+                             pick_first, follow_recommends,
+                             reporter=None, reasons=None):
     """
-    depname = "%s#%s" % (pkg.name, pkg.arch)
-    if depname in dependencies:
-        # Don't recurse the same dependency twice
-        return
-    dependencies[depname] = pkg
+    Resolve the Requires, Requires(pre|post) and optionally the Recommends
+    of a binary package
 
-    # Process Requires:
-    deps = get_requirements(pkg, pkg.requires, dependencies,
-                            ambiguities, query, hints,
-                            filters, whatreqs,
-                            pick_first)
+    All of them are resolved in a single batch before being processed in
+    turn, so the diagnostics come out in the same order as before.
 
+    'reporter' and 'reasons' are passed on to get_requirements().
+    """
+    requires = list(pkg.requires)
     try:
-        # Process Requires(pre|post)
-        prereqs = get_requirements(pkg, pkg.requires_pre, dependencies,
-                                   ambiguities, query, hints,
-                                   filters, whatreqs,
-                                   pick_first)
-        deps.extend(prereqs)
+        requires_pre = list(pkg.requires_pre)
     except AttributeError:
         print("DNF 2.x required.", file=sys.stderr)
         sys.exit(1)
+    recommends = list(pkg.recommends) if follow_recommends else []
+
+    providers = get_providers_many(query,
+                                   requires + requires_pre + recommends)
+    pre_start = len(requires)
+    rec_start = pre_start + len(requires_pre)
+
+    # Process Requires:
+    deps = get_requirements(pkg, requires, dependencies,
+                            ambiguities, query, hints,
+                            filters, whatreqs,
+                            pick_first, providers[:pre_start],
+                            reporter, reasons)
+
+    # Process Requires(pre|post)
+    prereqs = get_requirements(pkg, requires_pre, dependencies,
+                               ambiguities, query, hints,
+                               filters, whatreqs,
+                               pick_first, providers[pre_start:rec_start],
+                               reporter, reasons)
+    deps.extend(prereqs)
 
     if follow_recommends:
-        recommends = get_requirements(pkg, pkg.recommends, dependencies,
-                                      ambiguities, query, hints,
-                                      filters, whatreqs,
-                                      pick_first)
-        deps.extend(recommends)
+        recs = get_requirements(pkg, recommends, dependencies,
+                                ambiguities, query, hints,
+                                filters, whatreqs,
+                                pick_first, providers[rec_start:],
+                                reporter, reasons)
+        deps.extend(recs)
+
+    return deps
+
+
+@stats_phase("traversal")
+def walk_dependencies(roots, binaries, ambiguities,
+                      query, hints, filters, whatreqs,
+                      pick_first, follow_recommends,
+                      sources=None, breadth_first=False, depths=None,
+                      source_depths=None, stop_at=None, reporter=None):
+    """
+    Walk the dependency closure of the root packages with an explicit
+    worklist, adding every binary package reached to 'binaries'.
 
-    for dep in deps:
-        recurse_package_deps(dep, dependencies, ambiguities, query,
-                             hints, filters, whatreqs,
-                             pick_first, follow_recommends)
+    If 'sources' is a dict, the walk also follows the BuildRequires of the
+    Source RPM of every binary package and records those Source RPMs there.
 
+    The walk is depth-first by default, visiting packages in the same order
+    as a recursive search would. With breadth_first, packages are visited in
+    order of their distance from the roots, which is recorded in 'depths'
+    (and in 'source_depths' for the Source RPMs) if it is a dict.
 
-def recurse_self_host(binary_pkg, binaries, sources,
-                      ambiguities, query, hints,
-                      filters, whatreqs,
-                      pick_first, follow_recommends):
-    """
-    Recursively determine all build dependencies for this package
+    If 'stop_at' is given, the walk ends as soon as a package whose name or
+    name#arch is in it has been visited.
+
+    If 'ambiguities' is an AmbiguityTracker, it is told about every package
+    as it is visited.
+
+    If 'reporter' is given (see JsonLinesReporter), it is told about every
+    package as it is visited, along with the package and the requirement
+    that pulled it in, and about every ambiguity and missing provider.
+
+    Returns: the package that ended the walk early, or None
     """
+    resolve_ambiguity = getattr(ambiguities, "resolve", None)
 
-    depname = "%s#%s" % (binary_pkg.name, binary_pkg.arch)
-    if depname in binaries:
-        # Don't process the same binary RPM twice
-        return
+    if breadth_first:
+        worklist = collections.deque((pkg, 0, None, None) for pkg in roots)
+        take = worklist.popleft
+    else:
+        worklist = [(pkg, 0, None, None) for pkg in reversed(list(roots))]
+        take = worklist.pop
 
-    binaries[depname] = binary_pkg
+    while worklist:
+        (pkg, depth, parent, require) = take()
 
-    # Process strict Requires:
-    deps = get_requirements(binary_pkg, binary_pkg.requires, binaries,
-                            ambiguities, query, hints,
-                            filters, whatreqs, pick_first)
+        depname = "%s#%s" % (pkg.name, pkg.arch)
+        if depname in binaries:
+            # Don't process the same binary RPM twice
+            continue
+        binaries[depname] = pkg
+        count_stat("binaries_visited")
 
-    # Process Requires(pre|post):
-    prereqs = get_requirements(binary_pkg, binary_pkg.requires_pre,
-                               binaries, ambiguities, query, hints,
-                               filters, whatreqs, pick_first)
-    deps.extend(prereqs)
+        if resolve_ambiguity is not None:
+            resolve_ambiguity(depname)
 
-    if follow_recommends:
-        # Process Recommends:
-        recommends = get_requirements(binary_pkg, binary_pkg.recommends,
-                                      binaries, ambiguities, query, hints,
-                                      filters, whatreqs, pick_first)
-        deps.extend(recommends)
+        if depths is not None:
+            depths[depname] = depth
+
+        if reporter is not None:
+            reporter.package(pkg, depth, parent, require)
+
+        if stop_at is not None and (pkg.name in stop_at or
+                                    depname in stop_at):
+            return pkg
+
+        reasons = [] if reporter is not None else None
+        deps = get_package_requirements(pkg, binaries, ambiguities,
+                                        query, hints, filters, whatreqs,
+                                        pick_first, follow_recommends,
+                                        reporter, reasons)
+        parents = [pkg] * len(deps)
+
+        if sources is not None:
+            # Now get the build dependencies for this package
+            source_pkg = get_srpm_for_package(query, pkg)
+
+            if source_pkg.name not in sources:
+                # Don't process the same Source RPM twice
+                sources[source_pkg.name] = source_pkg
+                count_stat("sources_visited")
+
+                if source_depths is not None:
+                    source_depths[source_pkg.name] = depth
 
-    # Now get the build dependencies for this package
-    source_pkg = get_srpm_for_package(query, binary_pkg)
+                if reporter is not None:
+                    reporter.source(source_pkg, depth, pkg)
 
-    if source_pkg.name not in sources:
-        # Don't process the same Source RPM twice
-        sources[source_pkg.name] = source_pkg
+                # Get the BuildRequires for this Source RPM
+                buildreqs = get_requirements(source_pkg, source_pkg.requires,
+                                             binaries, ambiguities, query,
+                                             hints, filters, whatreqs,
+                                             pick_first, None,
+                                             reporter, reasons)
+                deps.extend(buildreqs)
+                parents.extend([source_pkg] * len(buildreqs))
 
-        # Get the BuildRequires for this Source RPM
-        buildreqs = get_requirements(source_pkg, source_pkg.requires,
-                                     binaries, ambiguities, query, hints,
-                                     filters, whatreqs, pick_first)
-        deps.extend(buildreqs)
+        if reasons is None:
+            reasons = [None] * len(deps)
+        edges = list(zip(deps, parents, reasons))
+        if not breadth_first:
+            edges.reverse()
+        worklist.extend((dep, depth + 1, parent, require)
+                        for (dep, parent, require) in edges)
 
-    for dep in deps:
-        recurse_self_host(dep, binaries, sources, ambiguities, query, hints,
-                          filters, whatreqs, pick_first, follow_recommends)
+    return None
 
 
-def print_package_name(pkgname, dependencies, full):
+def recurse_package_deps(pkg, dependencies, ambiguities,
+                         query, hints, filters, whatreqs,
+                         pick_first, follow_recommends):
     """
-    Parse the package name for the error state and
-    print it with the correct verbosity.
+    Search through dependencies and add them to the list
     """
+    walk_dependencies([pkg], dependencies, ambiguities, query,
+                      hints, filters, whatreqs,
+                      pick_first, follow_recommends)
 
-    printpkg = dependencies[pkgname]
 
-    if full:
-        print("%d:%s-%s-%s.%s" % (printpkg.epoch,
-                                  printpkg.name,
-                                  printpkg.version,
-                                  printpkg.release,
-                                  printpkg.arch))
-    else:
-        if printpkg.arch == multi_arch:
-            print("%s#%s" % (printpkg.name, printpkg.arch))
-        else:
-            print("%s" % printpkg.name)
+def recurse_self_host(binary_pkg, binaries, sources,
+                      ambiguities, query, hints,
+                      filters, whatreqs,
+                      pick_first, follow_recommends):
+    """
+    Determine all build dependencies for this package
+    """
+    walk_dependencies([binary_pkg], binaries, ambiguities, query,
+                      hints, filters, whatreqs,
+                      pick_first, follow_recommends,
+                      sources=sources)
 
 
-def resolve_ambiguity(dependencies, ambiguity):
+@stats_phase("traversal")
+def walk_reverse_dependencies(query, targets, kinds):
     """
-    Determine if any of the contents of an ambiguous lookup
-    is already resolved by something in the dependencies.
+    Walk the reverse-dependency index breadth-first from the target
+    packages, following only the edges whose kind is in 'kinds'.
+
+    Returns: tuple of
+      - dict of every package that depends on a target, directly or
+        indirectly, keyed by package_key()
+      - dict of the number of dependency steps from each of those packages
+        (and from the targets themselves) to the nearest target
+      - dict of the (package, kind, requirement) edges through which each
+        package is one step closer to a target, for shortest_paths()
     """
-    for key in sorted(ambiguity, key=ambiguity.get):
-        if key in dependencies:
-            return True
-    return False
+    found = collections.OrderedDict()
+    distances = dict((package_key(pkg), 0) for pkg in targets)
+    next_hops = {}
 
+    worklist = collections.deque(targets)
+    while worklist:
+        pkg = worklist.popleft()
+        distance = distances[package_key(pkg)]
 
-def _split_pkgname(name):
-    splitname = name.rsplit("#", 2)
-    pkgname = splitname[0]
-    arch = None
-    if len(splitname) > 1:
-        arch = splitname[1]
+        for (rpkg, kind, require) in query.get_requiring_packages(pkg):
+            if kind not in kinds:
+                continue
 
-    return (pkgname, arch)
+            key = package_key(rpkg)
+            if key not in distances:
+                distances[key] = distance + 1
+                found[key] = rpkg
+                worklist.append(rpkg)
+                count_stat("sources_visited" if rpkg.arch == "src" else
+                           "binaries_visited")
 
+            if distances[key] == distance + 1:
+                next_hops.setdefault(key, []).append((pkg, kind, require))
 
-@click.group()
-def main():
-    pass
+    return (found, distances, next_hops)
 
 
-@main.command(short_help="Get package dependencies")
-@click.argument('pkgnames', nargs=-1)
-@click.option('--hint', multiple=True,
-              help="""
-Specify a package to be selected when more than one package could satisfy a
-dependency. This option may be specified multiple times.
+def shortest_paths(root, next_hops, limit=None):
+    """
+    List every shortest path from the root package to the targets of a
+    walk_reverse_dependencies(), stopping after 'limit' paths.
 
-For example, it is recommended to use --hint=glibc-minimal-langpack
+    Returns: list of paths, each a list starting with the root and followed
+    by (package, kind, requirement) steps
+    """
+    paths = []
+    worklist = [[root]]
+    while worklist and (limit is None or len(paths) < limit):
+        path = worklist.pop()
+        last = path[-1] if len(path) == 1 else path[-1][0]
+
+        hops = next_hops.get(package_key(last))
+        if not hops:
+            paths.append(path)
+            continue
+
+        for hop in reversed(hops):
+            worklist.append(path + [hop])
+
+    return paths
+
+
+def format_dependency_path(path, full):
+    """
+    Format a path from shortest_paths() on a single line
+    """
+    line = format_package_name(path[0], full)
+    for (pkg, kind, require) in path[1:]:
+        label = REVERSE_DEPENDENCY_KINDS[kind]
+        if require is not None:
+            label = "%s: %s" % (label, require)
+        line += " --[%s]--> %s" % (label, format_package_name(pkg, full))
+    return line
+
+
+def format_package_name(printpkg, full):
+    """
+    Format the package name with the correct verbosity
+    """
+    if full:
+        return "%d:%s-%s-%s.%s" % (printpkg.epoch,
+                                   printpkg.name,
+                                   printpkg.version,
+                                   printpkg.release,
+                                   printpkg.arch)
+
+    if printpkg.arch == multi_arch:
+        return "%s#%s" % (printpkg.name, printpkg.arch)
+    return "%s" % printpkg.name
+
+
+def print_package_name(pkgname, dependencies, full, depths=None):
+    """
+    Parse the package name for the error state and
+    print it with the correct verbosity.
+
+    If 'depths' is given, the distance of the package from the package that
+    was queried is printed after its name, separated by a tab.
+    """
+
+    name = format_package_name(dependencies[pkgname], full)
+
+    if depths is not None:
+        print("%s\t%d" % (name, depths[pkgname]))
+    else:
+        print(name)
+
+
+def format_nevra(pkg):
+    """
+    Format the package as name-[epoch:]version-release.arch
+    """
+    epoch = "%d:" % pkg.epoch if pkg.epoch else ""
+    return "%s-%s%s-%s.%s" % (pkg.name, epoch, pkg.version, pkg.release,
+                              pkg.arch)
+
+
+class JsonLinesReporter(object):
+    """
+    Write one JSON record per line to 'stream' for every event of a
+    dependency walk, as soon as it happens.
+
+    Every record has a "type" field:
+      root:        a package whose closure follows
+      package:     a binary package was visited
+      source:      the Source RPM of a visited binary package was reached
+      ambiguity:   a requirement could be satisfied by more than one package
+      miss:        no package satisfies a requirement
+      unresolved:  an ambiguity that is still open at the end of a closure
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def _emit(self, record):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(json.dumps(record, sort_keys=True) + "\n")
+        stream.flush()
+
+    @staticmethod
+    def _describe(pkg):
+        if pkg is None:
+            return None
+        return format_nevra(pkg)
+
+    def root(self, pkg):
+        self._emit({"type": "root",
+                    "nevra": format_nevra(pkg),
+                    "repo": pkg.reponame})
+
+    def package(self, pkg, depth, parent, require):
+        self._emit({"type": "package",
+                    "nevra": format_nevra(pkg),
+                    "repo": pkg.reponame,
+                    "depth": depth,
+                    "parent": self._describe(parent),
+                    "requirement": None if require is None
+                    else str(require)})
+
+    def source(self, pkg, depth, parent):
+        self._emit({"type": "source",
+                    "nevra": format_nevra(pkg),
+                    "repo": pkg.reponame,
+                    "depth": depth,
+                    "parent": self._describe(parent)})
+
+    def ambiguity(self, parent, require, candidates):
+        self._emit({"type": "ambiguity",
+                    "parent": self._describe(parent),
+                    "requirement": str(require),
+                    "candidates": sorted(format_nevra(pkg) for pkg
+                                         in candidates.values())})
+
+    def miss(self, parent, require):
+        self._emit({"type": "miss",
+                    "parent": self._describe(parent),
+                    "requirement": str(require)})
+
+    def unresolved(self, ambiguities):
+        for ambiguity in ambiguities:
+            self._emit({"type": "unresolved",
+                        "candidates": sorted(format_nevra(pkg) for pkg
+                                             in ambiguity.values())})
+
+
+class AmbiguityTracker(object):
+    """
+    Collect the requirements that could be satisfied by more than one
+    package, in the same form as a list of {name#arch: package} dicts.
+
+    An ambiguity is dropped as soon as one of its candidates has been
+    visited, because the requirement is already satisfied by something else
+    in the dependencies. This happens when one package has an ambiguous dep
+    but another package has an explicit dep on the same package.
+    Identical ambiguities are only recorded once.
+    """
+    def __init__(self, visited):
+        self.visited = visited
+        self._unresolved = collections.OrderedDict()
+        self._by_candidate = {}
+
+    def append(self, ambiguity):
+        if any(key in self.visited for key in ambiguity):
+            return
+
+        record = frozenset(ambiguity)
+        if record in self._unresolved:
+            return
+
+        self._unresolved[record] = ambiguity
+        for key in ambiguity:
+            self._by_candidate.setdefault(key, []).append(record)
+
+    def resolve(self, depname):
+        """
+        Drop every ambiguity that the visited package depname satisfies
+        """
+        for record in self._by_candidate.pop(depname, []):
+            self._unresolved.pop(record, None)
+
+    def __iter__(self):
+        return iter(self._unresolved.values())
+
+    def __len__(self):
+        return len(self._unresolved)
+
+
+def _bit_indexes(mask):
+    """
+    Get the positions of the bits set in an integer, in ascending order
+    """
+    bits = bin(mask)[:1:-1]
+    return [i for (i, bit) in enumerate(bits) if bit == "1"]
+
+
+class DependencyGraph(object):
+    """
+    Dependency graph of every package reachable from the packages queried so
+    far, resolved once with the same options as walk_dependencies().
+
+    The graph is condensed into its strongly connected components, and the
+    closure of each component is computed once and kept as a bitmask of
+    package ids, so the closure of any package is the cached closure of its
+    component.
+
+    In the self-hosting graph, each binary package also depends on its Source
+    RPM, which in turn depends on its BuildRequires.
+
+    Note that the preference of --pick-first for already discovered packages
+    cannot depend on a particular closure here; each requirement is resolved
+    only once for the whole graph.
+    """
+    def __init__(self, query, hints, filters, whatreqs,
+                 pick_first, follow_recommends, self_host=False):
+        self.query = query
+        self.hints = hints
+        self.filters = filters
+        self.whatreqs = whatreqs
+        self.pick_first = pick_first
+        self.follow_recommends = follow_recommends
+        self.self_host = self_host
+
+        # Per package id
+        self.packages = []
+        self.is_source = []
+        self.edges = []
+        self.ambiguities = []
+        self.component = []
+
+        # Package id, keyed by name#arch for binaries and by name for
+        # sources; only the binaries are passed on as discovered packages
+        self._ids = {}
+        self._source_ids = {}
+        # Closure bitmask, per component id
+        self._closures = []
+
+    def _get_id(self, pkg, is_source):
+        if is_source:
+            (ids, key) = (self._source_ids, pkg.name)
+        else:
+            (ids, key) = (self._ids, "%s#%s" % (pkg.name, pkg.arch))
+        try:
+            return (ids[key], False)
+        except KeyError:
+            node = len(self.packages)
+            ids[key] = node
+            self.packages.append(pkg)
+            self.is_source.append(is_source)
+            self.edges.append(None)
+            self.ambiguities.append([])
+            self.component.append(None)
+            return (node, True)
+
+    def _expand(self, root):
+        """
+        Resolve the requirements of every package reachable from root that
+        has not been resolved yet
+        """
+        worklist = [root]
+        while worklist:
+            node = worklist.pop()
+            if self.edges[node] is not None:
+                continue
+
+            pkg = self.packages[node]
+            if self.is_source[node]:
+                count_stat("sources_visited")
+                # Get the BuildRequires for this Source RPM
+                deps = get_requirements(pkg, pkg.requires, self._ids,
+                                        self.ambiguities[node], self.query,
+                                        self.hints, self.filters,
+                                        self.whatreqs, self.pick_first)
+                children = [self._get_id(dep, False) for dep in deps]
+            else:
+                count_stat("binaries_visited")
+                deps = get_package_requirements(pkg, self._ids,
+                                                self.ambiguities[node],
+                                                self.query, self.hints,
+                                                self.filters, self.whatreqs,
+                                                self.pick_first,
+                                                self.follow_recommends)
+                children = [self._get_id(dep, False) for dep in deps]
+                if self.self_host:
+                    source_pkg = get_srpm_for_package(self.query, pkg)
+                    children.append(self._get_id(source_pkg, True))
+
+            self.edges[node] = [child for (child, new) in children]
+            worklist.extend(child for (child, new) in children if new)
+
+    def _condense(self, root):
+        """
+        Assign every package reachable from root that is not yet part of a
+        component to one, using an iterative version of Tarjan's algorithm.
+
+        Components are completed in reverse topological order, so the
+        closures of all of their successors are already known.
+        """
+        if self.component[root] is not None:
+            return
+
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        counter = 0
+
+        work = [(root, 0)]
+        while work:
+            (node, child_pos) = work.pop()
+            if child_pos == 0:
+                index[node] = lowlink[node] = counter
+                counter += 1
+                stack.append(node)
+                on_stack.add(node)
+
+            edges = self.edges[node]
+            recursed = False
+            while child_pos < len(edges):
+                child = edges[child_pos]
+                child_pos += 1
+                if self.component[child] is not None:
+                    # Already part of an earlier, complete component
+                    continue
+                if child not in index:
+                    work.append((node, child_pos))
+                    work.append((child, 0))
+                    recursed = True
+                    break
+                if child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            if recursed:
+                continue
+
+            if lowlink[node] == index[node]:
+                component = len(self._closures)
+                members = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    self.component[member] = component
+                    members.append(member)
+                    if member == node:
+                        break
+
+                closure = 0
+                for member in members:
+                    closure |= 1 << member
+                    for child in self.edges[member]:
+                        child_component = self.component[child]
+                        if child_component != component:
+                            closure |= self._closures[child_component]
+                self._closures.append(closure)
+
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+    @stats_phase("traversal")
+    def closure(self, pkg):
+        """
+        Get the complete dependencies of a binary package.
+
+        Returns: tuple of the binary packages keyed by name#arch, the Source
+                 RPMs keyed by name (empty unless self-hosting) and an
+                 AmbiguityTracker of the requirements left unresolved
+        """
+        (root, new) = self._get_id(pkg, False)
+        self._expand(root)
+        self._condense(root)
+
+        binaries = {}
+        sources = {}
+        members = _bit_indexes(self._closures[self.component[root]])
+        for node in members:
+            member_pkg = self.packages[node]
+            if self.is_source[node]:
+                sources[member_pkg.name] = member_pkg
+            else:
+                binaries["%s#%s" % (member_pkg.name,
+                                    member_pkg.arch)] = member_pkg
+
+        ambiguities = AmbiguityTracker(binaries)
+        for node in members:
+            for ambiguity in self.ambiguities[node]:
+                ambiguities.append(ambiguity)
+
+        return (binaries, sources, ambiguities)
+
+
+class _AmbiguityCollector(object):
+    """
+    Reporter for get_requirements() that keeps the ambiguities it is told
+    about together with the requirement they came from
+    """
+    def __init__(self):
+        self.ambiguities = []
+
+    def ambiguity(self, parent, require, candidates):
+        self.ambiguities.append((require, candidates))
+
+    def miss(self, parent, require):
+        pass
+
+
+@stats_phase("traversal")
+def export_dependency_graph(query, roots, hints, filters, pick_first,
+                            meta=None):
+    """
+    Resolve the dependency graph of every package reachable from the roots
+    through any kind of requirement, including the Source RPMs and their
+    BuildRequires, and collect it in a pkggraph.GraphWriter.
+
+    Each kind of requirement is kept apart, so the runtime and self-hosting
+    closures can both be computed from the graph. Recommends are always
+    resolved; it is up to the user of the graph whether to follow them.
+
+    Returns: the pkggraph.GraphWriter
+    """
+    writer = pkggraph.GraphWriter(meta)
+    # Binaries by name#arch, which are also the discovered packages passed
+    # to get_requirements(), and Source RPMs by name
+    ids = {}
+    source_ids = {}
+    queued = set()
+    worklist = []
+
+    def get_id(pkg, is_source=False, expand=True):
+        if is_source:
+            (known, key) = (source_ids, pkg.name)
+        else:
+            (known, key) = (ids, "%s#%s" % (pkg.name, pkg.arch))
+        node = known.get(key)
+        if node is None:
+            node = writer.add_package(pkg.name, pkg.epoch, pkg.version,
+                                      pkg.release, pkg.arch, pkg.reponame,
+                                      is_source)
+            known[key] = node
+        if expand and node not in queued:
+            queued.add(node)
+            worklist.append((node, pkg, is_source))
+        return node
+
+    for pkg in reversed(list(roots)):
+        get_id(pkg)
+
+    while worklist:
+        (node, pkg, is_source) = worklist.pop()
+        writer.set_expanded(node)
+        count_stat("sources_visited" if is_source else "binaries_visited")
+
+        if is_source:
+            groups = [("buildrequires", list(pkg.requires))]
+        else:
+            groups = [("requires", list(pkg.requires)),
+                      ("requires_pre", list(pkg.requires_pre)),
+                      ("recommends", list(pkg.recommends))]
+
+        providers = get_providers_many(
+            query, [require for (kind, reqs) in groups for require in reqs])
+        collector = _AmbiguityCollector()
+        start = 0
+        for (kind, reqs) in groups:
+            reasons = []
+            deps = get_requirements(pkg, reqs, ids, [], query, hints,
+                                    filters, None, pick_first,
+                                    providers[start:start + len(reqs)],
+                                    collector, reasons)
+            start += len(reqs)
+            for (dep, require) in zip(deps, reasons):
+                writer.add_edge(kind, node, get_id(dep), str(require))
+
+        for (require, candidates) in collector.ambiguities:
+            writer.add_ambiguity(node, str(require),
+                                 [get_id(rpkg, expand=False)
+                                  for rpkg in candidates.values()])
+
+        if not is_source:
+            try:
+                source_pkg = get_srpm_for_package(query, pkg)
+            except (NoSuchPackageException, TooManyPackagesException) as e:
+                print(e, file=sys.stderr)
+                continue
+            writer.add_edge("source", node, get_id(source_pkg, True))
+
+    return writer
+
+
+def _split_pkgname(name):
+    splitname = name.rsplit("#", 2)
+    pkgname = splitname[0]
+    arch = None
+    if len(splitname) > 1:
+        arch = splitname[1]
+
+    return (pkgname, arch)
+
+
+def _is_nevra(name):
+    """
+    Check whether a package name is in the epoch:name-version-release.arch
+    form printed by --full-name
+    """
+    return FULL_NAME_RE.match(name) is not None
+
+
+def _strip_server_option(argv):
+    """
+    Remove the --server option from a command line, and make the path given
+    to --stats-json absolute since the daemon runs in another directory.
+
+    The names read by --from-file are appended to the command line instead,
+    since the daemon can see neither the client's files nor its stdin.
+    """
+    stripped = []
+    names = []
+    skip = None
+    for arg in argv:
+        if skip == "--server":
+            skip = None
+        elif skip == "--from-file":
+            skip = None
+            names.extend(read_package_list(arg))
+        elif skip == "--stats-json":
+            skip = None
+            stripped.append(os.path.abspath(arg))
+        elif arg in ("--server", "--from-file"):
+            skip = arg
+        elif arg == "--stats-json":
+            skip = arg
+            stripped.append(arg)
+        elif arg.startswith("--from-file="):
+            names.extend(read_package_list(arg[len("--from-file="):]))
+        elif arg.startswith("--stats-json="):
+            stripped.append("--stats-json=" + os.path.abspath(
+                arg[len("--stats-json="):]))
+        elif not arg.startswith("--server="):
+            stripped.append(arg)
+
+    if names and "--" not in stripped:
+        stripped.append("--")
+    return stripped + names
+
+
+def _send_request(server, argv):
+    """
+    Send a command line to the resolver daemon and wait for its reply
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(server)
+        sock.sendall(json.dumps({"argv": argv}).encode("utf-8") + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as reply:
+            return json.loads(reply.read().decode("utf-8"))
+    finally:
+        sock.close()
+
+
+def forward_to_server(server):
+    """
+    Run the current command on the resolver daemon listening on the socket
+    at path 'server', reproduce its output and exit with its status.
+    """
+    try:
+        reply = _send_request(server, _strip_server_option(sys.argv[1:]))
+    except (OSError, ValueError) as e:
+        print("Unable to query server at %s: %s" % (server, e),
+              file=sys.stderr)
+        sys.exit(1)
+
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    sys.exit(reply["exit_code"])
+
+
+class ResolverRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Answer a single command line sent by forward_to_server()
+    """
+    def handle(self):
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        exit_code = 0
+
+        with contextlib.redirect_stdout(stdout), \
+                contextlib.redirect_stderr(stderr):
+            try:
+                request = json.loads(self.rfile.readline().decode("utf-8"))
+                argv = request["argv"]
+                if argv and argv[0] == "serve":
+                    raise click.ClickException(
+                        "Cannot start a server from within the server")
+                main.main(args=argv, prog_name="whatpkgs.py",
+                          standalone_mode=False)
+            except click.ClickException as e:
+                e.show()
+                exit_code = e.exit_code
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+
+        self.wfile.write(json.dumps({"stdout": stdout.getvalue(),
+                                     "stderr": stderr.getvalue(),
+                                     "exit_code": exit_code}).encode("utf-8"))
+
+
+def read_package_list(path):
+    """
+    Read package names from a file with one name per line, skipping blank
+    lines and comments starting with '#'. If path is '-', the names are
+    read from standard input.
+
+    The names are yielded as they are read, without holding the whole file.
+    """
+    f = sys.stdin if path == "-" else open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def with_names_from_file(names, from_file):
+    """
+    Add the names read from the --from-file PATH, if one was given, after
+    the names given on the command line
+    """
+    if from_file is None:
+        return names
+    return itertools.chain(names, read_package_list(from_file))
+
+
+# The lists a recipe can produce. Each of them is available as -short (names
+# only) and -full (epoch:name-version-release.arch).
+RECIPE_LISTS = ("toplevel-sources", "runtime-binaries", "runtime-sources",
+                "selfhost-binaries", "selfhost-sources")
+
+
+def _report_ambiguities(label, ambiguities):
+    if len(ambiguities) > 0:
+        print("=== Unresolved Requirements (%s) ===" % label,
+              file=sys.stderr)
+        pp = pprint.PrettyPrinter(indent=4, stream=sys.stderr)
+        pp.pprint(list(ambiguities))
+
+
+def run_recipe(recipe, basedir, query):
+    """
+    Compute every list requested by a recipe and write it out. Each closure
+    is computed at most once, and only if one of the outputs needs it.
+
+    Relative paths in the recipe are relative to basedir.
+    """
+    outputs = recipe.get("outputs", {})
+    for output in outputs:
+        if output.rsplit("-", 1)[0] not in RECIPE_LISTS or \
+                output.rsplit("-", 1)[-1] not in ("short", "full"):
+            raise click.ClickException("Unknown recipe output %s" % output)
+
+    def path(name):
+        return os.path.join(basedir, name)
+
+    def read_inputs(files):
+        names = []
+        for name in files:
+            names.extend(read_package_list(path(name)))
+        return names
+
+    filters = recipe.get("filters", [])
+    wanted = set(output.rsplit("-", 1)[0] for output in outputs)
+    lists = {}
+
+    toplevel = get_pkgs_by_name(query, read_inputs(recipe["inputs"]),
+                                filters)
+
+    if "toplevel-sources" in wanted:
+        lists["toplevel-sources"] = dict(
+            (srpm.name, srpm) for srpm in
+            (get_srpm_for_package(query, pkg) for (name, pkg) in toplevel))
+
+    runtime = recipe.get("runtime", {})
+    selfhost = recipe.get("selfhost", {})
+    need_runtime = bool(wanted & set(["runtime-binaries", "runtime-sources"]))
+    need_selfhost = bool(wanted & set(["selfhost-binaries",
+                                       "selfhost-sources"]))
+
+    if need_runtime or (need_selfhost and "inputs" not in selfhost):
+        binaries = {}
+        ambiguities = AmbiguityTracker(binaries)
+        walk_dependencies([pkg for (name, pkg) in toplevel], binaries,
+                          ambiguities, query, runtime.get("hints", []),
+                          filters, None, runtime.get("pick-first", False),
+                          runtime.get("recommends", False))
+        _report_ambiguities("runtime", ambiguities)
+        lists["runtime-binaries"] = binaries
+        lists["runtime-sources"] = dict(
+            (srpm.name, srpm) for srpm in
+            (get_srpm_for_package(query, pkg) for pkg in binaries.values()))
+
+    if need_selfhost:
+        if "inputs" in selfhost:
+            roots = [pkg for (name, pkg) in get_pkgs_by_name(
+                query, read_inputs(selfhost["inputs"]), filters)]
+        else:
+            # Self-host the runtime closure
+            roots = list(lists["runtime-binaries"].values())
+
+        binaries = {}
+        sources = {}
+        ambiguities = AmbiguityTracker(binaries)
+        walk_dependencies(roots, binaries, ambiguities, query,
+                          selfhost.get("hints", []), filters, None,
+                          selfhost.get("pick-first", False),
+                          selfhost.get("recommends", False),
+                          sources=sources)
+        _report_ambiguities("self-hosting", ambiguities)
+        lists["selfhost-binaries"] = binaries
+        lists["selfhost-sources"] = sources
+
+    with stats_phase("output"):
+        for (output, filename) in sorted(outputs.items()):
+            (name, form) = output.rsplit("-", 1)
+            pkgs = lists[name]
+            with open(path(filename), "w") as f:
+                for key in sorted(pkgs, key=pkgs.get):
+                    f.write("%s\n" % format_package_name(pkgs[key],
+                                                         form == "full"))
+            print("Wrote %d packages to %s" % (len(pkgs), filename),
+                  file=sys.stderr)
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command(short_help="Get package dependencies")
+@click.argument('pkgnames', nargs=-1)
+@click.option('--hint', multiple=True,
+              help="""
+Specify a package to be selected when more than one package could satisfy a
+dependency. This option may be specified multiple times.
+
+For example, it is recommended to use --hint=glibc-minimal-langpack
 """)
 @click.option('--filter', multiple=True,
               help="""
@@ -508,6 +2366,21 @@ set. This option may be specified multiple times.
 @click.option('--recommends/--no-recommends', default=True)
 @click.option('--merge/--no-merge', default=False)
 @click.option('--full-name/--no-full-name', default=False)
+@click.option('--show-depth/--no-show-depth', default=False,
+              help="""
+Walk the dependencies breadth-first and print, after each package name, the
+number of dependency steps between it and the package that first pulled it
+in, separated by a tab.
+""")
+@click.option('--format', 'output_format', default="text",
+              type=click.Choice(["text", "jsonl"]),
+              help="""
+With --format=jsonl, walk the dependencies breadth-first and write one JSON
+record per line as soon as each package is visited, instead of the sorted
+listing. Package records carry the NEVRA, repository, depth, the package that
+pulled it in and the requirement that matched; ambiguities and requirements
+without a provider have records of their own.
+""")
 @click.option('--pick-first/--no-pick-first', default=False,
               help="""
 If multiple packages could satisfy a dependency and no --hint package will
@@ -528,70 +2401,127 @@ sorted. It is recommended to use --hint instead, where practical.
 @click.option('--version', default="25",
               help="Specify the version of the OS sampledata to compare "
                    "against.")
+@click.option('--backend', default=DEFAULT_BACKEND,
+              type=click.Choice(BACKENDS),
+              help="Load the repositories with python3-dnf, or read their "
+                   "primary.sqlite or XML metadata directly, which does "
+                   "not need dnf but only supports the static sampledata.")
+@click.option('--filelists', default=None,
+              type=click.Choice(sqliterepo.FILELISTS_MODES),
+              help="Satisfy file dependencies with only the files listed in "
+                   "the primary metadata, or with every file from the "
+                   "filelists metadata, loaded up front (full) or when the "
+                   "first file dependency is looked up (lazy). Defaults to "
+                   "full with the dnf backend, which loads the filelists "
+                   "anyway, and to primary otherwise.")
+@click.option('--cache/--no-cache', default=True,
+              help="Reuse the on-disk cache of the static sampledata. It is "
+                   "regenerated automatically whenever the repodata "
+                   "changes.")
+@click.option('--rebuild-cache/--no-rebuild-cache', default=False,
+              help="Discard the on-disk cache of the static sampledata and "
+                   "regenerate it.")
+@click.option('--stats/--no-stats', default=False,
+              help="Print the time spent in each phase, the number of "
+                   "queries and lookups made and the peak memory use to "
+                   "standard error when the command ends.")
+@click.option('--stats-json', default=None, metavar="PATH",
+              help="Write the statistics printed by --stats to the file at "
+                   "PATH as JSON.")
+@click.option('--from-file', default=None, metavar="PATH",
+              help="Also read package names from the file at PATH, one per "
+                   "line, or from standard input if PATH is '-'. Blank "
+                   "lines and lines starting with '#' are skipped.")
+@click.option('--server', default=None, metavar="PATH",
+              help="Send this request to the resolver daemon listening on "
+                   "the Unix socket at PATH (see 'whatpkgs.py serve').")
 def neededby(pkgnames, hint, filter, whatreqs, recommends, merge, full_name,
-             pick_first, system, rhel, version):
+             show_depth, output_format, pick_first, system, rhel, version,
+             backend, filelists, cache, rebuild_cache, stats, stats_json,
+             from_file, server):
     """
     Look up the dependencies for each specified package and
     display them in a human-parseable format.
     """
 
-    query = get_query_object(system, rhel, version)
+    if server:
+        forward_to_server(server)
+    start_stats(stats, stats_json)
 
-    dependencies = {}
-    ambiguities = []
-    for fullpkgname in pkgnames:
-        (pkgname, arch) = _split_pkgname(fullpkgname)
+    query = get_query_object(system, rhel, version, cache, rebuild_cache,
+                             backend, filelists)
+    hits, misses = query.resolve_hits, query.resolve_misses
 
-        if pkgname in filter:
-            # Skip this if we explicitly filtered it out
-            continue
+    reporter = JsonLinesReporter() if output_format == "jsonl" else None
+    breadth_first = show_depth or reporter is not None
 
-        pkg = get_pkg_by_name(query, pkgname, arch)
-
-        if not merge:
-            # empty the dependencies list and start over
-            dependencies = {}
-            ambiguities = []
-
-        recurse_package_deps(pkg, dependencies, ambiguities, query, hint,
-                             filter, whatreqs, pick_first, recommends)
-
-        # Check for unresolved deps in the list that are present in the
-        # dependencies. This happens when one package has an ambiguous dep but
-        # another package has an explicit dep on the same package.
-        # This list comprehension just returns the set of dictionaries that
-        # are not resolved by other entries
-        ambiguities = [x for x in ambiguities
-                       if not resolve_ambiguity(dependencies, x)]
+    dependencies = {}
+    depths = {} if show_depth else None
+    ambiguities = AmbiguityTracker(dependencies)
+    graph = None
+    if not merge and not breadth_first:
+        # Resolve the shared parts of the per-package closures only once
+        graph = DependencyGraph(query, hint, filter, whatreqs,
+                                pick_first, recommends)
+
+    pkgnames = with_names_from_file(pkgnames, from_file)
+    for (pkgname, pkg) in get_pkgs_by_name(query, pkgnames, filter):
+        if reporter is not None:
+            reporter.root(pkg)
+
+        if graph is not None:
+            (dependencies, _, ambiguities) = graph.closure(pkg)
+        else:
+            if not merge:
+                # empty the dependencies list and start over
+                dependencies = {}
+                depths = {} if show_depth else None
+                ambiguities = AmbiguityTracker(dependencies)
+
+            walk_dependencies([pkg], dependencies, ambiguities, query, hint,
+                              filter, whatreqs, pick_first, recommends,
+                              breadth_first=breadth_first, depths=depths,
+                              reporter=reporter)
+
+        if reporter is not None:
+            if not merge:
+                reporter.unresolved(ambiguities)
+            continue
 
         if not merge:
             # If we're printing individually, create a header
             print(Fore.GREEN + Back.BLACK + "=== %s.%s ===" % (
                 pkg.name, pkg.arch) + Style.RESET_ALL)
 
-            # Print just this package's dependencies
-            for key in sorted(dependencies, key=dependencies.get):
-                # Skip the initial package
-                if key == pkgname:
-                    continue
-                print_package_name(key, dependencies, full_name)
+            with stats_phase("output"):
+                # Print just this package's dependencies
+                for key in sorted(dependencies, key=dependencies.get):
+                    # Skip the initial package
+                    if key == pkgname:
+                        continue
+                    print_package_name(key, dependencies, full_name, depths)
 
             if len(ambiguities) > 0:
                 print(Fore.RED + Back.BLACK + "=== Unresolved Requirements ===" +
                       Style.RESET_ALL)
                 pp = pprint.PrettyPrinter(indent=4)
-                pp.pprint(ambiguities)
+                pp.pprint(list(ambiguities))
 
-    if merge:
-        # Print the complete set of dependencies together
-        for key in sorted(dependencies, key=dependencies.get):
-            print_package_name(key, dependencies, full_name)
+    if merge and reporter is not None:
+        reporter.unresolved(ambiguities)
+    elif merge:
+        with stats_phase("output"):
+            # Print the complete set of dependencies together
+            for key in sorted(dependencies, key=dependencies.get):
+                print_package_name(key, dependencies, full_name, depths)
 
         if len(ambiguities) > 0:
             print(Fore.RED + Back.BLACK + "=== Unresolved Requirements ===" +
                   Style.RESET_ALL)
             pp = pprint.PrettyPrinter(indent=4)
-            pp.pprint(ambiguities)
+            pp.pprint(list(ambiguities))
+
+    print_resolution_stats(query, hits, misses)
 
 
 @main.command(short_help="Get Source RPM")
@@ -609,24 +2539,146 @@ def neededby(pkgnames, hint, filter, whatreqs, recommends, merge, full_name,
 @click.option('--version', default="25",
               help="Specify the version of the OS sampledata to compare "
                    "against.")
-def getsourcerpm(pkgnames, full_name, system, rhel, version):
+@click.option('--backend', default=DEFAULT_BACKEND,
+              type=click.Choice(BACKENDS),
+              help="Load the repositories with python3-dnf, or read their "
+                   "primary.sqlite or XML metadata directly, which does "
+                   "not need dnf but only supports the static sampledata.")
+@click.option('--filelists', default=None,
+              type=click.Choice(sqliterepo.FILELISTS_MODES),
+              help="Satisfy file dependencies with only the files listed in "
+                   "the primary metadata, or with every file from the "
+                   "filelists metadata, loaded up front (full) or when the "
+                   "first file dependency is looked up (lazy). Defaults to "
+                   "full with the dnf backend, which loads the filelists "
+                   "anyway, and to primary otherwise.")
+@click.option('--cache/--no-cache', default=True,
+              help="Reuse the on-disk cache of the static sampledata. It is "
+                   "regenerated automatically whenever the repodata "
+                   "changes.")
+@click.option('--rebuild-cache/--no-rebuild-cache', default=False,
+              help="Discard the on-disk cache of the static sampledata and "
+                   "regenerate it.")
+@click.option('--stats/--no-stats', default=False,
+              help="Print the time spent in each phase, the number of "
+                   "queries and lookups made and the peak memory use to "
+                   "standard error when the command ends.")
+@click.option('--stats-json', default=None, metavar="PATH",
+              help="Write the statistics printed by --stats to the file at "
+                   "PATH as JSON.")
+@click.option('--from-file', default=None, metavar="PATH",
+              help="Also read package names from the file at PATH, one per "
+                   "line, or from standard input if PATH is '-'. Blank "
+                   "lines and lines starting with '#' are skipped.")
+@click.option('--server', default=None, metavar="PATH",
+              help="Send this request to the resolver daemon listening on "
+                   "the Unix socket at PATH (see 'whatpkgs.py serve').")
+def getsourcerpm(pkgnames, full_name, system, rhel, version, backend,
+                 filelists, cache, rebuild_cache, stats, stats_json,
+                 from_file, server):
     """
     Look up the SRPMs from which these binary RPMs were generated.
 
     This list will be displayed deduplicated and sorted.
     """
-    query = get_query_object(system, rhel, version)
+    if server:
+        forward_to_server(server)
+    start_stats(stats, stats_json)
 
-    srpm_names = {}
-    for fullpkgname in pkgnames:
-        (pkgname, arch) = _split_pkgname(fullpkgname)
+    query = get_query_object(system, rhel, version, cache, rebuild_cache,
+                             backend, filelists)
 
-        pkg = get_srpm_for_package_name(query, pkgname)
+    srpm_names = {}
+    pkgnames = with_names_from_file(pkgnames, from_file)
+    for (pkgname, binary_pkg) in get_pkgs_by_name(query, pkgnames):
+        pkg = get_srpm_for_package(query, binary_pkg)
 
         srpm_names[pkg.name] = pkg
 
-    for key in sorted(srpm_names, key=srpm_names.get):
-        print_package_name(key, srpm_names, full_name)
+    with stats_phase("output"):
+        for key in sorted(srpm_names, key=srpm_names.get):
+            print_package_name(key, srpm_names, full_name)
+
+
+@main.command(short_help="Get binary RPMs")
+@click.argument('srpmnames', nargs=-1)
+@click.option('--full-name/--no-full-name', default=False)
+@click.option('--system/--no-system', default=False,
+              help="If --system is specified, use the 'fedora', 'updates', "
+                   "'source' and 'updates-source' repositories from the local "
+                   "system configuration. Otherwise, use the static data from "
+                   "the sampledata directory.")
+@click.option('--rhel/--no-rhel', default=False,
+              help="If --system is not specified, the use of --rhel will "
+                   "give back results from the RHEL sample data. Otherwise, "
+                   "Fedora sample data will be used.")
+@click.option('--version', default="25",
+              help="Specify the version of the OS sampledata to compare "
+                   "against.")
+@click.option('--backend', default=DEFAULT_BACKEND,
+              type=click.Choice(BACKENDS),
+              help="Load the repositories with python3-dnf, or read their "
+                   "primary.sqlite or XML metadata directly, which does "
+                   "not need dnf but only supports the static sampledata.")
+@click.option('--filelists', default=None,
+              type=click.Choice(sqliterepo.FILELISTS_MODES),
+              help="Satisfy file dependencies with only the files listed in "
+                   "the primary metadata, or with every file from the "
+                   "filelists metadata, loaded up front (full) or when the "
+                   "first file dependency is looked up (lazy). Defaults to "
+                   "full with the dnf backend, which loads the filelists "
+                   "anyway, and to primary otherwise.")
+@click.option('--cache/--no-cache', default=True,
+              help="Reuse the on-disk cache of the static sampledata. It is "
+                   "regenerated automatically whenever the repodata "
+                   "changes.")
+@click.option('--rebuild-cache/--no-rebuild-cache', default=False,
+              help="Discard the on-disk cache of the static sampledata and "
+                   "regenerate it.")
+@click.option('--stats/--no-stats', default=False,
+              help="Print the time spent in each phase, the number of "
+                   "queries and lookups made and the peak memory use to "
+                   "standard error when the command ends.")
+@click.option('--stats-json', default=None, metavar="PATH",
+              help="Write the statistics printed by --stats to the file at "
+                   "PATH as JSON.")
+@click.option('--from-file', default=None, metavar="PATH",
+              help="Also read package names from the file at PATH, one per "
+                   "line, or from standard input if PATH is '-'. Blank "
+                   "lines and lines starting with '#' are skipped.")
+@click.option('--server', default=None, metavar="PATH",
+              help="Send this request to the resolver daemon listening on "
+                   "the Unix socket at PATH (see 'whatpkgs.py serve').")
+def getbinaryrpms(srpmnames, full_name, system, rhel, version, backend,
+                  filelists, cache, rebuild_cache, stats, stats_json,
+                  from_file, server):
+    """
+    Look up the binary RPMs built from these SRPMs.
+
+    This list will be displayed deduplicated and sorted.
+    """
+    if server:
+        forward_to_server(server)
+    start_stats(stats, stats_json)
+
+    query = get_query_object(system, rhel, version, cache, rebuild_cache,
+                             backend, filelists)
+
+    binary_names = {}
+    for srpmname in with_names_from_file(srpmnames, from_file):
+        if _is_nevra(srpmname):
+            srpmname = splitFilename(srpmname)[0]
+
+        binaries = query.get_binary_packages(srpmname)
+        if len(binaries) == 0:
+            raise NoSuchPackageException(srpmname)
+
+        for pkg in binaries:
+            binary_names["%s#%s" % (pkg.name, pkg.arch)] = pkg
+
+    with stats_phase("output"):
+        for key in sorted(binary_names, key=binary_names.get):
+            print_package_name(key, binary_names, full_name)
 
 
 @main.command(short_help="Get build dependencies")
@@ -644,6 +2696,21 @@ dependencies of the BuildRequires.
 @click.option('--recommends/--no-recommends', default=False)
 @click.option('--merge/--no-merge', default=False)
 @click.option('--full-name/--no-full-name', default=False)
+@click.option('--show-depth/--no-show-depth', default=False,
+              help="""
+Walk the dependencies breadth-first and print, after each package name, the
+number of dependency steps between it and the package that first pulled it
+in, separated by a tab.
+""")
+@click.option('--format', 'output_format', default="text",
+              type=click.Choice(["text", "jsonl"]),
+              help="""
+With --format=jsonl, walk the dependencies breadth-first and write one JSON
+record per line as soon as each package is visited, instead of the sorted
+listing. Package records carry the NEVRA, repository, depth, the package that
+pulled it in and the requirement that matched; ambiguities and requirements
+without a provider have records of their own.
+""")
 @click.option('--sources/--no-sources', default=True)
 @click.option('--pick-first/--no-pick-first', default=False,
               help="""
@@ -678,92 +2745,179 @@ set. This option may be specified multiple times.
 @click.option('--version', default="25",
               help="Specify the version of the OS sampledata to compare "
                    "against.")
+@click.option('--backend', default=DEFAULT_BACKEND,
+              type=click.Choice(BACKENDS),
+              help="Load the repositories with python3-dnf, or read their "
+                   "primary.sqlite or XML metadata directly, which does "
+                   "not need dnf but only supports the static sampledata.")
+@click.option('--filelists', default=None,
+              type=click.Choice(sqliterepo.FILELISTS_MODES),
+              help="Satisfy file dependencies with only the files listed in "
+                   "the primary metadata, or with every file from the "
+                   "filelists metadata, loaded up front (full) or when the "
+                   "first file dependency is looked up (lazy). Defaults to "
+                   "full with the dnf backend, which loads the filelists "
+                   "anyway, and to primary otherwise.")
+@click.option('--cache/--no-cache', default=True,
+              help="Reuse the on-disk cache of the static sampledata. It is "
+                   "regenerated automatically whenever the repodata "
+                   "changes.")
+@click.option('--rebuild-cache/--no-rebuild-cache', default=False,
+              help="Discard the on-disk cache of the static sampledata and "
+                   "regenerate it.")
+@click.option('--stats/--no-stats', default=False,
+              help="Print the time spent in each phase, the number of "
+                   "queries and lookups made and the peak memory use to "
+                   "standard error when the command ends.")
+@click.option('--stats-json', default=None, metavar="PATH",
+              help="Write the statistics printed by --stats to the file at "
+                   "PATH as JSON.")
+@click.option('--from-file', default=None, metavar="PATH",
+              help="Also read package names from the file at PATH, one per "
+                   "line, or from standard input if PATH is '-'. Blank "
+                   "lines and lines starting with '#' are skipped.")
+@click.option('--server', default=None, metavar="PATH",
+              help="Send this request to the resolver daemon listening on "
+                   "the Unix socket at PATH (see 'whatpkgs.py serve').")
 def neededtoselfhost(pkgnames, hint, recommends, merge, full_name,
-                     pick_first, filter, whatreqs,
-                     sources, system, rhel, version):
+                     show_depth, output_format, sources, pick_first, filter,
+                     whatreqs, system, rhel, version, backend, filelists,
+                     cache, rebuild_cache, stats, stats_json, from_file,
+                     server):
     """
     Look up the build dependencies for each specified package
     and all of their dependencies, recursively and display them
     in a human-parseable format.
     """
 
-    query = get_query_object(system, rhel, version)
+    if server:
+        forward_to_server(server)
+    start_stats(stats, stats_json)
+
+    query = get_query_object(system, rhel, version, cache, rebuild_cache,
+                             backend, filelists)
+    hits, misses = query.resolve_hits, query.resolve_misses
+
+    reporter = JsonLinesReporter() if output_format == "jsonl" else None
+    breadth_first = show_depth or reporter is not None
 
     binary_pkgs = {}
     source_pkgs = {}
-    ambiguities = []
-    for fullpkgname in pkgnames:
-        (pkgname, arch) = _split_pkgname(fullpkgname)
-
-        if pkgname in filter:
-            # Skip this if we explicitly filtered it out
+    binary_depths = {} if show_depth else None
+    source_depths = {} if show_depth else None
+    ambiguities = AmbiguityTracker(binary_pkgs)
+    graph = None
+    if not merge and not breadth_first:
+        # Resolve the shared parts of the per-package closures only once
+        graph = DependencyGraph(query, hint, filter, whatreqs,
+                                pick_first, recommends, self_host=True)
+
+    pkgnames = with_names_from_file(pkgnames, from_file)
+    for (pkgname, pkg) in get_pkgs_by_name(query, pkgnames, filter):
+        if reporter is not None:
+            reporter.root(pkg)
+
+        if graph is not None:
+            (binary_pkgs, source_pkgs, ambiguities) = graph.closure(pkg)
+        else:
+            if not merge:
+                binary_pkgs = {}
+                source_pkgs = {}
+                binary_depths = {} if show_depth else None
+                source_depths = {} if show_depth else None
+                ambiguities = AmbiguityTracker(binary_pkgs)
+
+            walk_dependencies([pkg], binary_pkgs, ambiguities, query, hint,
+                              filter, whatreqs, pick_first, recommends,
+                              sources=source_pkgs,
+                              breadth_first=breadth_first,
+                              depths=binary_depths,
+                              source_depths=source_depths,
+                              reporter=reporter)
+
+        if reporter is not None:
+            if not merge:
+                reporter.unresolved(ambiguities)
             continue
 
-        pkg = get_pkg_by_name(query, pkgname, arch)
-
-        if not merge:
-            binary_pkgs = {}
-            source_pkgs = {}
-            ambiguities = []
-
-        recurse_self_host(pkg, binary_pkgs, source_pkgs,
-                          ambiguities, query, hint, filter,
-                          whatreqs, pick_first, recommends)
-
-        # Check for unresolved deps in the list that are present in the
-        # dependencies. This happens when one package has an ambiguous dep but
-        # another package has an explicit dep on the same package.
-        # This list comprehension just returns the set of dictionaries that
-        # are not resolved by other entries
-        # We only search the binary packages here. This is a reduction; no
-        # additional packages are discovered so we don't need to regenrate
-        # the source RPM list.
-        ambiguities = [x for x in ambiguities
-                       if not resolve_ambiguity(binary_pkgs, x)]
-
         if not merge:
             # If we're printing individually, create a header
             print(Fore.GREEN + Back.BLACK + "=== %s.%s ===" % (
                 pkg.name, pkg.arch) + Style.RESET_ALL)
 
-            # Print just this package's dependencies
-            if sources:
-                for key in sorted(source_pkgs, key=source_pkgs.get):
-                    # Skip the initial package
-                    if key == pkgname:
-                        continue
-                    print_package_name(key, source_pkgs, full_name)
-            else:
-                for key in sorted(binary_pkgs, key=binary_pkgs.get):
-                    # Skip the initial package
-                    if key == pkgname:
-                        continue
-                    print_package_name(key, binary_pkgs, full_name)
+            with stats_phase("output"):
+                # Print just this package's dependencies
+                if sources:
+                    for key in sorted(source_pkgs, key=source_pkgs.get):
+                        # Skip the initial package
+                        if key == pkgname:
+                            continue
+                        print_package_name(key, source_pkgs, full_name,
+                                           source_depths)
+                else:
+                    for key in sorted(binary_pkgs, key=binary_pkgs.get):
+                        # Skip the initial package
+                        if key == pkgname:
+                            continue
+                        print_package_name(key, binary_pkgs, full_name,
+                                           binary_depths)
 
             if len(ambiguities) > 0:
                 print(Fore.RED + Back.BLACK +
                       "=== Unresolved Requirements ===" +
                       Style.RESET_ALL)
                 pp = pprint.PrettyPrinter(indent=4)
-                pp.pprint(ambiguities)
+                pp.pprint(list(ambiguities))
 
-    if merge:
-        if sources:
-            for key in sorted(source_pkgs, key=source_pkgs.get):
-                print_package_name(key, source_pkgs, full_name)
-        else:
-            for key in sorted(binary_pkgs, key=binary_pkgs.get):
-                print_package_name(key, binary_pkgs, full_name)
+    if merge and reporter is not None:
+        reporter.unresolved(ambiguities)
+    elif merge:
+        with stats_phase("output"):
+            if sources:
+                for key in sorted(source_pkgs, key=source_pkgs.get):
+                    print_package_name(key, source_pkgs, full_name,
+                                       source_depths)
+            else:
+                for key in sorted(binary_pkgs, key=binary_pkgs.get):
+                    print_package_name(key, binary_pkgs, full_name,
+                                       binary_depths)
         if len(ambiguities) > 0:
             print(Fore.RED + Back.BLACK +
                   "=== Unresolved Requirements ===" +
                   Style.RESET_ALL)
             pp = pprint.PrettyPrinter(indent=4)
-            pp.pprint(ambiguities)
+            pp.pprint(list(ambiguities))
 
-@main.command(short_help="Debug missing Provides")
-@click.argument('requires', nargs=1)
+    print_resolution_stats(query, hits, misses)
 
+@main.command(short_help="Get reverse dependencies")
+@click.argument('pkgnames', nargs=-1)
+@click.option('--recommends/--no-recommends', default=True,
+              help="Follow Recommends: as well as Requires:.")
+@click.option('--buildrequires/--no-buildrequires', default=False,
+              help="""
+Follow BuildRequires: as well, so that a Source RPM depends on the packages
+it needs to build and the binary packages built from it depend on the Source
+RPM.
+""")
+@click.option('--merge/--no-merge', default=False)
+@click.option('--full-name/--no-full-name', default=False)
+@click.option('--show-depth/--no-show-depth', default=False,
+              help="""
+Print, after each package name, the smallest number of dependency steps
+between it and the package that was queried, separated by a tab.
+""")
+@click.option('--sources/--no-sources', default=False,
+              help="List the Source RPMs reached through --buildrequires "
+                   "instead of the binary packages.")
+@click.option('--why', multiple=True,
+              help="""
+Instead of listing everything that depends on the queried package, print
+every shortest chain of dependencies leading to it from this package. This
+option may be specified multiple times.
+""")
+@click.option('--max-paths', default=20, type=int,
+              help="Print at most this many chains for each --why package.")
 @click.option('--system/--no-system', default=False,
               help="If --system is specified, use the 'fedora', 'updates', "
                    "'source' and 'updates-source' repositories from the local "
@@ -776,29 +2930,437 @@ def neededtoselfhost(pkgnames, hint, recommends, merge, full_name,
 @click.option('--version', default="25",
               help="Specify the version of the OS sampledata to compare "
                    "against.")
-def debugprovides(requires, system, rhel, version):
-    query = get_query_object(system, rhel, version)
+@click.option('--backend', default=DEFAULT_BACKEND,
+              type=click.Choice(BACKENDS),
+              help="Load the repositories with python3-dnf, or read their "
+                   "primary.sqlite or XML metadata directly, which does "
+                   "not need dnf but only supports the static sampledata.")
+@click.option('--filelists', default=None,
+              type=click.Choice(sqliterepo.FILELISTS_MODES),
+              help="Satisfy file dependencies with only the files listed in "
+                   "the primary metadata, or with every file from the "
+                   "filelists metadata, loaded up front (full) or when the "
+                   "first file dependency is looked up (lazy). Defaults to "
+                   "full with the dnf backend, which loads the filelists "
+                   "anyway, and to primary otherwise.")
+@click.option('--cache/--no-cache', default=True,
+              help="Reuse the on-disk cache of the static sampledata. It is "
+                   "regenerated automatically whenever the repodata "
+                   "changes.")
+@click.option('--rebuild-cache/--no-rebuild-cache', default=False,
+              help="Discard the on-disk cache of the static sampledata and "
+                   "regenerate it.")
+@click.option('--stats/--no-stats', default=False,
+              help="Print the time spent in each phase, the number of "
+                   "queries and lookups made and the peak memory use to "
+                   "standard error when the command ends.")
+@click.option('--stats-json', default=None, metavar="PATH",
+              help="Write the statistics printed by --stats to the file at "
+                   "PATH as JSON.")
+@click.option('--from-file', default=None, metavar="PATH",
+              help="Also read package names from the file at PATH, one per "
+                   "line, or from standard input if PATH is '-'. Blank "
+                   "lines and lines starting with '#' are skipped.")
+@click.option('--server', default=None, metavar="PATH",
+              help="Send this request to the resolver daemon listening on "
+                   "the Unix socket at PATH (see 'whatpkgs.py serve').")
+def whatrequires(pkgnames, recommends, buildrequires, merge, full_name,
+                 show_depth, sources, why, max_paths, system, rhel, version,
+                 backend, filelists, cache, rebuild_cache, stats, stats_json,
+                 from_file, server):
+    """
+    Look up every package that depends on each specified package, directly
+    or indirectly, and display them in a human-parseable format.
 
-    required_packages = query.filter(provides=requires, latest=True,
-                                     arch=primary_arch)
+    The reverse dependencies are looked up in an index of the whole
+    repository set that is built once, so no package is resolved twice.
+    """
+    if server:
+        forward_to_server(server)
+    start_stats(stats, stats_json)
+
+    query = get_query_object(system, rhel, version, cache, rebuild_cache,
+                             backend, filelists)
+    hits, misses = query.resolve_hits, query.resolve_misses
 
-    if len(required_packages) == 0 and multi_arch:
-        required_packages = query.filter(provides=requires, latest=True,
-                                            arch=multi_arch)
+    kinds = set(["requires", "requires_pre"])
+    if recommends:
+        kinds.add("recommends")
+    if buildrequires:
+        kinds.update(["buildrequires", "source"])
 
-    if len(required_packages) == 0:
-        required_packages = query.filter(provides=requires, latest=True,
-                                            arch='noarch')
+    targets = [pkg for (pkgname, pkg) in
+               get_pkgs_by_name(query, with_names_from_file(pkgnames,
+                                                            from_file))]
+    roots = [pkg for (pkgname, pkg) in get_pkgs_by_name(query, why)]
 
+    if merge:
+        groups = [(None, targets)]
+    else:
+        groups = [(pkg, [pkg]) for pkg in targets]
 
-    # If there are no dependencies, just return
-    if len(required_packages) == 0:
-        print("No package for [%s]" % (str(requires)), file=sys.stderr)
+    for (target, group) in groups:
+        (found, distances, next_hops) = walk_reverse_dependencies(
+            query, group, kinds)
+
+        if target is not None:
+            # If we're printing individually, create a header
+            print(Fore.GREEN + Back.BLACK + "=== %s.%s ===" % (
+                target.name, target.arch) + Style.RESET_ALL)
+
+        if why:
+            for root in roots:
+                if package_key(root) not in distances:
+                    print("%s does not depend on %s" % (
+                        root.name, ", ".join(pkg.name for pkg in group)),
+                          file=sys.stderr)
+                    continue
+
+                for path in shortest_paths(root, next_hops, max_paths):
+                    print(format_dependency_path(path, full_name))
+            continue
+
+        listed = {}
+        depths = {} if show_depth else None
+        for (key, pkg) in found.items():
+            if (pkg.arch == 'src') != sources:
+                continue
+            depname = "%s#%s" % (pkg.name, pkg.arch)
+            listed[depname] = pkg
+            if depths is not None:
+                depths[depname] = distances[key]
+
+        with stats_phase("output"):
+            for key in sorted(listed, key=listed.get):
+                print_package_name(key, listed, full_name, depths)
+
+    print_resolution_stats(query, hits, misses)
+
+
+@main.command(short_help="Export the dependency graph")
+@click.argument('pkgnames', nargs=-1)
+@click.option('--output', required=True, metavar="PATH",
+              help="Write the graph to the file at PATH.")
+@click.option('--all/--no-all', 'all_packages', default=False,
+              help="Export the graph of every binary package in the "
+                   "repositories rather than of the given packages only.")
+@click.option('--hint', multiple=True,
+              help="""
+Specify a package to be selected when more than one package could satisfy a
+dependency. This option may be specified multiple times.
+""")
+@click.option('--filter', multiple=True,
+              help="""
+Specify a package to be skipped during processing. This option may be
+specified multiple times.
+""")
+@click.option('--pick-first/--no-pick-first', default=False,
+              help="""
+If multiple packages could satisfy a dependency and no --hint package will
+fulfill the requirement, automatically select one from the list.
+""")
+@click.option('--system/--no-system', default=False,
+              help="If --system is specified, use the 'fedora', 'updates', "
+                   "'source' and 'updates-source' repositories from the local "
+                   "system configuration. Otherwise, use the static data from "
+                   "the sampledata directory.")
+@click.option('--rhel/--no-rhel', default=False,
+              help="If --system is not specified, the use of --rhel will "
+                   "give back results from the RHEL sample data. Otherwise, "
+                   "Fedora sample data will be used.")
+@click.option('--version', default="25",
+              help="Specify the version of the OS sampledata to compare "
+                   "against.")
+@click.option('--backend', default=DEFAULT_BACKEND,
+              type=click.Choice(BACKENDS),
+              help="Load the repositories with python3-dnf, or read their "
+                   "primary.sqlite or XML metadata directly, which does "
+                   "not need dnf but only supports the static sampledata.")
+@click.option('--filelists', default=None,
+              type=click.Choice(sqliterepo.FILELISTS_MODES),
+              help="Satisfy file dependencies with only the files listed in "
+                   "the primary metadata, or with every file from the "
+                   "filelists metadata, loaded up front (full) or when the "
+                   "first file dependency is looked up (lazy). Defaults to "
+                   "full with the dnf backend, which loads the filelists "
+                   "anyway, and to primary otherwise.")
+@click.option('--cache/--no-cache', default=True,
+              help="Reuse the on-disk cache of the static sampledata. It is "
+                   "regenerated automatically whenever the repodata "
+                   "changes.")
+@click.option('--rebuild-cache/--no-rebuild-cache', default=False,
+              help="Discard the on-disk cache of the static sampledata and "
+                   "regenerate it.")
+@click.option('--stats/--no-stats', default=False,
+              help="Print the time spent in each phase, the number of "
+                   "queries and lookups made and the peak memory use to "
+                   "standard error when the command ends.")
+@click.option('--stats-json', default=None, metavar="PATH",
+              help="Write the statistics printed by --stats to the file at "
+                   "PATH as JSON.")
+@click.option('--from-file', default=None, metavar="PATH",
+              help="Also read package names from the file at PATH, one per "
+                   "line, or from standard input if PATH is '-'. Blank "
+                   "lines and lines starting with '#' are skipped.")
+def exportgraph(pkgnames, output, all_packages, hint, filter, pick_first,
+                system, rhel, version, backend, filelists, cache,
+                rebuild_cache, stats, stats_json, from_file):
+    """
+    Resolve the complete dependency graph of the specified packages,
+    including their self-hosting dependencies, and write it to a compact
+    file that pkggraph.py can query without dnf or the repodata.
+    """
+    start_stats(stats, stats_json)
+    query = get_query_object(system, rhel, version, cache, rebuild_cache,
+                             backend, filelists)
+    hits, misses = query.resolve_hits, query.resolve_misses
+
+    pkgnames = with_names_from_file(pkgnames, from_file)
+    if all_packages:
+        roots = [pkg for pkg in query.filter(latest=True, arch=ARCH_TIERS)
+                 if pkg.name not in filter]
+    else:
+        roots = [pkg for (pkgname, pkg) in
+                 get_pkgs_by_name(query, pkgnames, filter)]
+
+    meta = {"repositories": _get_repo_set_name(system, rhel, version),
+            "roots": sorted(format_package_name(pkg, True) for pkg in roots),
+            "hints": list(hint),
+            "filters": list(filter),
+            "pick_first": pick_first,
+            "arch_tiers": ARCH_TIERS,
+            "multi_arch": multi_arch,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+
+    writer = export_dependency_graph(query, roots, hint, filter, pick_first,
+                                     meta)
+    with stats_phase("output"):
+        writer.write(output)
+
+    print("Wrote %d packages to %s" % (len(writer), output),
+          file=sys.stderr)
+    print_resolution_stats(query, hits, misses)
+
+
+@main.command(short_help="Debug missing Provides")
+@click.argument('requires', nargs=-1)
+
+@click.option('--system/--no-system', default=False,
+              help="If --system is specified, use the 'fedora', 'updates', "
+                   "'source' and 'updates-source' repositories from the local "
+                   "system configuration. Otherwise, use the static data from "
+                   "the sampledata directory.")
+@click.option('--rhel/--no-rhel', default=False,
+              help="If --system is not specified, the use of --rhel will "
+                   "give back results from the RHEL sample data. Otherwise, "
+                   "Fedora sample data will be used.")
+@click.option('--version', default="25",
+              help="Specify the version of the OS sampledata to compare "
+                   "against.")
+@click.option('--backend', default=DEFAULT_BACKEND,
+              type=click.Choice(BACKENDS),
+              help="Load the repositories with python3-dnf, or read their "
+                   "primary.sqlite or XML metadata directly, which does "
+                   "not need dnf but only supports the static sampledata.")
+@click.option('--filelists', default=None,
+              type=click.Choice(sqliterepo.FILELISTS_MODES),
+              help="Satisfy file dependencies with only the files listed in "
+                   "the primary metadata, or with every file from the "
+                   "filelists metadata, loaded up front (full) or when the "
+                   "first file dependency is looked up (lazy). Defaults to "
+                   "full with the dnf backend, which loads the filelists "
+                   "anyway, and to primary otherwise.")
+@click.option('--cache/--no-cache', default=True,
+              help="Reuse the on-disk cache of the static sampledata. It is "
+                   "regenerated automatically whenever the repodata "
+                   "changes.")
+@click.option('--rebuild-cache/--no-rebuild-cache', default=False,
+              help="Discard the on-disk cache of the static sampledata and "
+                   "regenerate it.")
+@click.option('--stats/--no-stats', default=False,
+              help="Print the time spent in each phase, the number of "
+                   "queries and lookups made and the peak memory use to "
+                   "standard error when the command ends.")
+@click.option('--stats-json', default=None, metavar="PATH",
+              help="Write the statistics printed by --stats to the file at "
+                   "PATH as JSON.")
+@click.option('--from-file', default=None, metavar="PATH",
+              help="Also read requirements from the file at PATH, one per "
+                   "line, or from standard input if PATH is '-'. Blank "
+                   "lines and lines starting with '#' are skipped.")
+@click.option('--server', default=None, metavar="PATH",
+              help="Send this request to the resolver daemon listening on "
+                   "the Unix socket at PATH (see 'whatpkgs.py serve').")
+def debugprovides(requires, system, rhel, version, backend, filelists, cache,
+                  rebuild_cache, stats, stats_json, from_file, server):
+    if server:
+        forward_to_server(server)
+    start_stats(stats, stats_json)
+
+    query = get_query_object(system, rhel, version, cache, rebuild_cache,
+                             backend, filelists)
+
+    missing = False
+    for require in with_names_from_file(requires, from_file):
+        required_packages = get_providers(query, require)
+
+        # If there are no dependencies, report it and carry on
+        if len(required_packages) == 0:
+            print("No package for [%s]" % (str(require)), file=sys.stderr)
+            missing = True
+            continue
+
+        for pkg in required_packages:
+            print(repr(pkg))
+
+    if missing:
         sys.exit(1)
 
-    for pkg in required_packages:
-        print(repr(pkg))
 
+@main.command(short_help="Regenerate package lists from a recipe")
+@click.argument('recipe_file', metavar="FILE")
+@click.option('--backend', default=DEFAULT_BACKEND,
+              type=click.Choice(BACKENDS),
+              help="Load the repositories with python3-dnf, or read their "
+                   "primary.sqlite or XML metadata directly, which does "
+                   "not need dnf but only supports the static sampledata.")
+@click.option('--filelists', default=None,
+              type=click.Choice(sqliterepo.FILELISTS_MODES),
+              help="Satisfy file dependencies with only the files listed in "
+                   "the primary metadata, or with every file from the "
+                   "filelists metadata, loaded up front (full) or when the "
+                   "first file dependency is looked up (lazy). Defaults to "
+                   "full with the dnf backend, which loads the filelists "
+                   "anyway, and to primary otherwise.")
+@click.option('--cache/--no-cache', default=True,
+              help="Reuse the on-disk cache of the static sampledata. It is "
+                   "regenerated automatically whenever the repodata "
+                   "changes.")
+@click.option('--rebuild-cache/--no-rebuild-cache', default=False,
+              help="Discard the on-disk cache of the static sampledata and "
+                   "regenerate it.")
+@click.option('--stats/--no-stats', default=False,
+              help="Print the time spent in each phase, the number of "
+                   "queries and lookups made and the peak memory use to "
+                   "standard error when the command ends.")
+@click.option('--stats-json', default=None, metavar="PATH",
+              help="Write the statistics printed by --stats to the file at "
+                   "PATH as JSON.")
+def recipe(recipe_file, backend, filelists, cache, rebuild_cache, stats,
+           stats_json):
+    """
+    Load the repositories once and write every package list described by the
+    JSON recipe in FILE, computing each closure only once.
+
+    The recipe is an object with these keys (paths are relative to FILE):
+
+    \b
+      system, rhel, version  repositories to use, as for the other commands
+      inputs                 files listing the top-level binary packages
+      filters                packages to skip, as for --filter
+      runtime                options for the runtime closure: "hints",
+                             "recommends" and "pick-first"
+      selfhost               the same options for the self-hosting closure,
+                             plus "inputs" listing its top-level packages
+                             (the runtime closure if not given)
+      outputs                maps each list to write to its file. The lists
+                             are toplevel-sources, runtime-binaries,
+                             runtime-sources, selfhost-binaries and
+                             selfhost-sources, each suffixed with -short or
+                             -full
+    """
+    start_stats(stats, stats_json)
+    with open(recipe_file) as f:
+        spec = json.load(f)
+
+    query = get_query_object(spec.get("system", False),
+                             spec.get("rhel", False),
+                             str(spec.get("version", "25")),
+                             cache, rebuild_cache, backend, filelists)
+
+    run_recipe(spec, os.path.dirname(os.path.abspath(recipe_file)), query)
+
+
+@main.command(short_help="Run a resident resolver daemon")
+@click.option('--socket', 'socket_path', required=True, metavar="PATH",
+              help="Path of the Unix socket to listen on.")
+@click.option('--system/--no-system', default=False,
+              help="Load the 'fedora', 'updates', 'source' and "
+                   "'updates-source' repositories from the local system "
+                   "configuration.")
+@click.option('--rhel/--no-rhel', default=False,
+              help="Load the RHEL sample data.")
+@click.option('--version', multiple=True,
+              help="Load the Fedora sample data for this version. This "
+                   "option may be specified multiple times. If no "
+                   "repositories are requested at all, the Fedora 25 sample "
+                   "data is loaded.")
+@click.option('--backend', default=DEFAULT_BACKEND,
+              type=click.Choice(BACKENDS),
+              help="Load the repositories with python3-dnf, or read their "
+                   "primary.sqlite or XML metadata directly, which does "
+                   "not need dnf but only supports the static sampledata.")
+@click.option('--filelists', default=None,
+              type=click.Choice(sqliterepo.FILELISTS_MODES),
+              help="Satisfy file dependencies with only the files listed in "
+                   "the primary metadata, or with every file from the "
+                   "filelists metadata, loaded up front (full) or when the "
+                   "first file dependency is looked up (lazy). Defaults to "
+                   "full with the dnf backend, which loads the filelists "
+                   "anyway, and to primary otherwise.")
+@click.option('--cache/--no-cache', default=True,
+              help="Reuse the on-disk cache of the static sampledata. It is "
+                   "regenerated automatically whenever the repodata "
+                   "changes.")
+@click.option('--rebuild-cache/--no-rebuild-cache', default=False,
+              help="Discard the on-disk cache of the static sampledata and "
+                   "regenerate it.")
+def serve(socket_path, system, rhel, version, backend, filelists, cache,
+          rebuild_cache):
+    """
+    Load the requested repositories once and answer requests sent by the
+    other subcommands with --server until interrupted.
+
+    Requests are processed one at a time.
+    """
+    global _resident_queries
+
+    repo_sets = []
+    if system:
+        repo_sets.append((True, False, "25"))
+    if rhel:
+        repo_sets.append((False, True, "25"))
+    for ver in version:
+        repo_sets.append((False, False, ver))
+    if not repo_sets:
+        repo_sets.append((False, False, "25"))
+
+    if filelists is None:
+        filelists = default_filelists(backend)
+
+    queries = {}
+    for (use_system, use_rhel, ver) in repo_sets:
+        setname = _get_repo_set_name(use_system, use_rhel, ver)
+        queries[setname] = (get_query_object(use_system, use_rhel, ver,
+                                             cache, rebuild_cache, backend,
+                                             filelists),
+                            backend, filelists)
+    _resident_queries = queries
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = socketserver.UnixStreamServer(socket_path,
+                                           ResolverRequestHandler)
+    print("Serving %s on %s" % (", ".join(sorted(queries)), socket_path),
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+"""
+Repository backend that stream-parses the primary.xml.gz and filelists.xml.gz
+metadata of yum/dnf repositories, for repositories that only ship XML
+metadata.
+
+Each file is read with ElementTree.iterparse and every <package> element is
+discarded as soon as it has been indexed, so memory use is bounded by the
+indexes (names, Provides, dependencies, source RPMs and file paths) rather
+than by the size of the document. The resulting Sack and Query behave
+exactly like the ones of sqliterepo.py.
+"""
+
+import gzip
+from xml.etree import ElementTree
+
+import sqliterepo
+from sqliterepo import Reldep, RepodataException
+
+COMMON_NS = "http://linux.duke.edu/metadata/common"
+RPM_NS = "http://linux.duke.edu/metadata/rpm"
+FILELISTS_NS = "http://linux.duke.edu/metadata/filelists"
+
+# Dependency lists kept for each package: the <rpm:*> element they are read
+# from, and which entries of it belong in the list according to their "pre"
+# attribute (None for all of them)
+DEPENDENCY_LISTS = (
+    ("requires", False),
+    ("requires", True),
+    ("recommends", None),
+)
+
+
+def _iter_packages(filename, tag):
+    """
+    Yield the <package> elements of a (compressed) metadata file one at a
+    time, freeing each of them once the caller is done with it
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    try:
+        with opener(filename, "rb") as stream:
+            root = None
+            for (event, elem) in ElementTree.iterparse(
+                    stream, events=("start", "end")):
+                if root is None:
+                    root = elem
+                if event == "end" and elem.tag == tag:
+                    yield elem
+                    root.clear()
+    except (OSError, EOFError, ElementTree.ParseError) as e:
+        raise RepodataException(filename, e)
+
+
+def _parse_entry(entry):
+    epoch = entry.get("epoch")
+    return Reldep(entry.get("name"), entry.get("flags"),
+                  sqliterepo._parse_epoch(epoch) if epoch else None,
+                  entry.get("ver"), entry.get("rel"))
+
+
+def _parse_dependencies(format_elem, kind, pre=None):
+    """
+    Get the dependencies of the given kind listed in a <format> element, in
+    the order of the metadata and without duplicates or rpmlib() ones
+    """
+    deps_elem = format_elem.find("{%s}%s" % (RPM_NS, kind))
+    if deps_elem is None:
+        return []
+
+    deps = []
+    seen = set()
+    for entry in deps_elem.iter("{%s}entry" % RPM_NS):
+        if entry.get("name").startswith("rpmlib("):
+            continue
+        if pre is not None and (entry.get("pre") in ("1", "true")) != pre:
+            continue
+        dep = _parse_entry(entry)
+        if str(dep) not in seen:
+            seen.add(str(dep))
+            deps.append(dep)
+    return deps
+
+
+class Repo(object):
+    """
+    The XML metadata of one repository, indexed in a single pass
+    """
+    def __init__(self, name, path, filelists="primary"):
+        """
+        'filelists' is one of sqliterepo.FILELISTS_MODES
+        """
+        self.name = name
+        self.path = path
+        self.packages = {}
+        self._deps = {}
+        self._provides = {}
+        self._providers = {}
+        # Files of each package, and packages owning each file
+        self._files = None
+        self._file_owners = None
+        self._pkgids = {}
+        self._filelists_path = None
+        if filelists != "primary":
+            self._filelists_path = sqliterepo.find_repodata(path, "filelists")
+        primary_files = {}
+
+        primary = sqliterepo.find_repodata(path, "primary")
+        for (key, elem) in enumerate(_iter_packages(
+                primary, "{%s}package" % COMMON_NS)):
+            version = elem.find("{%s}version" % COMMON_NS)
+            format_elem = elem.find("{%s}format" % COMMON_NS)
+            pkg = sqliterepo.Package(
+                self, key,
+                elem.findtext("{%s}name" % COMMON_NS),
+                elem.findtext("{%s}arch" % COMMON_NS),
+                version.get("epoch"), version.get("ver"), version.get("rel"),
+                format_elem.findtext("{%s}sourcerpm" % RPM_NS))
+            self.packages[key] = pkg
+            self._pkgids[elem.findtext("{%s}checksum" % COMMON_NS)] = key
+
+            for (kind, pre) in DEPENDENCY_LISTS:
+                self._deps[(key, kind, pre)] = _parse_dependencies(
+                    format_elem, kind, pre)
+
+            provides = self._provides[key] = []
+            provides_elem = format_elem.find("{%s}provides" % RPM_NS)
+            if provides_elem is not None:
+                for entry in provides_elem.iter("{%s}entry" % RPM_NS):
+                    provide = _parse_entry(entry)
+                    provides.append(provide)
+                    self._providers.setdefault(provide.name, []).append(
+                        (key, provide))
+
+            if filelists == "primary":
+                # The primary metadata only lists the commonly required
+                # files, such as the ones in the bin directories
+                files = [file_elem.text for file_elem in
+                         format_elem.iter("{%s}file" % COMMON_NS)]
+                if files:
+                    primary_files[key] = files
+
+        if filelists == "primary":
+            self._files = primary_files
+        elif filelists == "full":
+            self.load_files()
+
+    def load_files(self):
+        """
+        Stream-parse the filelists.xml.gz metadata for the files of every
+        package
+        """
+        self._files = {}
+        for elem in _iter_packages(self._filelists_path,
+                                   "{%s}package" % FILELISTS_NS):
+            key = self._pkgids.get(elem.get("pkgid"))
+            if key is not None:
+                self._files[key] = [file_elem.text for file_elem in
+                                    elem.iter("{%s}file" % FILELISTS_NS)]
+
+    def get_deps(self, key, table, pre=None):
+        """
+        Get the dependencies of the given kind of a package
+        """
+        return self._deps.get((key, table, pre), [])
+
+    def get_provides(self, key):
+        """
+        Get the Provides of a package
+        """
+        return self._provides.get(key, [])
+
+    def get_files(self, key):
+        """
+        Get the files of a package. In the "lazy" filelists mode, the
+        filelists metadata is parsed on first use.
+        """
+        if self._files is None:
+            self.load_files()
+        return self._files.get(key, [])
+
+    def whatprovides(self, reldep):
+        """
+        Find the packages of this repository whose Provides (or files, for a
+        path) satisfy a simple dependency
+        """
+        found = [self.packages[key]
+                 for (key, provide) in self._providers.get(reldep.name, [])
+                 if reldep.overlaps(provide)]
+
+        if reldep.name.startswith("/"):
+            if self._file_owners is None:
+                if self._files is None:
+                    self.load_files()
+                self._file_owners = sqliterepo._index_files(self._files)
+            found.extend(self.packages[key]
+                         for key in self._file_owners.get(reldep.name, []))
+
+        return found
+
+
+class Sack(sqliterepo.Sack):
+    """
+    The packages of a set of repositories, read from the primary.xml.gz and
+    filelists.xml.gz of each of them
+    """
+    def __init__(self, repos, filelists="primary"):
+        """
+        Load the (reponame, path) repositories. 'filelists' is one of
+        sqliterepo.FILELISTS_MODES.
+        """
+        self.repos = [Repo(reponame, path, filelists)
+                      for (reponame, path) in repos]
+        self.decompressed = 0